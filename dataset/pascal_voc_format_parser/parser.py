@@ -3,6 +3,10 @@ import json
 import shutil
 import xml.etree.ElementTree as ET
 import xml.dom.minidom
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "source"))
+import annotation_store
 
 '''
 # STRUCTURE OF PASCAL VOC DATASET
@@ -51,25 +55,17 @@ def process_json(json_data, file_name,output_path):
     # process and copy image
     #TODO: copy image to JPEGImages folder as well with regard to the same filename as for the annotation
 
-def process_json_files(base_path,output_path):
+def process_json_files(dataset_path,output_path):
     """
-    Recursively processes all .json files in each numbered folder inside scene_tr.
-    
+    Processes the scene of every frame of a dataset, read from its annotation store.
+
     Args:
-        base_path (str): Path to the 'scene_tr' directory.
+        dataset_path (str): Path to the output directory of render_images.py (containing scene_tr or the shards).
     """
-    cnt = 0
-    for folder_name in sorted(os.listdir(base_path)):  # Iterate over numbered folders
-        folder_path = os.path.join(base_path, folder_name)
-        if os.path.isdir(folder_path):  # Ensure it's a directory
-            for file_name in sorted(os.listdir(folder_path)):  # Iterate over files
-                if file_name.endswith('.json'):  # Process only JSON files
-                    file_path = os.path.join(folder_path, file_name)
-                    with open(file_path, 'r') as json_file:
-                        json_data = json.load(json_file)
-                        #process_json(json_data, file_name, output_path)  # Apply function to JSON data
-                        process_json(json_data, f"{cnt:06d}.xml".format(), output_path)
-                        cnt+=1
+    # the store resolves the annotation deltas and the shards, and skips the base records (CLEVR_*_---.json)
+    store = annotation_store.open_store(dataset_path)
+    for cnt in range(len(store)):
+        process_json(store.scene(cnt), f"{cnt:06d}.xml", output_path)
 
 
 def create_pascal_voc_annotation(output_path, json_data):
@@ -141,6 +137,6 @@ if __name__== "__main__":
     delete_pascal_voc_structure(base_path)
     create_pascal_voc_structure(base_path)
 
-    # Path to the 'scene_tr' directory
-    scene_tr_path = "cylinders-6/scene_tr"
-    process_json_files(scene_tr_path, output_path="Dataset/Annotations")
\ No newline at end of file
+    # Path to the dataset directory (containing 'scene_tr')
+    dataset_path = "cylinders-6"
+    process_json_files(dataset_path, output_path="Dataset/Annotations")
\ No newline at end of file
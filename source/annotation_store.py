@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+"""
+A columnar store of the scene annotations of an output directory.
+
+consolidate reads the scene JSON of every frame once (from scene_tr, or
+from the shards, including the annotation deltas) and writes one .npy file
+per field into <output_dir>/annotation_store:
+
+  transition, frame            [N]           the frames, sorted by transition and frame
+  num_objects                  [N]           the number of objects of each frame, including the table
+  num_related                  [N]           the length of the lists of the relations, without the table
+  bbox                         [N, O, 4]     float32
+  location, pixel_coords       [N, O, 3]     float64
+  size, rotation               [N, O]        float64
+  id                           [N, O]        int16
+  shape, color, material       [N, O]        uint16 indices into the vocabularies in meta.json
+  stackable                    [N, O]        bool
+  rel_<name>                   [N, O]        uint64 bitsets: bit j of rel_on[k, i] is set when
+                                             j is in relationships["on"][i] of frame k
+
+where O is the largest number of objects in a frame; the objects beyond
+num_objects are zero. meta.json also has a digest of the frames and of the
+times / shard offsets of their files, and open_store consolidates the store
+again when they change, e.g. when more transitions are rendered.
+AnnotationStore memory maps the fields:
+
+  python source/annotation_store.py --output-dir output
+  store = AnnotationStore("output")
+  store.bbox[store.index(12, 3)]
+"""
+
+import argparse, hashlib, io, json, os, re
+import numpy as np
+from numpy.lib.format import open_memmap
+import deltas
+
+VERSION = 1
+
+STORE = "annotation_store"
+
+SCENE_FILE = re.compile(r"CLEVR_annotation_(\d+)\.json$")
+
+
+def frame_sources(output_dir):
+  """
+  Returns a sorted list of (transition, frame, load, stamp) where load() returns the scene
+  structure of the frame, from the files of scene_tr and from the shards, and stamp
+  changes when the frame is written again.
+  """
+  res = {}
+  import shards
+  reader = shards.ShardReader(output_dir)
+  for name in reader.names():
+    m = SCENE_FILE.search(name)
+    if name.startswith("scene_tr/") and m:
+      i, j = int(name.split("/")[1]), int(m.group(1))
+      shard, offset, size = reader.members[name]
+      res[(i, j)] = ((lambda i=i, j=j: reader.scene(i, j)), [os.path.basename(shard), offset, size])
+  scenes = os.path.join(output_dir, "scene_tr")
+  if os.path.isdir(scenes):
+    for transition in os.listdir(scenes):
+      directory = os.path.join(scenes, transition)
+      if not os.path.isdir(directory):
+        continue
+      for name in os.listdir(directory):
+        m = SCENE_FILE.match(name)
+        if m:
+          p = os.path.join(directory, name)
+          stat = os.stat(p)
+          res[(int(transition), int(m.group(1)))] = ((lambda p=p: deltas.load_scene(p)), [stat.st_mtime_ns, stat.st_size])
+  return [ (i, j, load, stamp) for (i, j), (load, stamp) in sorted(res.items()) ]
+
+
+def digest(sources):
+  """a digest of the frames of sources and their stamps, to tell when the store is out of date"""
+  h = hashlib.blake2b(digest_size=16)
+  for i, j, _, stamp in sources:
+    h.update(json.dumps([i, j, stamp]).encode())
+  return h.hexdigest()
+
+
+def fields(n, o, relations):
+  res = {
+    "transition"   : (np.int32, (n,)),
+    "frame"        : (np.int16, (n,)),
+    "num_objects"  : (np.uint16, (n,)),
+    "num_related"  : (np.uint16, (n,)),
+    "bbox"         : (np.float32, (n, o, 4)),
+    "location"     : (np.float64, (n, o, 3)),
+    "pixel_coords" : (np.float64, (n, o, 3)),
+    "size"         : (np.float64, (n, o)),
+    "rotation"     : (np.float64, (n, o)),
+    "id"           : (np.int16, (n, o)),
+    "shape"        : (np.uint16, (n, o)),
+    "color"        : (np.uint16, (n, o)),
+    "material"     : (np.uint16, (n, o)),
+    "stackable"    : (np.bool_, (n, o)),
+  }
+  for name in relations:
+    res["rel_" + name] = (np.uint64, (n, o))
+  return res
+
+
+def consolidate(output_dir, sources=None):
+  """Write the store of output_dir and return it as an AnnotationStore."""
+  if sources is None:
+    sources = frame_sources(output_dir)
+  if not sources:
+    raise ValueError("no scene found in {}".format(output_dir))
+  first = sources[0][2]()
+  num_objects = len(first["objects"])
+  if num_objects > 64:
+    raise ValueError("the relation bitsets hold at most 64 objects")
+  relations = sorted(first["relationships"])
+
+  directory = os.path.join(output_dir, STORE)
+  os.makedirs(directory, exist_ok=True)
+  out = {
+    k : open_memmap(os.path.join(directory, k+".npy"), mode="w+", dtype=dtype, shape=shape)
+    for k, (dtype, shape) in fields(len(sources), num_objects, relations).items()
+  }
+  vocab = { "shapes": {}, "materials": {}, "colors": {} }
+  def word(kind, value):
+    return vocab[kind].setdefault(value, len(vocab[kind]))
+
+  for k, (i, j, load, _) in enumerate(sources):
+    scene = first if k == 0 else load()
+    objects = scene["objects"]
+    n = len(objects)
+    if n > num_objects:
+      raise ValueError("frame {} of transition {} has {} objects, more than the {} of the first frame"
+                       .format(j, i, n, num_objects))
+    out["transition"][k] = i
+    out["frame"][k] = j
+    out["num_objects"][k] = n
+    out["num_related"][k] = len(scene["relationships"][relations[0]]) if relations else 0
+    out["bbox"][k, :n]         = [ o["bbox"] for o in objects ]
+    out["location"][k, :n]     = [ o["location"] for o in objects ]
+    out["pixel_coords"][k, :n] = [ o.get("pixel_coords", (0, 0, 0)) for o in objects ]
+    out["size"][k, :n]         = [ o["size"] for o in objects ]
+    out["rotation"][k, :n]     = [ o["rotation"] for o in objects ]
+    out["id"][k, :n]           = [ o["id"] for o in objects ]
+    out["shape"][k, :n]        = [ word("shapes", o["shape"]) for o in objects ]
+    out["color"][k, :n]        = [ word("colors", tuple(o["color"])) for o in objects ]
+    out["material"][k, :n]     = [ word("materials", o["material"]) for o in objects ]
+    out["stackable"][k, :n]    = [ o["stackable"] for o in objects ]
+    for name in relations:
+      related = scene["relationships"][name]
+      if len(related) != out["num_related"][k]:
+        raise ValueError("the relations of frame {} of transition {} have different lengths".format(j, i))
+      out["rel_" + name][k, :len(related)] = [
+        sum(1 << r for r in l) for l in related
+      ]
+  for array in out.values():
+    array.flush()
+
+  meta = {
+    "version"     : VERSION,
+    "num_frames"  : len(sources),
+    "sources"     : digest(sources),
+    "max_objects" : num_objects,
+    "relations"   : relations,
+    "shapes"      : list(vocab["shapes"]),
+    "materials"   : list(vocab["materials"]),
+    "colors"      : [ list(c) for c in vocab["colors"] ],
+  }
+  # written last, so that an interrupted consolidation leaves no meta.json
+  with open(os.path.join(directory, "meta.json"), "w") as f:
+    json.dump(meta, f, indent=2)
+  return AnnotationStore(output_dir)
+
+
+class AnnotationStore(object):
+  """The fields of the store of output_dir, memory mapped as attributes, e.g. store.bbox."""
+  def __init__(self, output_dir):
+    self.output_dir = output_dir
+    directory = os.path.join(output_dir, STORE)
+    with open(os.path.join(directory, "meta.json"), "r") as f:
+      self.meta = json.load(f)
+    if self.meta["version"] > VERSION:
+      raise ValueError("annotation store version {} is newer than the supported version {}"
+                       .format(self.meta["version"], VERSION))
+    for k in fields(0, 0, self.meta["relations"]):
+      setattr(self, k, np.load(os.path.join(directory, k+".npy"), mmap_mode="r"))
+    self.keys = self.transition.astype(np.int64) * 65536 + self.frame
+    self.shards = None
+
+  def __len__(self):
+    return self.meta["num_frames"]
+
+  def index(self, i, j):
+    """the row of the frame j of the transition i"""
+    key = i * 65536 + j
+    k = int(np.searchsorted(self.keys, key))
+    if k == len(self) or self.keys[k] != key:
+      raise KeyError("frame {} of transition {} is not in the store".format(j, i))
+    return k
+
+  def frames(self, i):
+    """the rows of the frames of the transition i"""
+    return np.arange(np.searchsorted(self.keys, i * 65536),
+                     np.searchsorted(self.keys, (i+1) * 65536))
+
+  def image_path(self, k):
+    i, j = int(self.transition[k]), int(self.frame[k])
+    return os.path.join(self.output_dir, "image_tr", "{:06d}".format(i), "CLEVR_image_{:03d}.png".format(j))
+
+  def image(self, k):
+    """the image file of the row k, or a file object on its bytes when it is in the shards."""
+    p = self.image_path(k)
+    if os.path.exists(p):
+      return p
+    if self.shards is None:
+      import shards
+      self.shards = shards.ShardReader(self.output_dir)
+    return io.BytesIO(self.shards.read(os.path.relpath(p, self.output_dir)))
+
+  def relation(self, name):
+    """the bitsets of a relation, [N, O]"""
+    return getattr(self, "rel_" + name)
+
+  def relation_matrix(self, name, k):
+    """res[i, j] when j is in relationships[name][i] of the row k"""
+    bits = self.relation(name)[k, :int(self.num_related[k])]
+    n = int(self.num_objects[k])
+    return (bits[:, None] >> np.arange(n, dtype=np.uint64)[None, :]) & np.uint64(1) == 1
+
+  def scene(self, k):
+    """the scene structure of the row k, with the fields kept in the store"""
+    n = int(self.num_objects[k])
+    meta = self.meta
+    objects = [
+      {
+        "id"           : int(self.id[k, o]),
+        "shape"        : meta["shapes"][self.shape[k, o]],
+        "color"        : meta["colors"][self.color[k, o]],
+        "material"     : meta["materials"][self.material[k, o]],
+        "size"         : float(self.size[k, o]),
+        "rotation"     : float(self.rotation[k, o]),
+        "stackable"    : bool(self.stackable[k, o]),
+        "location"     : self.location[k, o].tolist(),
+        "pixel_coords" : self.pixel_coords[k, o].tolist(),
+        "bbox"         : self.bbox[k, o].tolist(),
+      }
+      for o in range(n)
+    ]
+    relationships = {
+      name : [ np.flatnonzero(row).tolist() for row in self.relation_matrix(name, k) ]
+      for name in meta["relations"]
+    }
+    return {
+      "image_filename" : os.path.basename(self.image_path(k)),
+      "objects"        : objects,
+      "relationships"  : relationships,
+    }
+
+
+def open_store(output_dir):
+  """
+  the store of output_dir, consolidated again when it does not exist or when
+  frames were added, removed or written again since it was consolidated.
+  """
+  sources = frame_sources(output_dir)
+  meta = os.path.join(output_dir, STORE, "meta.json")
+  if os.path.exists(meta):
+    store = AnnotationStore(output_dir)
+    if store.meta.get("sources") == digest(sources):
+      return store
+    # unmapped before its files are written again
+    del store
+    print("the annotation store of {} is out of date; consolidating it again".format(output_dir))
+  return consolidate(output_dir, sources)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Consolidate the scene JSON of an output directory into a columnar store.")
+  parser.add_argument('--output-dir', default='output')
+  args = parser.parse_args()
+  store = consolidate(args.output_dir)
+  print("{} frames of up to {} objects".format(len(store), store.meta["max_objects"]))
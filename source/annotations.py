@@ -0,0 +1,68 @@
+"""
+Writing the scene annotations without Blender.
+
+The annotations are the same as those written by render_utils.render_scene,
+but the pixel coordinates and the bounding boxes are computed by the NumPy
+camera model in camera.py, so no image is rendered.
+"""
+
+import os, random
+import numpy as np
+from render_utils import rand, add_table_object, compute_all_relationships, AnnotationTracker
+import deltas
+
+
+def annotate_scene(args,
+    camera,
+    output_image='render.png',
+    output_scene='render_json',
+    objects=[],
+    camera_rng=random,
+    tracker=None,
+    base_scene=None,
+    writer=None,
+    **kwargs
+  ):
+  """
+  Same as render_utils.render_scene with the camera given as a camera.Camera,
+  but only writes the scene data to output_scene.
+  With an AnnotationTracker, only the objects that moved since the previous
+  frame given to the tracker are annotated again.
+  """
+  if args.camera_jitter > 0:
+    camera = camera.translated([ rand(args.camera_jitter, camera_rng) for i in range(3) ])
+
+  scene_struct = {
+      'image_filename': os.path.basename(output_image),
+      'objects': [],
+      'directions': camera.directions(),
+  }
+  scene_struct.update(kwargs)
+
+  if tracker is None:
+    annotate_objects(camera, objects)
+  else:
+    tracker.annotate_objects(camera, objects)
+
+  add_table_object(objects)
+  scene_struct['objects'] = objects
+  if tracker is None:
+    scene_struct['relationships'] = compute_all_relationships(scene_struct, spatial=args.spatial_relations)
+  else:
+    scene_struct['relationships'] = tracker.relations.update(scene_struct)
+
+  if writer is None:
+    deltas.write_scene(output_scene, scene_struct, base_scene)
+  else:
+    writer.write_scene(output_scene, scene_struct, base_scene)
+
+
+def annotate_objects(camera, objects):
+  """Store the pixel coordinates and the bounding boxes of all objects into them"""
+  locations = np.array([ obj["location"] for obj in objects ], dtype=float)
+  dimensions = np.array([ camera.dimensions(obj["shape"], obj["size"]) for obj in objects ])
+  px, py, z = camera.project(locations)
+  bboxes = camera.bboxes(locations, dimensions)
+  for obj, x, y, d, bbox in zip(objects, px, py, z, bboxes):
+    obj["pixel_coords"] = (int(x), int(y), float(d))
+    obj["bbox"] = tuple(float(v) for v in bbox)
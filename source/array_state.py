@@ -0,0 +1,215 @@
+"""
+A compact blocksworld state backed by NumPy arrays.
+
+ArrayState follows the same rules as blocks.State, but stores one array per
+attribute instead of a list of Block objects, and maintains the table slot and
+the on-top-of relation of each block. tops, object_just_below and action_move
+therefore run without the pairwise scans of blocks.State, which makes it
+suitable for sampling long action sequences over many blocks. dump and
+for_rendering produce the same output as blocks.State.
+"""
+
+import random
+import numpy as np
+from blocks import properties, sample_objects, Unstackable, State, Block
+
+
+class ArrayState(object):
+  """
+  Block i is described by the i-th element of each array:
+
+  shape, color, material, size_id: indices into the lists of attribute values
+  size, rotation, stackable:       attribute values
+  slot:                            index of the table slot of the tower the block is in
+  x, z:                            the coordinates of the block; y is always 0
+  below, above:                    the block just below / above, or -1 for the table / nothing
+  column_top[k]:                   the top block of the k-th table slot, or -1 when empty
+  """
+
+  def __init__(self,args,rng=random):
+    self.table_size = args.table_size
+    self.object_jitter = args.object_jitter
+    self._set_objects(sample_objects(args, rng))
+    self.shuffle(rng)
+    pass
+
+  @staticmethod
+  def vocabulary():
+    """returns the lists of shape names, colors, materials and sizes indexed by the attribute ids."""
+    return (list(properties['shapes'].values()),
+            [ tuple(c) for c in properties['colors'] ],
+            list(properties['materials'].values()),
+            list(properties['sizes'].values()))
+
+  def _set_objects(self,objects):
+    """initialize the attribute arrays from a list of Blocks sorted by id. The blocks are not placed."""
+    shapes, colors, materials, sizes = self.vocabulary()
+    n = len(objects)
+    self.shape     = np.array([ shapes.index(o.shape) for o in objects ], dtype=np.int32)
+    self.color     = np.array([ colors.index(tuple(o.color)) for o in objects ], dtype=np.int32)
+    self.material  = np.array([ materials.index(o.material) for o in objects ], dtype=np.int32)
+    self.size_id   = np.array([ sizes.index(o.size) for o in objects ], dtype=np.int32)
+    self.size      = np.array([ o.size for o in objects ], dtype=float)
+    self.rotation  = np.array([ o.rotation for o in objects ], dtype=float)
+    self.stackable = np.array([ o.stackable for o in objects ], dtype=bool)
+    self.slot      = np.full(n, -1, dtype=np.int32)
+    self.x         = np.zeros(n)
+    self.z         = np.zeros(n)
+    self.below     = np.full(n, -1, dtype=np.int32)
+    self.above     = np.full(n, -1, dtype=np.int32)
+    self.column_top = np.full(self.table_size, -1, dtype=np.int32)
+
+  @classmethod
+  def from_state(cls,state):
+    """convert a blocks.State. The locations of the blocks must be on the table slots."""
+    res = cls.__new__(cls)
+    res.table_size = state.table_size
+    res.object_jitter = state.object_jitter
+    if hasattr(state, "last_action"):
+      res.last_action = state.last_action
+    objects = sorted(state.objects, key=(lambda o: o.id))
+    res._set_objects(objects)
+    # place the blocks from the bottom so that the block below is always placed first
+    for i in sorted(range(len(objects)), key=(lambda i: objects[i].z)):
+      res._place(i, state.slot(objects[i]))
+    res.x[:] = [ o.x for o in objects ]
+    return res
+
+  def clone(self):
+    """returns a copy sharing the attribute arrays, which are never modified in place."""
+    res = ArrayState.__new__(ArrayState)
+    vars(res).update(vars(self))
+    for key in ["slot", "x", "z", "below", "above", "column_top"]:
+      setattr(res, key, getattr(self, key).copy())
+    return res
+
+  def to_state(self):
+    res = State.__new__(State)
+    res.table_size = self.table_size
+    res.object_jitter = self.object_jitter
+    if hasattr(self, "last_action"):
+      res.last_action = self.last_action
+    res.objects = []
+    for values in self.objects():
+      o = Block.__new__(Block)
+      vars(o).update(values)
+      res.objects.append(o)
+    return res
+
+  def __len__(self):
+    return len(self.size)
+
+  def positions(self):
+    """returns the locations of the blocks as an array [num_blocks, 3], as blocks.State.positions."""
+    return np.stack([self.x, np.zeros(len(self)), self.z], axis=1)
+
+  def slot_x(self,k):
+    unit = max(properties['sizes'].values())
+    max_x = unit * 2 * self.table_size
+    return max_x * ((k / (self.table_size-1)) - 1/2)
+
+  def _place(self,i,k):
+    """put block i on top of the tower at slot k."""
+    top = self.column_top[k]
+    self.below[i] = top
+    self.above[i] = -1
+    if top < 0:
+      self.z[i] = self.size[i]
+    else:
+      self.above[top] = i
+      self.z[i] = self.z[top] + self.size[top] + self.size[i]
+    self.slot[i] = k
+    self.x[i] = self.slot_x(k)
+    self.column_top[k] = i
+
+  def _remove(self,i):
+    """take block i, which must be a top, from its tower."""
+    below = self.below[i]
+    self.column_top[self.slot[i]] = below
+    if below >= 0:
+      self.above[below] = -1
+    self.below[i] = -1
+    self.slot[i] = -1
+
+  def feasible_slots(self,i,force_change=False):
+    """returns the slots block i (not in any tower) can be put on."""
+    top = self.column_top
+    ok = (top < 0) | self.stackable[np.maximum(top, 0)]
+    if force_change:
+      ok &= (top != self.below[i])
+    return np.flatnonzero(ok)
+
+  def shuffle(self,rng=random):
+    """place all blocks at random, in the order of ids."""
+    self.column_top[:] = -1
+    for i in range(len(self)):
+      self.shuffle1(i,rng=rng)
+
+  def shuffle1(self,i,force_change=False,rng=random):
+    """move block i, which must not be in any tower, to a random feasible slot.
+ with force_change, the block below must change; block i keeps its previous below until it is placed."""
+    slots = self.feasible_slots(i,force_change)
+    if len(slots) == 0:
+      raise Unstackable("this state is not stackable")
+    self._place(i, int(rng.choice(slots)))
+
+  def wiggle(self,rng=random):
+    """wiggles all objects by adding a jitter to the x coordinate of the objects"""
+    unit = max(properties['sizes'].values())
+    self.x += np.array([ rng.gauss(0.0, self.object_jitter * unit) for _ in range(len(self)) ])
+
+  def tops(self):
+    """returns the ids of the blocks on which nothing is on top of."""
+    return np.flatnonzero(self.above < 0)
+
+  def object_just_below(self,i):
+    below = int(self.below[i])
+    return None if below < 0 else below
+
+  def random_action(self,rng=random):
+    method = rng.choice([self.action_move])
+    method(rng)
+    # storing the name of the action. This is visible in the json file
+    self.last_action = method.__name__
+    pass
+
+  def action_move(self,rng=random):
+    i = int(rng.choice(self.tops()))
+    k = int(self.slot[i])
+    below = self.below[i]
+    self._remove(i)
+    # shuffle1 compares the new block below with this one
+    self.below[i] = below
+    try:
+      self.shuffle1(i,force_change=True,rng=rng)
+    except Unstackable:
+      self._place(i,k)
+      raise
+    pass
+
+  def objects(self):
+    """returns the blocks as a list of dicts in the order of ids, as in blocks.State.for_rendering."""
+    shapes, colors, materials, sizes = self.vocabulary()
+    return [
+      {
+        "shape"     : shapes[self.shape[i]],
+        "color"     : colors[self.color[i]],
+        "size"      : float(self.size[i]),
+        "material"  : materials[self.material[i]],
+        "rotation"  : float(self.rotation[i]),
+        "stackable" : bool(self.stackable[i]),
+        "location"  : [float(self.x[i]), 0, float(self.z[i])],
+        "id"        : i,
+      }
+      for i in range(len(self))
+    ]
+
+  def for_rendering(self):
+    return self.objects()
+
+  def dump(self):
+    return self.to_state().dump()
+
+  @staticmethod
+  def undump(data):
+    return ArrayState.from_state(State.undump(data))
@@ -0,0 +1,169 @@
+"""
+Writing the output files in a background thread.
+
+The render thread hands the rendered pixels and the scene structures to an
+AsyncWriter through a bounded queue, and goes on with the next frame while
+the writer thread encodes the PNG, serializes the JSON and writes (and
+optionally fsyncs) the files. When the queue is full, the render thread
+waits; the time it waits is reported as backpressure by stats().
+
+Files are written to a temporary name and renamed, so a crash never leaves a
+partial file. Since the files of a frame are written later, the frame must
+be recorded as done only after them: mark(tag) queues a marker that poll()
+returns once everything submitted before it is written.
+"""
+
+import os, queue, struct, threading, time, zlib
+import numpy as np
+
+
+def srgb(pixels):
+  """
+  linear float pixels to 8 bit sRGB, as the "Standard" view transform of blender on an sRGB display,
+  without dithering. render_utils.check_color_management refuses the other settings.
+  """
+  c = np.clip(pixels, 0.0, 1.0)
+  c = np.where(c <= 0.0031308, 12.92 * c, 1.055 * np.power(c, 1/2.4) - 0.055)
+  return np.rint(c * 255).astype(np.uint8)
+
+
+def encode_png(pixels, compression=6):
+  """
+  Encode an array [height, width, channels] of uint8 (1, 2, 3 or 4 channels:
+  gray, gray+alpha, RGB, RGBA) as PNG bytes.
+  """
+  pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+  if pixels.ndim == 2:
+    pixels = pixels[:, :, None]
+  h, w, channels = pixels.shape
+  color_type = {1: 0, 2: 4, 3: 2, 4: 6}[channels]
+  # each row starts with its filter type, 0 (none)
+  raw = np.zeros((h, w * channels + 1), dtype=np.uint8)
+  raw[:, 1:] = pixels.reshape(h, w * channels)
+
+  def chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+  return b"".join([
+    b"\x89PNG\r\n\x1a\n",
+    chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, color_type, 0, 0, 0)),
+    chunk(b"IDAT", zlib.compress(raw.tobytes(), compression)),
+    chunk(b"IEND", b""),
+  ])
+
+
+def write_file(path, data, fsync=False):
+  tmp = path + ".tmp"
+  with open(tmp, "wb") as f:
+    f.write(data)
+    if fsync:
+      f.flush()
+      os.fsync(f.fileno())
+  os.replace(tmp, path)
+
+
+class AsyncWriter(object):
+  def __init__(self, max_pending=8, fsync=False, compression=6):
+    self.fsync = fsync
+    self.compression = compression
+    self.queue = queue.Queue(max_pending)
+    self.done = queue.Queue()
+    self.error = None
+    self.metrics = {
+      "tasks"       : 0,
+      "bytes"       : 0,
+      "wait"        : 0.0,  # seconds the render thread waited for a free slot
+      "waits"       : 0,    # number of submissions that found the queue full
+      "busy"        : 0.0,  # seconds the writer thread spent encoding and writing
+      "max_pending" : 0,
+    }
+    self.thread = threading.Thread(target=self._run, daemon=True)
+    self.thread.start()
+
+  def _run(self):
+    while True:
+      task = self.queue.get()
+      if task is None:
+        self.queue.task_done()
+        return
+      fn, args, kwargs = task
+      start = time.time()
+      try:
+        if self.error is None:
+          fn(*args, **kwargs)
+      except Exception as e:
+        self.error = e
+      self.metrics["busy"] += time.time() - start
+      self.metrics["tasks"] += 1
+      self.queue.task_done()
+
+  def submit(self, fn, *args, **kwargs):
+    """Run fn(*args, **kwargs) in the writer thread. Blocks while the queue is full."""
+    if self.error is not None:
+      raise self.error
+    try:
+      self.queue.put_nowait((fn, args, kwargs))
+    except queue.Full:
+      start = time.time()
+      self.queue.put((fn, args, kwargs))
+      self.metrics["wait"] += time.time() - start
+      self.metrics["waits"] += 1
+    self.metrics["max_pending"] = max(self.metrics["max_pending"], self.queue.qsize())
+
+  def _write(self, path, data):
+    write_file(path, data, self.fsync)
+    self.metrics["bytes"] += len(data)
+
+  def write_bytes(self, path, data):
+    self.submit(self._write, path, data)
+
+  def write_png(self, path, pixels):
+    """pixels: uint8 [height, width, channels], or linear floats converted by srgb."""
+    def encode():
+      p = pixels if pixels.dtype == np.uint8 else srgb(pixels)
+      self._write(path, encode_png(p, self.compression))
+    self.submit(encode)
+
+  def write_scene(self, output_scene, scene_struct, base_scene=None):
+    """deltas.write_scene in the writer thread. scene_struct must not be modified afterwards."""
+    import deltas
+    def write():
+      for path, data in deltas.scene_files(output_scene, scene_struct, base_scene):
+        self._write(path, data)
+    self.submit(write)
+
+  def mark(self, tag):
+    """poll() returns tag once all the tasks submitted before are finished."""
+    self.submit(self.done.put, tag)
+
+  def poll(self):
+    """returns the tags of the markers reached since the last call."""
+    if self.error is not None:
+      raise self.error
+    tags = []
+    while True:
+      try:
+        tags.append(self.done.get_nowait())
+      except queue.Empty:
+        return tags
+
+  def flush(self):
+    """wait until all submitted tasks are finished, and return the tags of the markers reached."""
+    self.queue.join()
+    return self.poll()
+
+  def close(self):
+    self.queue.put(None)
+    self.thread.join()
+    return self.poll()
+
+  def stats(self):
+    m = dict(self.metrics)
+    m["pending"] = self.queue.qsize()
+    return m
+
+  def report(self):
+    m = self.stats()
+    return ("writer: {tasks} tasks, {mb:.1f} MB written, busy {busy:.1f}s; "
+            "render thread waited {wait:.1f}s in {waits} submissions, "
+            "up to {max_pending} pending").format(mb=m["bytes"] / 1e6, **m)
@@ -1,5 +1,6 @@
 import json
 import random
+import numpy as np
 from datetime import datetime as dt
 
 properties         = {}
@@ -109,10 +110,31 @@ def initialize_parser_rendering_options(parser):
                       "quality of the rendered image but may affect the speed; CPU-based " +
                       "rendering may achieve better performance using smaller tile sizes " +
                       "while larger tile sizes may be optimal for GPU-based rendering.")
-
-
-def random_dict(dict):
-  return random.choice(list(dict.items()))
+  parser.add_argument('--persistent-session', action="store_true",
+                      help="Load the base scene, the materials and the shapes only once per process " +
+                      "instead of reloading them for every image. Between images, the objects are " +
+                      "removed and the camera and the lights are moved back to their original positions. " +
+                      "The objects share the mesh of their shape, and the objects with the same material " +
+                      "and color share a single material.")
+  parser.add_argument('--tight-bboxes', action="store_true",
+                      help="Compute the bounding boxes from the vertices of the meshes instead of the corners " +
+                      "of the boxes given by the dimensions of the objects. Ignored by --annotations-only.")
+  parser.add_argument('--render-passes', action="store_true",
+                      help="Also write the object index and depth passes of each image as OpenEXR files " +
+                      "(CLEVR_image_NNN_index.exr and CLEVR_image_NNN_depth.exr) in the same render, and " +
+                      "store the visible pixels, the bounding box of the visible pixels, the visibility " +
+                      "and the mean depth of each object in the scene JSON.")
+  parser.add_argument('--spatial-relations', action="store_true",
+                      help="Also store the left, right, front and behind relationships between the objects " +
+                      "in the scene JSON, computed from the directions of the camera.")
+  parser.add_argument('--render-animation', action="store_true",
+                      help="Render all images of a transition as a single animation. The object locations " +
+                      "and the jitter of each image are stored as keyframes, and the scene is transferred " +
+                      "to the renderer only once per transition.")
+
+
+def random_dict(dict, rng=random):
+  return rng.choice(list(dict.items()))
 
 
 
@@ -140,10 +162,12 @@ def dump(obj):
 # dump(undump(dump(a)))
 
 def undump(obj):
+  # the classes that may appear in a dump, looked up by name instead of eval
+  classes = { "State": State, "Block": Block }
   def rec(obj):
     if isinstance(obj, dict):
       if "__class__" in obj:
-        cls = eval(obj["__class__"])
+        cls = classes[obj["__class__"]]
         res = cls.__new__(cls)
         for k, v in obj.items():
           if k != "__class__":
@@ -163,12 +187,12 @@ class Unstackable(Exception):
 
 
 class Block(object):
-  def __init__(self,i):
-    shape_name, self.shape = random_dict(properties['shapes'])
-    self.color             = random.choice(properties['colors'])
-    _, self.size           = random_dict(properties['sizes'])
-    _, self.material       = random_dict(properties['materials'])
-    self.rotation          = 360.0 * random.random()
+  def __init__(self,i,rng=random):
+    shape_name, self.shape = random_dict(properties['shapes'], rng)
+    self.color             = rng.choice(properties['colors'])
+    _, self.size           = random_dict(properties['sizes'], rng)
+    _, self.material       = random_dict(properties['materials'], rng)
+    self.rotation          = 360.0 * rng.random()
     self.stackable         = properties['stackable'][shape_name] == 1
     self.location          = [0,0,0]
     self.id                = i
@@ -224,94 +248,148 @@ class Block(object):
   def above(o1, o2):
     return o1.overlap(o2) and (o1.z > o2.z)
 
+  def clone(self, location=None):
+    """returns a copy of the block that shares the attributes, which are never modified in place.
+ Only the location is copied, or replaced by the given one (e.g. a row of a positions array)."""
+    res = Block.__new__(Block)
+    vars(res).update(vars(self))
+    res.location = list(self.location) if location is None else location
+    return res
 
-class State(object):
-  "Randomly select a list of objects while avoiding duplicates"
 
-  def __init__(self,args):
-    objects         = []
-    for i in range(args.num_objects):
-      while True:
-        o1 = Block(i)
-        if args.allow_duplicates:
-          break
-        ok = True
-        for o2 in objects:
-          if o1.similar(o2):
-            ok = False
-            print("duplicate object!")
-            break
-        if ok:
+def sample_objects(args, rng=random):
+  "Randomly select a list of objects while avoiding duplicates"
+  objects         = []
+  for i in range(args.num_objects):
+    while True:
+      o1 = Block(i, rng)
+      if args.allow_duplicates:
+        break
+      ok = True
+      for o2 in objects:
+        if o1.similar(o2):
+          ok = False
+          print("duplicate object!")
           break
-      objects.append(o1)
+      if ok:
+        break
+    objects.append(o1)
+  return objects
 
+
+class State(object):
+  "Randomly select a list of objects while avoiding duplicates"
+
+  def __init__(self,args,rng=random):
     self.table_size = args.table_size
     self.object_jitter = args.object_jitter
-    self.objects = objects
-    self.shuffle()
+    self.objects = sample_objects(args, rng)
+    self.shuffle(rng)
     pass
 
   def for_rendering(self):
-    return [ vars(o) for o in sorted(self.objects, key=(lambda o: o.id)) ]
+    def location(o):
+      if hasattr(o.location, "tolist"):
+        # a view over a numpy array
+        return o.location.tolist()
+      return list(o.location)
+    return [ dict(vars(o), location=location(o)) for o in sorted(self.objects, key=(lambda o: o.id)) ]
+
+  def clone(self):
+    """returns a copy of the state without copying the block attributes; see Block.clone."""
+    res = State.__new__(State)
+    vars(res).update(vars(self))
+    res.objects = [ o.clone() for o in self.objects ]
+    return res
+
+  def positions(self):
+    """returns the locations of the objects as an array [num_objects, 3], in the order of self.objects."""
+    return np.array([ o.location for o in self.objects ], dtype=float)
+
+  def view(self, positions):
+    """returns a copy of the state whose object locations are the rows of positions (see positions()).
+ The rows are not copied, so wiggle() on the result modifies positions in place."""
+    res = State.__new__(State)
+    vars(res).update(vars(self))
+    res.objects = [ o.clone(location) for o, location in zip(self.objects, positions) ]
+    return res
 
   def dump(self):
-    return dump(self)
+    import state_codec
+    return state_codec.encode(self)
 
   @staticmethod
   def undump(data):
-    return undump(data)
+    import state_codec
+    return state_codec.decode(data)
 
-  def shuffle(self):
+  def shuffle(self,rng=random):
     """destructively modify the list of objects using shuffle1."""
     objs = self.objects.copy()
     self.objects.clear()
     for oi in objs:
-      self.shuffle1(oi)
+      self.shuffle1(oi,rng=rng)
       self.objects.append(oi)
 
-  def shuffle1(self,oi,force_change=False):
+  def shuffle1(self,oi,force_change=False,rng=random):
     """destructively modify an object by choosing a random x position and put it on top of existing objects.
- oi itself is not inserted to the list of objects."""
-    # note: if a cube is rotated by 45degree, it should consume 1.41 times the size
-    unit = max(properties['sizes'].values())
-    max_x = unit * 2 * self.table_size
-
+ oi itself is not inserted to the list of objects.
+ The position is sampled from the table slots where oi can be stacked, so Unstackable is raised
+ only when there is no such slot."""
     if force_change:
       object_below = self.object_just_below(oi)
 
-    trial = 0
-    fail = True
-    while fail and trial < 100:
-      fail = False
-      oi.x = max_x * ((random.randint(0,self.table_size-1) / (self.table_size-1)) - 1/2)
-      oi.z = 0
-      for oj in self.objects:
-        if oi.overlap(oj):
-          if not oj.stackable:
-            fail = True
-            break
-          if not oi.stable_on(oj):
-            fail = True
-            break
-          oi.z = max(oi.z, oj.z + oj.size)
-      oi.z += oi.size
-      if force_change:
-        new_object_below = self.object_just_below(oi)
-        if object_below == new_object_below:
-          # is not shuffled!
-          fail = True
-      trial += 1
-
-    if fail:
+    tops = self.column_tops()
+    slots = []
+    for k, top in enumerate(tops):
+      if top is not None and not top.stackable:
+        continue
+      if force_change and object_below == top:
+        # is not shuffled!
+        continue
+      slots.append(k)
+
+    if len(slots) == 0:
       raise Unstackable("this state is not stackable")
+
+    k = rng.choice(slots)
+    top = tops[k]
+    oi.x = self.slot_x(k)
+    oi.z = 0 if top is None else top.z + top.size
+    oi.z += oi.size
     pass
 
+  def slot_x(self,k):
+    """returns the x coordinate of the k-th table slot."""
+    # note: if a cube is rotated by 45degree, it should consume 1.41 times the size
+    unit = max(properties['sizes'].values())
+    max_x = unit * 2 * self.table_size
+    return max_x * ((k / (self.table_size-1)) - 1/2)
+
+  def slot(self,o):
+    """returns the index of the table slot nearest to the x coordinate of o."""
+    unit = max(properties['sizes'].values())
+    max_x = unit * 2 * self.table_size
+    k = round((o.x / max_x + 1/2) * (self.table_size-1))
+    return min(max(k, 0), self.table_size-1)
+
+  def column_tops(self):
+    """returns a list whose k-th element is the top object of the tower at the k-th table slot,
+ or None if the slot is empty.
+ The slots are wider than any two objects, so objects overlap only when they are in the same slot."""
+    tops = [None] * self.table_size
+    for o in self.objects:
+      k = self.slot(o)
+      if tops[k] is None or tops[k].z < o.z:
+        tops[k] = o
+    return tops
+
 
-  def wiggle(self):
+  def wiggle(self,rng=random):
     """wiggles all objects by adding a jitter to the x coordinate of the objects"""
     unit = max(properties['sizes'].values())
     for oi in self.objects:
-      oi.x += random.gauss(0.0, self.object_jitter * unit)
+      oi.x += rng.gauss(0.0, self.object_jitter * unit)
 
 
   def tops(self):
@@ -347,26 +425,26 @@ class State(object):
           result = other
       return result
 
-  def random_action(self):
-    method = random.choice([self.action_move])
-    method()
+  def random_action(self,rng=random):
+    method = rng.choice([self.action_move])
+    method(rng)
     # storing the name of the action. This is visible in the json file
     self.last_action = method.__name__
     pass
 
-  def action_move(self):
-    o = random.choice(self.tops())
+  def action_move(self,rng=random):
+    o = rng.choice(self.tops())
     index = self.objects.index(o)
     self.objects.remove(o)
-    self.shuffle1(o,force_change=True)
+    self.shuffle1(o,force_change=True,rng=rng)
     self.objects.insert(index,o)
     # note: do not change the order of the object.
     pass
 
-  def action_change_material(self):
-    o = random.choice(self.tops())
+  def action_change_material(self,rng=random):
+    o = rng.choice(self.tops())
     tmp = list(properties['materials'].values())
     tmp.remove(o.material)
-    o.material = random.choice(tmp)
+    o.material = rng.choice(tmp)
     pass
 
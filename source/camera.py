@@ -0,0 +1,179 @@
+"""
+A NumPy model of the camera of the base scene.
+
+The camera and the dimensions of the shapes are exported once from Blender:
+
+  blender --background --python source/camera.py -- --out data/camera.json [render_images.py options]
+
+After that, Camera reproduces utils.get_camera_coords and the corner-based
+bounding boxes of render_utils.add_objects without Blender, and projects many
+points at once.
+"""
+
+import json
+import numpy as np
+
+# the corners of a box centered at the origin with half size 1
+CORNERS = np.array([[ 1, 1, 1],
+                    [ 1, 1,-1],
+                    [ 1,-1, 1],
+                    [ 1,-1,-1],
+                    [-1, 1, 1],
+                    [-1, 1,-1],
+                    [-1,-1, 1],
+                    [-1,-1,-1]], dtype=float)
+
+
+class Camera(object):
+  """
+  matrix:     4x4 column-normalized world matrix of the camera (extrinsics)
+  frame:      the top-right, bottom-right and bottom-left corners of the view frame
+              in camera coordinates, as returned by bpy.types.Camera.view_frame (intrinsics)
+  ortho:      True for an orthographic camera
+  resolution: (width, height) of the image in pixels
+  shape_dimensions: the dimensions of each shape at scale 1, used for the bounding boxes
+  """
+  def __init__(self, matrix, frame, ortho, resolution, shape_dimensions={}):
+    self.matrix = np.array(matrix, dtype=float)
+    self.frame = np.array(frame, dtype=float)
+    self.ortho = ortho
+    self.resolution = tuple(resolution)
+    self.shape_dimensions = dict(shape_dimensions)
+    self.world_to_camera = np.linalg.inv(self.matrix)
+
+  @classmethod
+  def from_blender(cls, camera, scene, shape_dimensions={}):
+    scale = scene.render.resolution_percentage / 100.0
+    return cls(matrix     = [ list(row) for row in camera.matrix_world.normalized() ],
+               frame      = [ list(v) for v in camera.data.view_frame(scene=scene)[:3] ],
+               ortho      = camera.data.type == 'ORTHO',
+               resolution = (int(scale * scene.render.resolution_x),
+                             int(scale * scene.render.resolution_y)),
+               shape_dimensions = shape_dimensions)
+
+  def dump(self):
+    return {
+      "matrix"     : self.matrix.tolist(),
+      "frame"      : self.frame.tolist(),
+      "ortho"      : self.ortho,
+      "resolution" : list(self.resolution),
+      "shape_dimensions" : self.shape_dimensions,
+    }
+
+  @classmethod
+  def undump(cls, data):
+    return cls(**data)
+
+  @classmethod
+  def load(cls, path):
+    with open(path, "r") as f:
+      return cls.undump(json.load(f))
+
+  def translated(self, offset):
+    """Returns a copy of the camera moved by offset, e.g. a jitter."""
+    matrix = self.matrix.copy()
+    matrix[:3, 3] += offset
+    return Camera(matrix, self.frame, self.ortho, self.resolution, self.shape_dimensions)
+
+  def view(self, points):
+    """
+    Same as bpy_extras.object_utils.world_to_camera_view for an array of points
+    of shape [..., 3]. Returns the normalized coordinates x, y and the depth z.
+    """
+    points = np.asarray(points, dtype=float)
+    co = points @ self.world_to_camera[:3, :3].T + self.world_to_camera[:3, 3]
+    z = -co[..., 2]
+    min_x, max_x = self.frame[2, 0], self.frame[1, 0]
+    min_y, max_y = self.frame[1, 1], self.frame[0, 1]
+    if self.ortho:
+      x = (co[..., 0] - min_x) / (max_x - min_x)
+      y = (co[..., 1] - min_y) / (max_y - min_y)
+    else:
+      # the view frame scaled to the depth of each point
+      with np.errstate(divide='ignore', invalid='ignore'):
+        scale = z / -self.frame[0, 2]
+        x = (co[..., 0] - min_x * scale) / ((max_x - min_x) * scale)
+        y = (co[..., 1] - min_y * scale) / ((max_y - min_y) * scale)
+      x = np.where(z == 0, 0.5, x)
+      y = np.where(z == 0, 0.5, y)
+    return x, y, z
+
+  def project(self, points):
+    """
+    Same as utils.get_camera_coords for an array of points of shape [..., 3].
+    Returns the integer pixel coordinates px, py and the depth z.
+    """
+    x, y, z = self.view(points)
+    w, h = self.resolution
+    px = np.round(x * w).astype(int)
+    py = np.round(h - y * h).astype(int)
+    return px, py, z
+
+  def pixel_coords(self, location):
+    """Same as utils.get_camera_coords for a single point."""
+    px, py, z = self.project(location)
+    return (int(px), int(py), float(z))
+
+  def dimensions(self, shape, size):
+    return np.array(self.shape_dimensions[shape]) * size
+
+  def bboxes(self, locations, dimensions):
+    """
+    Returns the bounding boxes (xmin, ymin, xmax, ymax) in pixels of the boxes
+    of the given locations and dimensions (both of shape [N, 3]), as computed
+    by render_utils.add_objects from the 8 corners of each box.
+    """
+    locations = np.asarray(locations, dtype=float)
+    half = np.asarray(dimensions, dtype=float) / 2
+    corners = locations[:, None, :] + half[:, None, :] * CORNERS
+    px, py, _ = self.project(corners)
+    return np.stack([px.min(axis=1), py.min(axis=1), px.max(axis=1), py.max(axis=1)], axis=-1)
+
+  def directions(self):
+    """Same as render_utils.compute_directions with the ground plane normal +z."""
+    rotation = self.matrix[:3, :3]
+    normal = np.array([0.0, 0.0, 1.0])
+    cam_behind = rotation @ [0, 0, -1]
+    cam_left = rotation @ [-1, 0, 0]
+    cam_up = rotation @ [0, 1, 0]
+    def normalized(v):
+      return v / np.linalg.norm(v)
+    plane_behind = normalized(cam_behind - normal * cam_behind[2])
+    plane_left = normalized(cam_left - normal * cam_left[2])
+    plane_up = normalized(normal * cam_up[2])
+    directions = {}
+    directions['left'] = tuple(map(float, plane_left))
+    directions['right'] = tuple(map(float, -plane_left))
+    directions['behind'] = tuple(map(float, plane_behind))
+    directions['front'] = tuple(map(float, -plane_behind))
+    directions['above'] = tuple(map(float, plane_up))
+    directions['below'] = tuple(map(float, -plane_up))
+    return directions
+
+
+def export(args):
+  """Export the camera of the base scene and the dimensions of the shapes. Runs in Blender."""
+  import bpy
+  import utils
+  from render_utils import setup_scene
+  setup_scene(args)
+  with open(args.properties_json, 'r') as f:
+    shapes = json.load(f)["shapes"].values()
+  shape_dimensions = {
+    name : list(utils.load_object(args.shape_dir, name).dimensions)
+    for name in shapes
+  }
+  camera = Camera.from_blender(bpy.data.objects['Camera'], bpy.context.scene, shape_dimensions)
+  with open(args.out, "w") as f:
+    json.dump(camera.dump(), f, indent=2)
+
+
+if __name__ == '__main__':
+  import argparse
+  import utils, blocks
+  parser = argparse.ArgumentParser()
+  blocks.initialize_parser_input_options(parser)
+  blocks.initialize_parser_rendering_options(parser)
+  parser.add_argument('--out', default='data/camera.json',
+                      help="The JSON file to write the camera parameters and shape dimensions to.")
+  export(utils.parse_args(parser))
@@ -0,0 +1,90 @@
+"""
+Detecting the transitions that were already generated in an output directory.
+
+The canonical form of a state describes only its logical configuration: the
+towers of blocks, from the bottom to the top, where each block is given by
+its attributes (shape, color, size, material, stackable). It does not depend
+on the ids of the blocks, on the order of the towers on the table, on the
+rotations or on the x jitter, so two states that differ only in these
+respects have the same key.
+
+The keys of the (pre, suc) pairs generated in an output directory are stored
+in a small sqlite database (dedup.sqlite) shared by all workers, like the ledger.
+"""
+
+import hashlib, json, os, sqlite3
+
+
+def block_attributes(o):
+  return (o.shape, [ round(c, 6) for c in o.color ], round(o.size, 6), o.material, bool(o.stackable))
+
+
+def canonical(state):
+  """returns the towers of the state as a sorted list of lists of block attributes, from the bottom."""
+  towers = {}
+  for o in state.objects:
+    towers.setdefault(state.slot(o), []).append(o)
+  return sorted(
+    [ block_attributes(o) for o in sorted(tower, key=(lambda o: o.z)) ]
+    for tower in towers.values()
+  )
+
+
+def digest(value):
+  return hashlib.blake2b(json.dumps(value, separators=(",", ":")).encode(), digest_size=16).hexdigest()
+
+
+def state_key(state):
+  return digest(canonical(state))
+
+
+def transition_key(pre, suc):
+  return digest([canonical(pre), getattr(suc, "last_action", None), canonical(suc)])
+
+
+class DedupIndex(object):
+  def __init__(self, output_dir, name="dedup.sqlite"):
+    os.makedirs(output_dir, exist_ok=True)
+    self.db = sqlite3.connect(os.path.join(output_dir, name),
+                              timeout=60, isolation_level=None)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("""CREATE TABLE IF NOT EXISTS transitions (
+                         key        TEXT PRIMARY KEY,
+                         idx        INTEGER NOT NULL,
+                         duplicates INTEGER NOT NULL DEFAULT 0)""")
+    self.db.execute("CREATE INDEX IF NOT EXISTS transitions_idx ON transitions (idx)")
+
+  def add(self, key, idx):
+    """
+    Record that the transition idx has the given key. Returns False, and counts
+    the duplicate, when another transition already has the key.
+    """
+    self.db.execute("BEGIN IMMEDIATE")
+    try:
+      row = self.db.execute("SELECT idx FROM transitions WHERE key = ?", (key,)).fetchone()
+      if row is None:
+        self.db.execute("INSERT INTO transitions (key, idx) VALUES (?, ?)", (key, idx))
+        return True
+      if row[0] == idx:
+        return True
+      self.db.execute("UPDATE transitions SET duplicates = duplicates + 1 WHERE key = ?", (key,))
+      return False
+    finally:
+      self.db.execute("COMMIT")
+
+  def forget(self, idx):
+    """Drop the key of the transition idx, e.g. before sampling it again."""
+    self.db.execute("DELETE FROM transitions WHERE idx = ?", (idx,))
+
+  def __contains__(self, key):
+    return self.db.execute("SELECT 1 FROM transitions WHERE key = ?", (key,)).fetchone() is not None
+
+  def __len__(self):
+    return self.db.execute("SELECT COUNT(*) FROM transitions").fetchone()[0]
+
+  def duplicates(self):
+    """Returns the number of duplicate samples rejected so far."""
+    return self.db.execute("SELECT COALESCE(SUM(duplicates), 0) FROM transitions").fetchone()[0]
+
+  def close(self):
+    self.db.close()
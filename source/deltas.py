@@ -0,0 +1,111 @@
+"""
+Storing the scene JSON of the frames of a transition as deltas.
+
+Within a transition, most of the scene data of a frame is the same as in the
+other frames. With deltas, the first scene written for a transition is kept
+as its base record, and each frame only stores what differs from the base:
+
+  {"base": "CLEVR_annotation_---.json",
+   "scene": {"image_filename": ...},              top-level keys that differ
+   "objects": {"2": {"location": ..., ...}},       changed keys of each object, by index
+   "relationships": {"on": {"2": [...]}}}          changed lists of each relation, by index
+
+load_scene reads both full scenes and deltas, and returns the full scene.
+"""
+
+import json, os, copy
+
+_bases = {}
+
+
+def _normalized(scene_struct):
+  # tuples become lists, as when the scene is read back
+  return json.loads(json.dumps(scene_struct))
+
+
+def delta(base, scene_struct):
+  """returns the delta of scene_struct against base; both are scene structures."""
+  scene_struct = _normalized(scene_struct)
+  res = {"scene": {}, "objects": {}, "relationships": {}}
+  for k, v in scene_struct.items():
+    if k in ("objects", "relationships"):
+      continue
+    if base.get(k) != v:
+      res["scene"][k] = v
+  if len(scene_struct["objects"]) != len(base["objects"]):
+    res["scene"]["objects"] = scene_struct["objects"]
+  else:
+    for i, (o, b) in enumerate(zip(scene_struct["objects"], base["objects"])):
+      changed = { k : v for k, v in o.items() if b.get(k) != v }
+      if changed:
+        res["objects"][str(i)] = changed
+  for name, lists in scene_struct.get("relationships", {}).items():
+    base_lists = base.get("relationships", {}).get(name)
+    if base_lists is None or len(base_lists) != len(lists):
+      res["scene"].setdefault("relationships", {})[name] = lists
+      continue
+    changed = { str(i) : l for i, (l, b) in enumerate(zip(lists, base_lists)) if l != b }
+    if changed:
+      res["relationships"][name] = changed
+  return res
+
+
+def apply(base, d):
+  """returns the scene structure of the delta d against base."""
+  res = copy.deepcopy(base)
+  relationships = d["scene"].get("relationships", {})
+  res.update({ k : v for k, v in d["scene"].items() if k != "relationships" })
+  for i, changed in d["objects"].items():
+    res["objects"][int(i)].update(changed)
+  res.setdefault("relationships", {}).update(relationships)
+  for name, changed in d["relationships"].items():
+    for i, l in changed.items():
+      res["relationships"][name][int(i)] = l
+  return res
+
+
+def _load_base(path):
+  path = os.path.abspath(path)
+  mtime = os.path.getmtime(path)
+  if path not in _bases or _bases[path][0] != mtime:
+    with open(path, "r") as f:
+      _bases[path] = (mtime, json.load(f))
+  return _bases[path][1]
+
+
+def scene_files(output_scene, scene_struct, base_scene=None):
+  """
+  Returns the list of (path, bytes) of the files to write for scene_struct: the
+  full scene in output_scene, or with base_scene, a delta against it, preceded
+  by base_scene itself when it does not exist yet.
+  """
+  if base_scene is None:
+    return [(output_scene, json.dumps(scene_struct, indent=2).encode())]
+  files = []
+  if os.path.exists(base_scene):
+    base = _load_base(base_scene)
+  else:
+    base = _normalized(scene_struct)
+    files.append((base_scene, json.dumps(base, separators=(",", ":")).encode()))
+  d = delta(base, scene_struct)
+  d["base"] = os.path.basename(base_scene)
+  files.append((output_scene, json.dumps(d, separators=(",", ":")).encode()))
+  return files
+
+
+def write_scene(output_scene, scene_struct, base_scene=None):
+  """Write scene_struct to output_scene, as a delta against base_scene when it is given."""
+  for path, data in scene_files(output_scene, scene_struct, base_scene):
+    tmp = path + ".tmp"
+    with open(tmp, 'wb') as f:
+      f.write(data)
+    os.replace(tmp, path)
+
+
+def load_scene(path):
+  """returns the full scene structure stored in path, either as a scene or as a delta."""
+  with open(path, "r") as f:
+    data = json.load(f)
+  if "base" not in data:
+    return data
+  return apply(_load_base(os.path.join(os.path.dirname(path), data["base"])), data)
@@ -4,12 +4,16 @@ import numpy as np
 import json
 import imageio
 import os.path
-import skimage.transform
 import skimage.exposure
 import skimage.color
 from skimage.util import img_as_float, img_as_ubyte
 import argparse
 import tqdm
+import tempfile
+import multiprocessing
+from numpy.lib.format import open_memmap
+import annotation_store
+import crop_resize
 
 parser = argparse.ArgumentParser(
     description='extract the regions and save the results in a npz file.')
@@ -29,6 +33,13 @@ parser.add_argument('--preprocess-mode', type=int, default=6,
                     help="")
 parser.add_argument('--num-samples-per-state', default=5, type=int,
                     help="The number of images to render per logical states")
+parser.add_argument('--jobs', default=os.cpu_count(), type=int,
+                    help="The number of processes.")
+parser.add_argument('--chunk-size', default=16, type=int,
+                    help="The number of states extracted by a process at a time.")
+parser.add_argument('--work-dir', default=None,
+                    help="The directory of the temporary memory mapped arrays of the statistics, which take about as much space as the output before compression. "+
+                    "Defaults to the system temporary directory.")
 
 
 def preprocess(args,rgb):
@@ -81,99 +92,153 @@ def safe_load_json(path):
             return obj
 
 
-def main(args):
+def extract_state(args, store, rows, picsize, maxobj):
+    """returns the images, the patches and the bboxes of the rows of the store, i.e. the frames of a state."""
+    images = np.zeros((len(rows), *picsize), dtype=np.uint8)
+    frames = np.zeros((len(rows), *picsize))
+    for j, k in enumerate(rows):
+        images[j] = imageio.imread(store.image(k))[:,:,:3] # range: [0,   255]
+        image = img_as_float(images[j])                     # range: [0.0, 1.0]
+        frames[j] = preprocess(args,image)
+        assert(picsize==frames[j].shape)
+
+    patches = np.zeros((len(rows), maxobj, *args.resize, 3), dtype=np.uint8)
+    bboxes = np.zeros((len(rows), maxobj, 4), dtype=np.uint16)
+    # all the regions of the state are resized at once, see crop_resize.py
+    if args.include_background:
+        # picsize = (200, 300, 3)
+        # [0,0,300,200] --- xmin,ymin,xmax,ymax
+        bboxes[:,-1] = [0,0,picsize[1],picsize[0]]
+        patches[:,-1] = crop_resize.crop_resize(frames, np.arange(len(rows)), bboxes[:,-1], args.resize)
+    if args.exclude_objects:
+        return images, patches, bboxes
+
+    o = store.bbox.shape[1]
+    boxes = np.asarray(store.bbox[rows])
+    objects = np.arange(o)[None,:] < store.num_objects[rows][:,None]
+    bboxes[:,:o][objects] = boxes[objects]
+    # the pixels covered by the bboxes
+    x1, y1, x2, y2 = np.moveaxis(np.trunc(boxes).astype(int), -1, 0)
+    x1, x2 = np.clip(x1, 0, picsize[1]), np.clip(x2, 0, picsize[1])
+    y1, y2 = np.clip(y1, 0, picsize[0]), np.clip(y2, 0, picsize[0])
+    # the empty regions, e.g. the table or an object lifted out of the view, have no patch
+    regions = objects & (x1 < x2) & (y1 < y2)
+    frame, obj = np.nonzero(regions)
+    patches[frame, obj] = crop_resize.crop_resize(frames, frame, np.stack([x1, y1, x2, y2], -1)[regions], args.resize)
+    return images, patches, bboxes
+
+
+def extract_states(args, store, start, stop, picsize, maxobj, outputs):
+    """extract the states start to stop, and write their statistics into outputs."""
+    samples = args.num_samples_per_state
+    num_transitions = (len(store) // samples) // 2
+    start_idx = int(store.transition[0])
+    for i in range(start, stop):
+        images, patches, bboxes = extract_state(args, store, np.arange(i*samples, (i+1)*samples), picsize, maxobj)
+
+        outputs["patches_mean"][i] = patches.mean(axis=0)
+        outputs["patches_var"][i]  = patches.var(axis=0)
+        outputs["coords_mean"][i]  = bboxes_to_coord(bboxes.mean(axis=0),"mean")
+        outputs["coords_var"][i]   = bboxes_to_coord(bboxes.var(axis=0),"variance")
+
+        if i < num_transitions * 2:
+            presuc = ("pre","suc")[i % 2]
+            if not os.path.exists(path("distr_tr",start_idx+i//2,presuc,"mean","png")):
+                imageio.imwrite(path("distr_tr",start_idx+i//2,presuc,"mean","png"), img_as_ubyte(images.mean(axis=0)/255)) # [0, 2^8-1]
+                imageio.imwrite(path("distr_tr",start_idx+i//2,presuc,"std","png"), img_as_ubyte(images.std(axis=0)/255))
+    for array in outputs.values():
+        array.flush()
+    return stop - start
+
+
+_worker = {}
+
+# the options read by the workers. args itself is not sent to them, as --out is an open file,
+# which cannot be pickled for the spawn / forkserver start methods
+WORKER_OPTIONS = ("dir", "resize", "preprocess", "preprocess_mode",
+                  "include_background", "exclude_objects", "num_samples_per_state")
+
+def _init_worker(args_, picsize, maxobj, work_dir):
+    # path() reads the global args
+    global args
+    args = args_
+    _worker.update(
+        store   = annotation_store.AnnotationStore(args.dir),
+        picsize = picsize,
+        maxobj  = maxobj,
+        outputs = { name : np.load(os.path.join(work_dir, name+".npy"), mmap_mode="r+")
+                    for name in ("patches_mean", "patches_var", "coords_mean", "coords_var") })
+
+
+def _extract_states(job):
+    start, stop = job
+    w = _worker
+    return extract_states(args, w["store"], start, stop, w["picsize"], w["maxobj"], w["outputs"])
 
-    scenes=os.path.join(args.dir,"scene_tr")
-    files = [ f for f in os.listdir(scenes) if "---" not in f ]
-    files.sort()
-    filenum = len(files)
 
-    scene = safe_load_json(os.path.join(scenes,files[0]))
-    maxobj = len(scene["objects"])
-    imagefile = os.path.join(args.dir,"image_tr",scene["image_filename"])
-    picsize = imageio.imread(imagefile)[:,:,:3].shape
+def main(args):
+
+    # the scene JSON are read once into the columnar store, and later runs reuse it
+    store = annotation_store.open_store(args.dir)
+    filenum = len(store)
 
-    # .../CLEVR_XXXXXX_pre_YYY.png -> XXXXXX
-    start_idx = int(os.path.split(imagefile)[1].split("_")[1])
+    maxobj = store.meta["max_objects"]
+    picsize = imageio.imread(store.image(0))[:,:,:3].shape
 
     if args.exclude_objects:
         maxobj = 0
     if args.include_background:
         maxobj += 1
 
-    images = np.zeros((filenum, *picsize), dtype=np.uint8)
-    patches = np.zeros((filenum, maxobj, *args.resize, 3), dtype=np.uint8)
-    bboxes = np.zeros((filenum, maxobj, 4), dtype=np.uint16)
-
-    if args.include_background:
-        # picsize = (200, 300, 3)
-        # [0,0,300,200] --- xmin,ymin,xmax,ymax
-        bboxes[:,-1] = [0,0,picsize[1],picsize[0]]
-
-    print("extracting images")
-    # store states
-    for i,scenefile in tqdm.tqdm(enumerate(files),total=len(files)):
-
-        scene = safe_load_json(os.path.join(scenes,scenefile))
-
-        imagefile = os.path.join(args.dir,"image_tr",scene["image_filename"])
-        image_ubyte = imageio.imread(imagefile)[:,:,:3] # range: [0,   255]
-        image = img_as_float(image_ubyte)               # range: [0.0, 1.0]
-        image = preprocess(args,image)
-        assert(picsize==image.shape)
-        images[i] = image_ubyte
-        if args.include_background:
-            # note: resize may cause numerical error that makes values exceed 0.0,1.0.
-            # the value is now from 0 to 255.
-            patches[i,-1] = img_as_ubyte(np.clip(skimage.transform.resize(image,(*args.resize,3)), 0.0, 1.0))
-        if args.exclude_objects:
-            continue
-
-        for j, obj in enumerate(scene["objects"]):
-            bbox = tuple(obj["bbox"])
-            x1, y1, x2, y2 = bbox
-            region = image[int(y1):int(y2), int(x1):int(x2), :]
-            # note: resize may cause numerical error that makes values exceed 0.0,1.0
-            patches[i,j] = img_as_ubyte(np.clip(skimage.transform.resize(region,(*args.resize,3)), 0.0, 1.0))
-            bboxes[i,j] = bbox
-
-    print("computing means and variances")
     samples = args.num_samples_per_state
     num_states = filenum // samples
     num_transitions = num_states // 2
-    images = images.reshape((num_states, samples, *picsize))
-    patches = patches.reshape((num_states, samples, maxobj, *args.resize, 3))
-    bboxes = bboxes.reshape((num_states, samples, maxobj, 4))
-    images_mean = images.mean(axis=1) # [0, 2^8-1]
-    patches_mean = patches.mean(axis=1)
-    bboxes_mean = bboxes.mean(axis=1)
-    images_std = images.std(axis=1) # [0, 2^8-1]
-    patches_std = patches.std(axis=1)
-    bboxes_std = bboxes.std(axis=1)
-    images_var = images.var(axis=1) # [0, 2^16-1]
-    patches_var = patches.var(axis=1)
-    bboxes_var = bboxes.var(axis=1)
-    coords_mean = bboxes_to_coord(bboxes_mean,"mean")
-    coords_var = bboxes_to_coord(bboxes_var,"variance")
-
-    images_mean2 = images_mean.reshape((num_transitions, 2, *picsize))
-    images_std2  = images_std.reshape((num_transitions, 2, *picsize))
-    os.makedirs(os.path.join(args.dir,"distr_tr"),exist_ok=True)
-    for i in tqdm.tqdm(range(num_transitions)):
-        for presuc,j in (("pre",0),("suc",1)):
-            if os.path.exists(path("distr_tr",start_idx+i,presuc,"mean","png")):
-                continue
-            imageio.imwrite(path("distr_tr",start_idx+i,presuc,"mean","png"), img_as_ubyte(images_mean2[i,j]/255))
-            imageio.imwrite(path("distr_tr",start_idx+i,presuc,"std","png"), img_as_ubyte(images_std2[i,j]/255))
 
+    # the frames are processed one state (samples frames) at a time, and only the statistics
+    # of the states are kept, in memory mapped arrays, so the memory does not grow with the dataset.
+    # they are stored in the dtypes of the archive, except for --as-problem which uses the floats
+    # (it has only 2 states anyway).
     if args.as_problem:
-        save_as = save_as_problem
+        dtypes = (np.float64, np.float64, np.float64, np.float64)
     else:
-        save_as = save_as_dataset
-    save_as(args,samples,num_states,num_transitions,
-            patches_mean,patches_var,
-            coords_mean,coords_var,
-            picsize)
+        dtypes = (np.uint8, np.uint16, np.uint16, np.uint32)
+    # removed also when the extraction fails or is interrupted
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        names = ("patches_mean", "patches_var", "coords_mean", "coords_var")
+        shapes = ((num_states, maxobj, *args.resize, 3),
+                  (num_states, maxobj, *args.resize, 3),
+                  (num_states, maxobj, 4),
+                  (num_states, maxobj, 4))
+        for name, dtype, shape in zip(names, dtypes, shapes):
+            open_memmap(os.path.join(work_dir, name+".npy"), mode="w+", dtype=dtype, shape=shape).flush()
+
+        os.makedirs(os.path.join(args.dir,"distr_tr"),exist_ok=True)
+        print("extracting images")
+        # work units of chunk_size states, each written by its worker straight into the memory mapped arrays
+        jobs = [ (start, min(start + args.chunk_size, num_states))
+                 for start in range(0, num_states, args.chunk_size) ]
+        options = argparse.Namespace(**{ k : getattr(args, k) for k in WORKER_OPTIONS })
+        initargs = (options, picsize, maxobj, work_dir)
+        with tqdm.tqdm(total=num_states) as progress:
+            if args.jobs == 1:
+                _init_worker(*initargs)
+                for job in jobs:
+                    progress.update(_extract_states(job))
+            else:
+                with multiprocessing.Pool(args.jobs, initializer=_init_worker, initargs=initargs) as pool:
+                    for n in pool.imap_unordered(_extract_states, jobs):
+                        progress.update(n)
+        patches_mean, patches_var, coords_mean, coords_var = [
+            np.load(os.path.join(work_dir, name+".npy"), mmap_mode="r") for name in names ]
+
+        if args.as_problem:
+            save_as = save_as_problem
+        else:
+            save_as = save_as_dataset
+        save_as(args,samples,num_states,num_transitions,
+                patches_mean,patches_var,
+                coords_mean,coords_var,
+                picsize)
 
     pass
 
@@ -186,10 +251,10 @@ def save_as_dataset(args,
     np.savez_compressed(args.out,
                         # note: the name mismatch (images vs patches) is not a mistake,
                         # an artifact of history of changes.
-                        images_mean=patches_mean.astype(np.uint8),
-                        images_var=patches_var.astype(np.uint16),
-                        coords_mean=coords_mean.astype(np.uint16),
-                        coords_var=coords_var.astype(np.uint32),
+                        images_mean=patches_mean.astype(np.uint8, copy=False),
+                        images_var=patches_var.astype(np.uint16, copy=False),
+                        coords_mean=coords_mean.astype(np.uint16, copy=False),
+                        coords_var=coords_var.astype(np.uint32, copy=False),
                         # metadata
                         picsize=picsize,
                         patch_shape=[*args.resize,3],
@@ -241,7 +306,6 @@ def bboxes_to_coord(bboxes,mode="mean"):
 
 
 if __name__ == '__main__':
-    import sys
     args = parser.parse_args()
     main(args)
 
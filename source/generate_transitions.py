@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+"""
+Generate logical transitions (pre, action, suc) without Blender.
+
+The transitions are written in a directory as one .npy file per field, so
+that millions of transitions can be generated on a machine with little
+memory and read back without parsing. Transition idx is generated from its
+logic stream (see streams.py), so the result does not depend on the number of
+processes, and matches render_images.py with the same --seed.
+
+  python source/generate_transitions.py --properties-json data/cylinders-properties.json \\
+      --num-transitions 1000000 --jobs 16 --out transitions
+
+Rendering jobs read the file with render_images.py --transitions-file transitions.
+
+Fields, for N transitions of M blocks in the order of their ids:
+
+  shape, color, material  [N, M] uint16    indices into the vocabularies in meta.json
+  size, rotation          [N, M] float64
+  stackable               [N, M] bool
+  pre, suc                [N, M, 3] float64  locations
+  action                  [N] uint16       index into the actions in meta.json
+  plan                    [N, S-1, M, 3]   locations of the intermediate states, for --num-steps S > 1
+"""
+
+import argparse, json, os, random
+import multiprocessing
+import numpy as np
+from numpy.lib.format import open_memmap
+import blocks
+from blocks import State, Unstackable, properties, load_colors
+from array_state import ArrayState
+import state_codec
+import streams
+
+VERSION = 1
+
+ACTIONS = sorted( name for name in dir(State) if name.startswith("action_") )
+
+
+def sample_transition(args, rng=random):
+  """
+  returns a random state and its successor after args.num_steps actions, as blocks.State.
+  They are sampled as ArrayStates, which draw from rng as State does, so the
+  transitions are the same as with State, only faster for many blocks.
+  """
+  pre = ArrayState(args, rng)
+  suc = pre.clone()
+  # the positions of the intermediate states of a plan with several steps
+  plan = []
+  for j in range(args.num_steps):
+    if j > 0:
+      plan.append(suc.positions().tolist())
+    suc.random_action(rng)
+  pre, suc = pre.to_state(), suc.to_state()
+  if plan:
+    suc.plan = plan
+  return pre, suc
+
+
+def vocabularies():
+  """the values of the string and color attributes, from the loaded properties."""
+  return {
+    "shapes"    : sorted(properties["shapes"].values()),
+    "materials" : sorted(properties["materials"].values()),
+    "colors"    : [ list(c) for c in properties["colors"] ],
+    "actions"   : ACTIONS,
+  }
+
+
+def fields(n, m, num_steps):
+  """the dtype and shape of each field for n transitions of m blocks."""
+  res = {
+    "shape"     : (np.uint16, (n, m)),
+    "color"     : (np.uint16, (n, m)),
+    "material"  : (np.uint16, (n, m)),
+    "size"      : (np.float64, (n, m)),
+    "rotation"  : (np.float64, (n, m)),
+    "stackable" : (np.bool_, (n, m)),
+    "pre"       : (np.float64, (n, m, 3)),
+    "suc"       : (np.float64, (n, m, 3)),
+    "action"    : (np.uint16, (n,)),
+  }
+  if num_steps > 1:
+    res["plan"] = (np.float64, (n, num_steps-1, m, 3))
+  return res
+
+
+def generate_chunk(args, start, stop):
+  """returns the arrays of the fields of the transitions start, ..., stop-1."""
+  vocab = vocabularies()
+  shape_ids    = { v:i for i, v in enumerate(vocab["shapes"]) }
+  material_ids = { v:i for i, v in enumerate(vocab["materials"]) }
+  color_ids    = { tuple(v):i for i, v in enumerate(vocab["colors"]) }
+  action_ids   = { v:i for i, v in enumerate(vocab["actions"]) }
+
+  res = { k : np.zeros(shape, dtype) for k, (dtype, shape) in fields(stop-start, args.num_objects, args.num_steps).items() }
+  for row, idx in enumerate(range(start, stop)):
+    rng = streams.logic(args.seed, idx)
+    while True:
+      try:
+        pre, suc = sample_transition(args, rng)
+        break
+      except Unstackable as e:
+        pass
+    objects = sorted(pre.objects, key=(lambda o: o.id))
+    res["shape"][row]     = [ shape_ids[o.shape] for o in objects ]
+    res["color"][row]     = [ color_ids[tuple(o.color)] for o in objects ]
+    res["material"][row]  = [ material_ids[o.material] for o in objects ]
+    res["size"][row]      = [ o.size for o in objects ]
+    res["rotation"][row]  = [ o.rotation for o in objects ]
+    res["stackable"][row] = [ o.stackable for o in objects ]
+    res["pre"][row]       = [ o.location for o in objects ]
+    res["suc"][row]       = [ o.location for o in sorted(suc.objects, key=(lambda o: o.id)) ]
+    res["action"][row]    = action_ids[suc.last_action]
+    if "plan" in res:
+      # the plan follows the order of suc.objects
+      order = [ o.id for o in suc.objects ]
+      res["plan"][row][:, order] = suc.plan
+  return res
+
+
+def _generate_chunk(job):
+  return job[1], generate_chunk(*job)
+
+
+def generate(args):
+  """write args.num_transitions transitions from args.start_idx into the directory args.out."""
+  load_colors(args)
+  os.makedirs(args.out, exist_ok=True)
+  n = args.num_transitions
+  outputs = {
+    k : open_memmap(os.path.join(args.out, k+".npy"), mode="w+", dtype=dtype, shape=shape)
+    for k, (dtype, shape) in fields(n, args.num_objects, args.num_steps).items()
+  }
+
+  end = args.start_idx + n
+  jobs = [ (args, start, min(start + args.chunk_size, end))
+           for start in range(args.start_idx, end, args.chunk_size) ]
+  with multiprocessing.Pool(args.jobs, initializer=load_colors, initargs=(args,)) as pool:
+    for start, chunk in pool.imap_unordered(_generate_chunk, jobs):
+      row = start - args.start_idx
+      for k, array in chunk.items():
+        outputs[k][row:row+len(array)] = array
+  for array in outputs.values():
+    array.flush()
+
+  # written last, so that an interrupted run leaves no meta.json
+  meta = dict(vocabularies(),
+              version         = VERSION,
+              start_idx       = args.start_idx,
+              num_transitions = n,
+              num_objects     = args.num_objects,
+              num_steps       = args.num_steps,
+              table_size      = args.table_size,
+              object_jitter   = args.object_jitter,
+              seed            = args.seed)
+  with open(os.path.join(args.out, "meta.json"), "w") as f:
+    json.dump(meta, f, indent=2)
+
+
+class TransitionFile(object):
+  """
+  The transitions written by generate. The fields are memory mapped, and
+  transitions[idx] returns the blocks.State pair (pre, suc) of the transition idx.
+  """
+  def __init__(self, path):
+    with open(os.path.join(path, "meta.json"), "r") as f:
+      self.meta = json.load(f)
+    if self.meta["version"] > VERSION:
+      raise ValueError("transition file version {} is newer than the supported version {}"
+                       .format(self.meta["version"], VERSION))
+    self.start_idx = self.meta["start_idx"]
+    self.fields = {
+      k : np.load(os.path.join(path, k+".npy"), mmap_mode="r")
+      for k in fields(0, 0, self.meta["num_steps"])
+    }
+
+  def __len__(self):
+    return self.meta["num_transitions"]
+
+  def __contains__(self, idx):
+    return self.start_idx <= idx < self.start_idx + len(self)
+
+  def __getitem__(self, idx):
+    if idx not in self:
+      raise IndexError("transition {} is not in the file".format(idx))
+    row = idx - self.start_idx
+    f = self.fields
+    meta = self.meta
+    objects = {
+      "id"        : list(range(meta["num_objects"])),
+      "shape"     : [ meta["shapes"][i] for i in f["shape"][row].tolist() ],
+      "color"     : [ meta["colors"][i] for i in f["color"][row].tolist() ],
+      "size"      : f["size"][row].tolist(),
+      "material"  : [ meta["materials"][i] for i in f["material"][row].tolist() ],
+      "rotation"  : f["rotation"][row].tolist(),
+      "stackable" : f["stackable"][row].tolist(),
+    }
+    def state(location, **kwargs):
+      return state_codec.decode(dict(kwargs,
+                                     version       = state_codec.VERSION,
+                                     table_size    = meta["table_size"],
+                                     object_jitter = meta["object_jitter"],
+                                     objects       = dict(objects, location=location)))
+    pre = state(f["pre"][row].tolist())
+    suc = state(f["suc"][row].tolist(), last_action=meta["actions"][int(f["action"][row])])
+    if "plan" in f:
+      suc.plan = f["plan"][row].tolist()
+    return pre, suc
+
+
+parser = argparse.ArgumentParser(description="Generate logical transitions without rendering them.")
+blocks.initialize_parser_input_options(parser)
+blocks.initialize_parser_environment_options(parser)
+parser.add_argument('--start-idx', default=0, type=int,
+                    help="The index of the first transition.")
+parser.add_argument('--num-transitions', default=100, type=int,
+                    help="The number of transitions to generate")
+parser.add_argument('--num-steps', default=1, type=int,
+                    help="The number of steps to perform from the source state")
+parser.add_argument('--seed', default=0, type=int,
+                    help="The seed of the run. Each transition is generated from the logic stream of the seed and its index.")
+parser.add_argument('--jobs', default=os.cpu_count(), type=int,
+                    help="The number of processes.")
+parser.add_argument('--chunk-size', default=1000, type=int,
+                    help="The number of transitions generated by a process at a time.")
+parser.add_argument('--out', default='transitions',
+                    help="The directory to write the transitions to.")
+
+
+if __name__ == '__main__':
+  generate(parser.parse_args())
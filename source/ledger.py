@@ -0,0 +1,114 @@
+"""
+A durable record of the work finished in an output directory.
+
+The ledger is a small sqlite database (ledger.sqlite) in the output directory,
+shared by all the workers rendering into that directory. A worker claims a
+transition before rendering it; the claim is a lease that expires after a
+while, so that the transitions claimed by a crashed worker are claimed again
+by the next worker that asks for them. render_images.py also releases its
+claim when it is interrupted, and drops the claims of the dead processes of
+its host when it starts. Finished frames and transitions are recorded as they
+complete, so resuming a job only needs a few queries instead of checking the
+files of every frame.
+"""
+
+import os, socket, sqlite3, time
+
+
+class Ledger(object):
+  def __init__(self, output_dir, worker=None, lease=3600.0, name="ledger.sqlite"):
+    os.makedirs(output_dir, exist_ok=True)
+    if worker is None:
+      worker = "{}:{}".format(socket.gethostname(), os.getpid())
+    self.worker = worker
+    self.lease = lease
+    # autocommit mode; transactions are opened explicitly where needed
+    self.db = sqlite3.connect(os.path.join(output_dir, name),
+                              timeout=60, isolation_level=None)
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("""CREATE TABLE IF NOT EXISTS transitions (
+                         idx     INTEGER PRIMARY KEY,
+                         status  TEXT NOT NULL,
+                         worker  TEXT,
+                         expires REAL)""")
+    self.db.execute("""CREATE TABLE IF NOT EXISTS frames (
+                         idx   INTEGER NOT NULL,
+                         frame INTEGER NOT NULL,
+                         PRIMARY KEY (idx, frame))""")
+
+  def claim(self, idx):
+    """
+    Claim the transition idx for this worker. Returns False when the transition
+    is already finished, or is claimed by another worker whose lease has not expired.
+    """
+    now = time.time()
+    self.db.execute("BEGIN IMMEDIATE")
+    try:
+      row = self.db.execute("SELECT status, worker, expires FROM transitions WHERE idx = ?",
+                            (idx,)).fetchone()
+      if row is not None:
+        status, worker, expires = row
+        if status == "done":
+          return False
+        if worker != self.worker and expires > now:
+          return False
+      self.db.execute("INSERT OR REPLACE INTO transitions VALUES (?, 'claimed', ?, ?)",
+                      (idx, self.worker, now + self.lease))
+      return True
+    finally:
+      self.db.execute("COMMIT")
+
+  def renew(self, idx):
+    """Extend the lease of a transition claimed by this worker."""
+    self.db.execute("UPDATE transitions SET expires = ? WHERE idx = ? AND worker = ? AND status = 'claimed'",
+                    (time.time() + self.lease, idx, self.worker))
+
+  def release(self, idx):
+    """Give up the claim on a transition so that other workers can take it immediately."""
+    self.db.execute("DELETE FROM transitions WHERE idx = ? AND worker = ? AND status = 'claimed'",
+                    (idx, self.worker))
+
+  def frame_done(self, idx, frame):
+    """Record that a frame of a transition is written, and renew the lease."""
+    self.db.execute("BEGIN IMMEDIATE")
+    try:
+      self.db.execute("INSERT OR IGNORE INTO frames VALUES (?, ?)", (idx, frame))
+      self.db.execute("UPDATE transitions SET expires = ? WHERE idx = ? AND worker = ? AND status = 'claimed'",
+                      (time.time() + self.lease, idx, self.worker))
+    finally:
+      self.db.execute("COMMIT")
+
+  def done_frames(self, idx):
+    """Returns the set of the frames of a transition that are already written."""
+    return { frame for frame, in self.db.execute("SELECT frame FROM frames WHERE idx = ?", (idx,)) }
+
+  def finish(self, idx):
+    """Record that all frames of a transition are written."""
+    self.db.execute("INSERT OR REPLACE INTO transitions VALUES (?, 'done', ?, NULL)",
+                    (idx, self.worker))
+
+  def done(self):
+    """Returns the set of the finished transitions."""
+    return { idx for idx, in self.db.execute("SELECT idx FROM transitions WHERE status = 'done'") }
+
+  def release_all(self):
+    """Drop all unfinished claims, e.g. when no worker is running on this directory."""
+    self.db.execute("DELETE FROM transitions WHERE status = 'claimed'")
+
+  def release_dead(self):
+    """Drop the unfinished claims of the workers of this host whose process is no longer running."""
+    host = socket.gethostname()
+    for worker, in self.db.execute("SELECT DISTINCT worker FROM transitions WHERE status = 'claimed'").fetchall():
+      name, _, pid = worker.rpartition(":")
+      if name != host or not pid.isdigit() or worker == self.worker:
+        continue
+      try:
+        os.kill(int(pid), 0)
+      except ProcessLookupError:
+        self.db.execute("DELETE FROM transitions WHERE worker = ? AND status = 'claimed'", (worker,))
+      except PermissionError:
+        # running, as another user
+        pass
+
+  def close(self):
+    self.db.close()
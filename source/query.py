@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+
+"""
+Selecting frames and transitions of a rendered dataset with conjunctive queries.
+
+QueryIndex builds an inverted index from the annotation store: for each fact,
+the sorted rows of the frames where it holds. The facts are
+
+  on(i,j) on(i,table) clear(i)     the relations of the scene, by object index
+  shape(i,v) color(i,v) material(i,v)
+                                   the attributes, v as in the store, e.g.
+                                   SmoothCylinder, or its name in --properties-json,
+                                   e.g. cylinder. Colors are hex, e.g. ff0000.
+
+plus the tallest tower of each frame, height. A query is a conjunction of atoms,
+e.g.
+
+  height>=3
+  clear(2) !on(2,table)
+  on(X,Y) shape(X,cylinder) shape(Y,cube)
+
+where the arguments starting with an uppercase letter are variables over the
+objects (not the table; distinct variables take distinct objects; the values of
+the attributes are not variables, e.g. SmoothCylinder), and ! negates an atom.
+The variables are bound from the facts of the positive atoms; a negated atom
+holds when no value of its other variables makes it true, e.g. !on(X,2) is
+clear(2). Atoms prefixed
+with pre. or suc. hold in the first or the last frame of a transition, and make
+the query select transitions instead of frames (the other atoms then hold in
+the first frame), e.g. the transitions moving a cylinder onto a cube:
+
+  !pre.on(X,Y) suc.on(X,Y) shape(X,cylinder) shape(Y,cube)
+
+The index is cached in annotation_store/index.npz.
+
+  python source/query.py --output-dir output "on(X,Y) shape(X,cylinder)" --export files
+"""
+
+import argparse, json, os, re
+import numpy as np
+import annotation_store
+import shards
+
+ATOM = re.compile(r"\s*(?:(!|not\s+)?(?:(pre|suc)\.)?(\w+)\(([^()]*)\)"
+                  r"|(?:(pre|suc)\.)?height\s*(>=|<=|==|=|>|<)\s*(\d+))\s*")
+
+ATTRIBUTES = ("shape", "color", "material")
+
+COMPARE = {
+  ">=" : np.greater_equal,
+  "<=" : np.less_equal,
+  "==" : np.equal,
+  "="  : np.equal,
+  ">"  : np.greater,
+  "<"  : np.less,
+}
+
+
+def color_name(rgba):
+  return "".join("{:02x}".format(int(round(c * 255))) for c in rgba[:3])
+
+
+def parse(text):
+  """returns the list of atoms of a query, as (negated, scope, name, args) or (False, scope, "height", (op, value))"""
+  atoms = []
+  pos = 0
+  while pos < len(text):
+    m = ATOM.match(text, pos)
+    if m is None or m.end() == pos:
+      raise ValueError("cannot parse the query at: {}".format(text[pos:]))
+    neg, scope, name, args, hscope, op, value = m.groups()
+    if name is not None:
+      atoms.append((bool(neg), scope, name, tuple(a.strip() for a in args.split(","))))
+    else:
+      atoms.append((False, hscope, "height", (op, int(value))))
+    pos = m.end()
+  return atoms
+
+
+def is_variable(arg):
+  return arg[:1].isupper()
+
+
+def variables(name, args):
+  """the variables of an atom; the value of an attribute is not one, e.g. SmoothCylinder"""
+  if name == "height":
+    return set()
+  if name in ATTRIBUTES:
+    args = args[:-1]
+  return { a for a in args if is_variable(a) }
+
+
+def bind(args, fact, binding, names):
+  """binding extended so that args match the arguments of a fact, or None; the variables in names take distinct objects"""
+  if len(args) != len(fact):
+    return None
+  res = dict(binding)
+  for a, v in zip(args, fact):
+    if a not in names:
+      if a != v:
+        return None
+    elif a in res:
+      if res[a] != v:
+        return None
+    elif not v.isdigit() or v in res.values():
+      return None
+    else:
+      res[a] = v
+  return res
+
+
+class QueryIndex(object):
+  def __init__(self, store, properties=None):
+    self.store = store
+    self.aliases = {}
+    self._facts = None
+    if properties is not None:
+      for kind in ("shapes", "materials"):
+        self.aliases.update(properties.get(kind, {}))
+      for i, rgb in enumerate(properties.get("colors", [])):
+        self.aliases[str(i)] = "".join("{:02x}".format(c) for c in rgb)
+    path = os.path.join(store.output_dir, annotation_store.STORE, "index.npz")
+    meta = os.path.join(store.output_dir, annotation_store.STORE, "meta.json")
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(meta):
+      self._load(path)
+    else:
+      self._build()
+      self._save(path)
+    # the first and the last row of each transition
+    starts = np.flatnonzero(np.diff(store.transition, prepend=-1) != 0)
+    self.transitions = np.asarray(store.transition[starts])
+    self.first = starts
+    self.last = np.append(starts[1:], len(store)) - 1
+
+  def _build(self):
+    store = self.store
+    n, o = store.bbox.shape[:2]
+    objects = np.arange(o)
+    table = np.asarray(store.num_related, dtype=np.int64)
+    valid = objects[None, :] < table[:, None]
+    postings = {}
+    def add(key, mask):
+      rows = np.flatnonzero(mask).astype(np.int32)
+      if len(rows):
+        postings[key] = rows
+
+    for name in store.meta["relations"]:
+      bits = np.asarray(store.relation(name))
+      for i in range(o):
+        add("{}({})".format(name, i), valid[:, i] & (bits[:, i] != 0))
+        for j in range(o):
+          add("{}({},{})".format(name, i, j), valid[:, i] & (j < table) & ((bits[:, i] >> np.uint64(j)) & np.uint64(1) == 1))
+        add("{}({},table)".format(name, i), valid[:, i] & ((bits[:, i] >> table.astype(np.uint64)) & np.uint64(1) == 1))
+
+    for field, vocab in (("shape", store.meta["shapes"]),
+                         ("material", store.meta["materials"]),
+                         ("color", [ color_name(c) for c in store.meta["colors"] ])):
+      column = np.asarray(getattr(store, field))
+      for i in range(o):
+        for v in np.unique(column[valid[:, i], i]):
+          add("{}({},{})".format(field, i, vocab[v]), valid[:, i] & (column[:, i] == v))
+
+    # the height of each object is 1 + the height of the object below it; O passes settle the towers
+    on = (np.asarray(store.rel_on)[:, :, None] >> objects.astype(np.uint64)[None, None, :]) & np.uint64(1) == 1
+    on &= (objects[None, None, :] < table[:, None, None])
+    heights = valid.astype(np.int64)
+    for _ in range(o):
+      below = np.where(on, heights[:, None, :], 0).max(axis=2)
+      heights = np.where(valid, below + 1, 0)
+    self.postings = postings
+    self.height = heights.max(axis=1)
+
+  def _save(self, path):
+    keys = sorted(self.postings)
+    lengths = [ len(self.postings[k]) for k in keys ]
+    tmp = path + ".tmp.npz"
+    np.savez(tmp,
+             keys=np.array(json.dumps(keys)),
+             offsets=np.cumsum([0] + lengths),
+             rows=np.concatenate([ self.postings[k] for k in keys ]) if keys else np.zeros(0, dtype=np.int32),
+             height=self.height)
+    os.replace(tmp, path)
+
+  def _load(self, path):
+    with np.load(path) as data:
+      keys = json.loads(str(data["keys"]))
+      offsets, rows = data["offsets"], data["rows"]
+      self.height = data["height"]
+    self.postings = { k : rows[offsets[i]:offsets[i+1]] for i, k in enumerate(keys) }
+
+  def rows(self, name, args):
+    """the rows where the fact name(args) holds"""
+    return self.postings.get("{}({})".format(name, ",".join(args)), np.zeros(0, dtype=np.int32))
+
+  def facts(self, name):
+    """[(args, rows)] of the facts name(args) in the index"""
+    if self._facts is None:
+      self._facts = {}
+      for key, rows in self.postings.items():
+        fact, args = key[:-1].split("(", 1)
+        self._facts.setdefault(fact, []).append((tuple(args.split(",")), rows))
+    return self._facts.get(name, [])
+
+  def query(self, text):
+    """
+    Returns ("frame", rows of the store) or ("transition", transition indices)
+    of the frames or transitions where the query holds.
+    """
+    atoms = parse(text)
+    transitions = any(scope is not None for _, scope, _, _ in atoms)
+    if transitions:
+      universe = self.transitions
+    else:
+      universe = np.arange(len(self.store))
+
+    def units(rows, scope):
+      # rows -> the selected units: rows themselves, or the transitions whose first / last frame is in rows
+      if not transitions:
+        return rows
+      ends = self.last if scope == "suc" else self.first
+      return self.transitions[np.isin(ends, rows, assume_unique=True)]
+
+    def rows(name, args):
+      if name == "height":
+        op, value = args
+        return np.flatnonzero(COMPARE[op](self.height, value))
+      return self.rows(name, args)
+
+    def restrict(selected, neg, scope, rows):
+      if neg:
+        return np.setdiff1d(selected, units(rows, scope), assume_unique=True)
+      return np.intersect1d(selected, units(rows, scope), assume_unique=True)
+
+    # the atoms without variables hold for all bindings and are evaluated once
+    selected = universe
+    positive, negative = [], []
+    for neg, scope, name, args in sorted(atoms, key=lambda atom: atom[0]):
+      if name in ATTRIBUTES:
+        args = args[:-1] + (self.aliases.get(args[-1], args[-1]),)
+      if variables(name, args):
+        (negative if neg else positive).append((scope, name, args))
+      else:
+        selected = restrict(selected, neg, scope, rows(name, args))
+
+    # bind the variables from the facts of the positive atoms, one atom at a time,
+    # keeping the bindings that still select something
+    bindings = [ ({}, selected) ] if len(selected) else []
+    for scope, name, args in positive:
+      joined = []
+      for binding, selected in bindings:
+        for fact, rows_ in self.facts(name):
+          extended = bind(args, fact, binding, variables(name, args))
+          if extended is not None:
+            selected_ = np.intersect1d(selected, units(rows_, scope), assume_unique=True)
+            if len(selected_):
+              joined.append((extended, selected_))
+      bindings = joined
+
+    # a negative atom removes the units where it holds for some value of its variables that
+    # are not bound by the positive atoms (negation as failure): !on(X,2) alone is clear(2)
+    res = []
+    for binding, selected in bindings:
+      for scope, name, args in negative:
+        names = variables(name, args)
+        matches = [ rows_ for fact, rows_ in self.facts(name) if bind(args, fact, binding, names) is not None ]
+        if matches:
+          selected = restrict(selected, True, scope, np.unique(np.concatenate(matches)))
+        if not len(selected):
+          break
+      res.append(selected)
+    # no binding selects nothing, e.g. when no frame has objects
+    ids = np.unique(np.concatenate(res)) if res else universe[:0]
+    return ("transition" if transitions else "frame"), ids
+
+  def select(self, text):
+    """the rows of the store of the frames where the query holds, or of the frames of the transitions where it holds."""
+    kind, ids = self.query(text)
+    if kind == "frame":
+      return ids
+    where = np.searchsorted(self.transitions, ids)
+    return np.concatenate([ np.arange(self.first[w], self.last[w] + 1) for w in where ] or [np.zeros(0, dtype=np.int64)])
+
+  def members(self, rows):
+    """the names of the files of the rows, relative to the output directory, including the base records of the deltas"""
+    res = []
+    bases = set()
+    for k in rows:
+      i, j = int(self.store.transition[k]), int(self.store.frame[k])
+      scene = shards.scene_name(i, j)
+      base = os.path.join(os.path.dirname(scene), "CLEVR_annotation_---.json")
+      if i not in bases:
+        bases.add(i)
+        res.append(base)
+      res.extend([shards.image_name(i, j), scene])
+    return res
+
+  def files(self, rows):
+    """the paths of the files of the rows that exist in the output directory"""
+    paths = ( os.path.join(self.store.output_dir, name) for name in self.members(rows) )
+    return [ p for p in paths if os.path.exists(p) ]
+
+  def shard_offsets(self, rows):
+    """(shard, offset, size, name) of the files of the rows that are in the shards"""
+    reader = shards.ShardReader(self.store.output_dir)
+    return [ (*reader.members[name], name) for name in self.members(rows) if name in reader ]
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Select the frames or transitions of a dataset with a conjunctive query.")
+  parser.add_argument('query',
+                      help="The query, e.g. \"on(X,Y) shape(X,cylinder) height>=3\"." +
+                      " See the docstring of query.py for the syntax.")
+  parser.add_argument('--output-dir', default='output')
+  parser.add_argument('--properties-json', default=None,
+                      help="The properties of the dataset, to name the shapes and materials as in the file," +
+                      " and the colors by their index.")
+  parser.add_argument('--export', default="ids", choices=["ids", "frames", "files", "shards", "count"],
+                      help="ids: the selected frames (transition, frame) or transitions." +
+                      " frames: the frames, also of the selected transitions." +
+                      " files: the paths of their files." +
+                      " shards: the shard, offset, size and name of their files in the shards." +
+                      " count: the number of selected frames or transitions.")
+  args = parser.parse_args()
+
+  properties = None
+  if args.properties_json is not None:
+    with open(args.properties_json, "r") as f:
+      properties = json.load(f)
+  index = QueryIndex(annotation_store.open_store(args.output_dir), properties)
+
+  if args.export in ("ids", "count"):
+    kind, ids = index.query(args.query)
+    if args.export == "count":
+      print(len(ids), kind + "s")
+    elif kind == "transition":
+      for i in ids:
+        print(i)
+    else:
+      for k in ids:
+        print("{}\t{}".format(index.store.transition[k], index.store.frame[k]))
+  else:
+    rows = index.select(args.query)
+    if args.export == "frames":
+      for k in rows:
+        print("{}\t{}".format(index.store.transition[k], index.store.frame[k]))
+    elif args.export == "files":
+      for p in index.files(rows):
+        print(p)
+    else:
+      for shard, offset, size, name in index.shard_offsets(rows):
+        print("{}\t{}\t{}\t{}".format(os.path.basename(shard), offset, size, name))
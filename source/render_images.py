@@ -14,12 +14,22 @@ try:
   from mathutils import Vector
 except ImportError as e:
   INSIDE_BLENDER = False
+# blocks and ledger do not need blender; they are needed for the argument parser
+# and for --annotations-only
+import blocks
+from blocks import State, Unstackable, load_colors
+from ledger import Ledger
+import trajectory
+import dedup as dedup_module
+from generate_transitions import sample_transition, TransitionFile
+import streams
+from async_writer import AsyncWriter
+from shards import ShardWriter
+from render_utils import pass_paths, AnnotationTracker
 if INSIDE_BLENDER:
   try:
     import utils
-    import blocks
-    from blocks import State, Unstackable, load_colors
-    from render_utils import render_scene
+    from render_utils import render_scene, render_trajectory
   except ImportError as e:
     print("\nERROR")
     print("Running render_images.py from Blender and cannot import utils.py.")
@@ -50,11 +60,81 @@ def initialize_parser():
   parser.add_argument('--num-transitions', default=100, type=int,
                       help="The number of transitions to render")
 
+  parser.add_argument('--work-queue', default=None,
+                      help="The address host:port of a queue served by render_pool.py. When given, " +
+                      "the indices of the transitions are taken from the queue until it is exhausted, " +
+                      "and --start-idx and --num-transitions are ignored.")
+
+  parser.add_argument('--lease', default=3600.0, type=float,
+                      help="The number of seconds a worker may hold a transition without finishing a frame. " +
+                      "After that, the transition is considered abandoned and is claimed by other workers.")
+
+  parser.add_argument('--reclaim', action="store_true",
+                      help="Drop the claims of all unfinished transitions, e.g. those left by a previous run that was killed, " +
+                      "instead of waiting for their leases to expire. Do not use it while other workers render into the same directory. " +
+                      "Without it, the claims of the processes of this host that are no longer running are dropped.")
+
   parser.add_argument('--num-samples-per-state', default=3, type=int,
                       help="The number of images to render per logical states")
 
   parser.add_argument('--num-steps', default=1, type=int,
-                      help="The number of steps to perform from the source state")
+                      help="The number of steps to perform from the source state. The frames are spread evenly " +
+                      "over the steps, from the source to the final state, and each step lifts, carries and places the objects it moves.")
+
+  parser.add_argument('--easing', default='linear', choices=sorted(trajectory.EASINGS),
+                      help="The easing curve of the lift, carry and place phases of a move.")
+
+  parser.add_argument('--annotations-only', action="store_true",
+                      help="Only write the scene annotations, without rendering the images. " +
+                      "The pixel coordinates and the bounding boxes are computed from the camera " +
+                      "exported to --camera-json. This mode runs without blender: " +
+                      "python render_images.py --annotations-only [args]")
+
+  parser.add_argument('--camera-json', default='data/camera.json',
+                      help="The camera parameters and shape dimensions exported by camera.py, used by --annotations-only.")
+
+  parser.add_argument('--transitions-file', default=None,
+                      help="A directory written by generate_transitions.py. The states of each transition " +
+                      "are read from it instead of being sampled; it must contain the transitions to render.")
+
+  parser.add_argument('--seed', default=0, type=int,
+                      help="The seed of the run. The states, the wiggle and the light and camera jitter " +
+                      "of each transition and frame are drawn from random streams derived from the seed and the index " +
+                      "of the transition and the frame, so that any frame can be rendered again alone with the same result. " +
+                      "Defaults to 0, as in generate_transitions.py; use another seed for another dataset.")
+
+  parser.add_argument('--dedup', action="store_true",
+                      help="Reject the sampled transitions whose logical (pre, suc) pair was already " +
+                      "generated in the output directory. The keys are kept in dedup.sqlite in the output directory.")
+
+  parser.add_argument('--dedup-retries', default=100, type=int,
+                      help="With --dedup, the number of times a duplicate transition is sampled again " +
+                      "before keeping it anyway, e.g. when the state space is nearly exhausted.")
+
+  parser.add_argument('--annotation-deltas', action="store_true",
+                      help="Store the scene JSON of each frame as a delta against the first scene written " +
+                      "for its transition (CLEVR_annotation_---.json). Read them with deltas.load_scene.")
+
+  parser.add_argument('--async-writer', action="store_true",
+                      help="Write the images and the scene JSON in a background thread while the next frame is " +
+                      "rendered. The images are read from a compositor Viewer node and encoded as PNG with the " +
+                      "Standard view transform (without dithering); the scene must use it, with no look, exposure, " +
+                      "gamma or curves, or rendering stops with an error. " +
+                      "The time spent waiting for the writer is printed at the end.")
+
+  parser.add_argument('--writer-queue-size', default=8, type=int,
+                      help="With --async-writer, the number of pending writes after which rendering waits for the writer.")
+
+  parser.add_argument('--fsync', action="store_true",
+                      help="With --async-writer, fsync each file before it is renamed to its final name.")
+
+  parser.add_argument('--output-format', default='files', choices=['files', 'shards'],
+                      help="With shards, the files of each frame are moved into tar shards in the output directory " +
+                      "once they are written, and the base scenes once the transition is finished. " +
+                      "Read them with shards.ShardReader.")
+
+  parser.add_argument('--shard-size', default=1024, type=int,
+                      help="With --output-format shards, the size in MB after which a new shard is started.")
 
   # Rendering options
   blocks.initialize_parser_rendering_options(parser)
@@ -75,226 +155,290 @@ def path(dir,i,name,j,ext):
     i = "{:06d}".format(i)
   if isinstance(j, int):
     j = "{:03d}".format(j)
+  return os.path.join(args.output_dir,dir,i,"_".join(["CLEVR",name,j])+"."+ext)
+
+
+def make_transition_dirs(i):
+  i = "{:06d}".format(i)
   os.makedirs(os.path.join(args.output_dir,"image_tr",i), exist_ok=True)
   os.makedirs(os.path.join(args.output_dir,"scene_tr",i), exist_ok=True)
-  return os.path.join(args.output_dir,dir,i,"_".join(["CLEVR",name,j])+"."+ext)
+
+
+def transition_indices(args):
+  """Yields the indices of the transitions to render."""
+  if args.work_queue is None:
+    yield from range(args.start_idx,
+                     args.start_idx+args.num_transitions)
+  else:
+    import render_pool
+    queue = render_pool.connect(args.work_queue)
+    while True:
+      i = queue.get()
+      if i is None:
+        return
+      yield i
+
+
+def frame_paths(i, j):
+  """the files of the frame j of the transition i."""
+  image = path("image_tr",i,"image",j,"png")
+  return [ image,
+           path("scene_tr",i,"annotation",j,"json"),
+           *pass_paths(image) ]
+
+
+def record_frame(ledger, shards, i, j):
+  """record the frame j of the transition i in the ledger, after moving its files into the shards."""
+  if shards is not None:
+    for p in frame_paths(i, j):
+      if os.path.exists(p):
+        shards.add_file(p, remove=True)
+    shards.flush()
+  ledger.frame_done(i, j)
+
+
+def frame_written(ledger, writer, shards, i, j):
+  """record the frame j of the transition i, once its files are written."""
+  # the frames queued in the writer are recorded later; the lease is renewed as each frame is rendered
+  ledger.renew(i)
+  if writer is None:
+    record_frame(ledger, shards, i, j)
+    return
+  writer.mark((i, j))
+  for tag in writer.poll():
+    record_frame(ledger, shards, *tag)
+
+
+def transition_written(ledger, writer, shards, i):
+  """record the transition i in the ledger, once the files of all its frames are written."""
+  if writer is not None:
+    for tag in writer.flush():
+      record_frame(ledger, shards, *tag)
+  if shards is not None:
+    # the remaining files, e.g. the base scenes
+    for top in ["image_tr", "scene_tr"]:
+      directory = os.path.join(args.output_dir, top, "{:06d}".format(i))
+      for name in sorted(os.listdir(directory)):
+        shards.add_file(os.path.join(directory, name), remove=True)
+      os.rmdir(directory)
+    shards.flush()
+  ledger.finish(i)
 
 
 def main(args):
-  import copy
   load_colors(args)
 
   os.makedirs(os.path.join(args.output_dir,"image_tr"), exist_ok=True)
   os.makedirs(os.path.join(args.output_dir,"scene_tr"), exist_ok=True)
 
-  print("rendering images")
-  for i in range(args.start_idx,
-                 args.start_idx+args.num_transitions):
+  if args.annotations_only:
+    # the frames in the ledger of the rendered dataset must not be marked done
+    ledger = Ledger(args.output_dir, lease=args.lease, name="ledger-annotations.sqlite")
+    from camera import Camera
+    from annotations import annotate_scene
+    camera = Camera.load(args.camera_json)
+  else:
+    ledger = Ledger(args.output_dir, lease=args.lease)
+  if args.reclaim:
+    ledger.release_all()
+  else:
+    ledger.release_dead()
 
-    while True:
-      try:
-        # by default, save the noiseless states into json.
-        # if we want to extend the number of samples, load these fils and performs a wiggle.
-        if os.path.exists(path("scene_tr",i,"pre","---","json")):
-          assert os.path.exists(path("scene_tr",i,"suc","---","json"))
-          print("base scene available; loading scene")
-          with open(path("scene_tr",i,"pre","---","json"),"r") as f:
-            pre = State.undump(json.load(f))
-          with open(path("scene_tr",i,"suc","---","json"),"r") as f:
-            suc = State.undump(json.load(f))
-        else:
-          assert not os.path.exists(path("scene_tr",i,"suc","---","json"))
-          print("base scene not found; creating a new scene")
-          pre = State(args)
-          suc = copy.deepcopy(pre)
-          for j in range(args.num_steps):
-            suc.random_action()
-
-          with open(path("scene_tr",i,"pre","---","json"),"w") as f:
-            json.dump(pre.dump(),f,indent=2)
-            f.truncate()
-          with open(path("scene_tr",i,"suc","---","json"),"w") as f:
-            json.dump(suc.dump(),f,indent=2)
-            f.truncate()
-          # print("dump success: ", json.dumps(pre.dump(),indent=2))
-          # print("loading")
-          # with open(path("scene_tr",i,"pre","---","json"),"r") as f:
-          #   pre2 = State.undump(json.load(f))
-          # with open(path("scene_tr",i,"suc","---","json"),"r") as f:
-          #   suc2 = State.undump(json.load(f))
-          # print("loaded data: ", json.dumps(pre.dump(),indent=2))
-          #
-          # 1/0
-
-
-        # --------------   OLD VERSION -----------------
-        '''
-        for j in range(args.num_samples_per_state):
-          if os.path.exists(path("image_tr",i,"pre",j,"png")):
-            continue
-          state = copy.deepcopy(pre)
-          state.wiggle()
-          render_scene(args,
-                       output_image = path("image_tr",i,"pre",j,"png"),
-                       output_scene = path("scene_tr",i,"pre",j,"json"),
-                       objects      = state.for_rendering())
-
-        for j in range(args.num_samples_per_state):
-          if os.path.exists(path("image_tr",i,"suc",j,"png")):
-            continue
-          state = copy.deepcopy(suc)
-          state.wiggle()
-          render_scene(args,
-                       output_image = path("image_tr",i,"suc",j,"png"),
-                       output_scene = path("scene_tr",i,"suc",j,"json"),
-                       objects      = state.for_rendering(),
-                       action       = state.last_action)
-        '''
-        # --------------   OLD VERSION -----------------
-
-        # get tallest thing:
-        y_max = 0
-        size_max = 0
-        for state in [pre, suc]:
-          for o_id, object in enumerate(state.objects):
-            position = object.location # [x, z, y]
-            size = object.size
-            y_max = max(y_max, position[2])
-            size_max = max(size_max, size)
-        y_operate_level = y_max+4*size_max
-
-
-
-        # render frames
-        WIGGLE_BETWEEN_IMAGES = True
-        state_sequence = compute_trajectory(pre, suc, args.num_samples_per_state, y_operate_level)
-
-        for j, state in enumerate(state_sequence):
-          if os.path.exists(path("image_tr",i,"pre",j,"png")):
-            continue
-          if WIGGLE_BETWEEN_IMAGES:
+  dedup = dedup_module.DedupIndex(args.output_dir) if args.dedup else None
+  transitions = TransitionFile(args.transitions_file) if args.transitions_file else None
+  writer = AsyncWriter(args.writer_queue_size, fsync=args.fsync) if args.async_writer else None
+  shards = ShardWriter(args.output_dir, args.shard_size << 20) if args.output_format == "shards" else None
+
+  print("rendering images")
+  current = None
+  try:
+    for i in transition_indices(args):
+      if not ledger.claim(i):
+        print("transition {} is finished or claimed by another worker; skipping".format(i))
+        continue
+      current = i
+      make_transition_dirs(i)
+      done_frames = ledger.done_frames(i)
+      logic_rng = streams.logic(args.seed, i)
+
+      while True:
+        try:
+          # by default, save the noiseless states into json.
+          # if we want to extend the number of samples, load these fils and performs a wiggle.
+          if os.path.exists(path("scene_tr",i,"pre","---","json")):
+            assert os.path.exists(path("scene_tr",i,"suc","---","json"))
+            print("base scene available; loading scene")
+            with open(path("scene_tr",i,"pre","---","json"),"r") as f:
+              pre = State.undump(json.load(f))
+            with open(path("scene_tr",i,"suc","---","json"),"r") as f:
+              suc = State.undump(json.load(f))
+          else:
+            assert not os.path.exists(path("scene_tr",i,"suc","---","json"))
+            print("base scene not found; creating a new scene")
+            if transitions is not None:
+              pre, suc = transitions[i]
+            elif dedup is None:
+              pre, suc = sample_transition(args, logic_rng)
+            else:
+              # a key left by an interrupted attempt on this transition
+              dedup.forget(i)
+              for retry in range(args.dedup_retries+1):
+                pre, suc = sample_transition(args, logic_rng)
+                if dedup.add(dedup_module.transition_key(pre, suc), i):
+                  break
+                print("duplicate transition; sampling again")
+              else:
+                print("no new transition after {} retries; keeping a duplicate".format(args.dedup_retries))
+
+            with open(path("scene_tr",i,"pre","---","json"),"w") as f:
+              json.dump(pre.dump(),f,separators=(",",":"))
+            with open(path("scene_tr",i,"suc","---","json"),"w") as f:
+              json.dump(suc.dump(),f,separators=(",",":"))
+            # print("dump success: ", json.dumps(pre.dump(),indent=2))
+            # print("loading")
+            # with open(path("scene_tr",i,"pre","---","json"),"r") as f:
+            #   pre2 = State.undump(json.load(f))
+            # with open(path("scene_tr",i,"suc","---","json"),"r") as f:
+            #   suc2 = State.undump(json.load(f))
+            # print("loaded data: ", json.dumps(pre.dump(),indent=2))
+            #
+            # 1/0
+
+
+          # --------------   OLD VERSION -----------------
+          '''
+          for j in range(args.num_samples_per_state):
+            if os.path.exists(path("image_tr",i,"pre",j,"png")):
+              continue
+            state = copy.deepcopy(pre)
+            state.wiggle()
+            render_scene(args,
+                         output_image = path("image_tr",i,"pre",j,"png"),
+                         output_scene = path("scene_tr",i,"pre",j,"json"),
+                         objects      = state.for_rendering())
+
+          for j in range(args.num_samples_per_state):
+            if os.path.exists(path("image_tr",i,"suc",j,"png")):
+              continue
+            state = copy.deepcopy(suc)
             state.wiggle()
-          render_scene(args,
-                       output_image = path("image_tr",i,"image",j,"png"),
-                       output_scene = path("scene_tr",i,"annotation",j,"json"),
-                       objects      = state.for_rendering())
-
-        """
-        for j in range(args.num_samples_per_state):
-          if os.path.exists(path("image_tr",i,"suc",j,"png")):
-            continue
-          state = copy.deepcopy(suc)
-          state.wiggle()
-          render_scene(args,
-                       output_image = path("image_tr",i,"suc",j,"png"),
-                       output_scene = path("scene_tr",i,"suc",j,"json"),
-                       objects      = state.for_rendering(),
-                       action       = state.last_action)
-        """
+            render_scene(args,
+                         output_image = path("image_tr",i,"suc",j,"png"),
+                         output_scene = path("scene_tr",i,"suc",j,"json"),
+                         objects      = state.for_rendering(),
+                         action       = state.last_action)
+          '''
+          # --------------   OLD VERSION -----------------
+
+          # the positions of all frames, lifted and carried above the tallest thing
+          keyframes = [ pre.positions(), *getattr(suc, "plan", []), suc.positions() ]
+          y_operate_level = trajectory.operate_level(keyframes, [ o.size for o in pre.objects ])
+
+          # render frames
+          WIGGLE_BETWEEN_IMAGES = True
+          state_sequence = [ pre.view(positions)
+                             for positions in trajectory.plan(keyframes, args.num_samples_per_state,
+                                                              y_operate_level, easing=args.easing) ]
+
+          if args.annotation_deltas:
+            base_scene = path("scene_tr",i,"annotation","---","json")
+          else:
+            base_scene = None
+
+          if args.annotations_only:
+            tracker = AnnotationTracker(args)
+            for j, state in enumerate(state_sequence):
+              if j in done_frames:
+                continue
+              rngs = streams.frame(args.seed, i, j)
+              if WIGGLE_BETWEEN_IMAGES:
+                state.wiggle(rngs["wiggle"])
+              annotate_scene(args,
+                             camera,
+                             output_image = path("image_tr",i,"image",j,"png"),
+                             output_scene = path("scene_tr",i,"annotation",j,"json"),
+                             objects      = state.for_rendering(),
+                             camera_rng   = rngs["camera"],
+                             tracker      = tracker,
+                             base_scene   = base_scene,
+                             writer       = writer)
+              frame_written(ledger, writer, shards, i, j)
+            transition_written(ledger, writer, shards, i)
+            break
+
+          if args.render_animation:
+            frames = []
+            rngs = [ streams.frame(args.seed, i, j) for j in range(len(state_sequence)) ]
+            for state, r in zip(state_sequence, rngs):
+              if WIGGLE_BETWEEN_IMAGES:
+                state.wiggle(r["wiggle"])
+              frames.append(state.for_rendering())
+            render_trajectory(args,
+                              output_image_pattern = path("image_tr",i,"image","###","png"),
+                              output_scenes        = [ path("scene_tr",i,"annotation",j,"json")
+                                                       for j in range(len(frames)) ],
+                              frames               = frames,
+                              camera_rngs          = [ r["camera"] for r in rngs ],
+                              lights_rngs          = [ r["lights"] for r in rngs ],
+                              base_scene           = base_scene,
+                              writer               = writer,
+                              done_frames          = done_frames,
+                              frame_written        = lambda j: frame_written(ledger, writer, shards, i, j))
+            transition_written(ledger, writer, shards, i)
+            break
+
+          tracker = AnnotationTracker(args)
+          for j, state in enumerate(state_sequence):
+            if j in done_frames:
+              continue
+            rngs = streams.frame(args.seed, i, j)
+            if WIGGLE_BETWEEN_IMAGES:
+              state.wiggle(rngs["wiggle"])
+            render_scene(args,
+                         output_image = path("image_tr",i,"image",j,"png"),
+                         output_scene = path("scene_tr",i,"annotation",j,"json"),
+                         objects      = state.for_rendering(),
+                         camera_rng   = rngs["camera"],
+                         lights_rng   = rngs["lights"],
+                         tracker      = tracker,
+                         base_scene   = base_scene,
+                         writer       = writer)
+            frame_written(ledger, writer, shards, i, j)
+          transition_written(ledger, writer, shards, i)
+
+          """
+          for j in range(args.num_samples_per_state):
+            if os.path.exists(path("image_tr",i,"suc",j,"png")):
+              continue
+            state = copy.deepcopy(suc)
+            state.wiggle()
+            render_scene(args,
+                         output_image = path("image_tr",i,"suc",j,"png"),
+                         output_scene = path("scene_tr",i,"suc",j,"json"),
+                         objects      = state.for_rendering(),
+                         action       = state.last_action)
+          """
           
           
 
 
 
-        break
-      except Unstackable as e:
-        print(e)
-        pass
-
-def compute_midpoint(initial, goal, fraction):
-    if not (0 <= fraction <= 1):
-        raise ValueError("Percentage must be between 0 and 1.")
-
-    # Interpolate between start and end positions
-    current_position = list(initial[i] + fraction * (goal[i] - initial[i]) for i in range(3))
-    return current_position
-
-def compute_intermediate_state(initial, goal, step, num_steps):
-  import copy
-  res = copy.deepcopy(initial)
-
-  # calc fraction of movement
-  frac = step/float(num_steps)
-  for o_id, object in enumerate(res.objects):
-    # get current position
-    initial_pos = object.location
-
-    # get final position
-    final_pos = goal.objects[o_id].location
-
-    # calculate intermediate position
-    new_pos = compute_midpoint(initial_pos, final_pos, frac)
-    object.location = new_pos
-
-  return res
-
-
-def euclidean_distance(point1, point2):
-    import math
-    return math.sqrt(sum((a - b) ** 2 for a, b in zip(point1, point2)))
-
-
-def compute_trajectory(initial, goal, num_steps, y_operate_level, active_threshold=.5):
-  import copy
-  state_sequence_list = list()
-  active_obj_ids = list()
-   
-  # determine what objects will move:
-  for o_id, object in enumerate(initial.objects):
-    # get current and final position
-    i_pos = object.location
-    f_pos = goal.objects[o_id].location
-    
-    if euclidean_distance(i_pos, f_pos) >= active_threshold:
-      active_obj_ids.append(o_id)
-
-  # create 1. intermediate step (lifted up until y operation level)
-  step_1 = copy.deepcopy(initial)
-  for o_id, object in enumerate(step_1.objects):
-    if o_id not in active_obj_ids:
-      continue
-    # get current position
-    initial_pos = object.location
-
-    # elevate from current x and y position
-    object.location = [initial_pos[0], initial_pos[1], y_operate_level]
-
-  # create 2. intermediate step (moved in x direction on elevated level)
-  step_2 = copy.deepcopy(initial)
-  for o_id, object in enumerate(step_2.objects):
-    if o_id not in active_obj_ids:
-      continue
-    # get current position
-    initial_pos = object.location
-
-    # get final position
-    final_pos = goal.objects[o_id].location
-
-    # elevate from current x and y position
-    object.location = [final_pos[0], final_pos[1], y_operate_level]
-
-
-    ## Create array of states:
-    num_frames_step0and1 = num_steps//3
-    num_frames_step1and2 = num_steps//3 + num_steps%3
-    num_frames_step2and3 = num_steps//3
-
-    for i in range(num_frames_step0and1):
-      res = compute_intermediate_state(initial, step_1, i, num_frames_step0and1-1)
-      state_sequence_list.append(res)
-
-    for i in range(num_frames_step1and2):
-      res = compute_intermediate_state(step_1, step_2, i, num_frames_step1and2-1)
-      state_sequence_list.append(res)
-
-    for i in range(num_frames_step2and3):
-      res = compute_intermediate_state(step_2, goal, i, num_frames_step2and3-1)
-      state_sequence_list.append(res)
-
-
-    # return finished list of states
-    return state_sequence_list
+          break
+        except Unstackable as e:
+          print(e)
+          pass
+  except BaseException:
+    # e.g. Ctrl-C: the transition being rendered can be claimed again right away
+    if current is not None:
+      ledger.release(current)
+    raise
 
+  if writer is not None:
+    for tag in writer.close():
+      record_frame(ledger, shards, *tag)
+    print(writer.report())
+  if shards is not None:
+    shards.close()
 
 if __name__ == '__main__':
   parser = initialize_parser()
@@ -303,6 +447,9 @@ if __name__ == '__main__':
     argv = utils.extract_args()
     args = parser.parse_args(argv)
     main(args)
+  elif '--annotations-only' in sys.argv:
+    args = parser.parse_args()
+    main(args)
   elif '--help' in sys.argv or '-h' in sys.argv:
     parser.print_help()
   else:
@@ -314,4 +461,8 @@ if __name__ == '__main__':
     print('arguments like this:')
     print()
     print('python render_images.py --help')
+    print()
+    print('Only the annotations can be generated without blender like this:')
+    print()
+    print('python render_images.py --annotations-only [args]')
 
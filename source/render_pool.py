@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+"""
+Render a dataset with several headless Blender workers on a single machine.
+
+The transition indices are put into a queue served on localhost, and each
+worker (a blender process running render_images.py with --work-queue) pulls
+the next index whenever it finishes the previous one, so that fast workers
+are never left idle behind slow ones. Example:
+
+  ./source/render_pool.py --blender blender-2.83.2-linux64/blender \\
+      --num-workers 8 --threads-per-worker 4 --pin-cpus \\
+      --start-idx 0 --num-transitions 30000 -- \\
+      --properties-json data/cylinders-properties.json --output-dir out ...
+
+Options after "--" are passed to render_images.py as they are.
+"""
+
+import argparse, os, sys, subprocess, threading, queue, secrets
+from multiprocessing.managers import BaseManager
+from ledger import Ledger
+
+AUTHKEY_ENV = "RENDER_POOL_AUTHKEY"
+
+
+class QueueServer(BaseManager):
+  pass
+
+
+class QueueClient(BaseManager):
+  pass
+
+
+def serve(indices, num_workers):
+  """
+  Start serving a queue holding indices on a random local port, followed by
+  one None per worker that tells the worker to stop.
+  Returns the address "host:port" and the authentication key of the queue.
+  """
+  q = queue.Queue()
+  for i in indices:
+    q.put(i)
+  for _ in range(num_workers):
+    q.put(None)
+
+  authkey = secrets.token_hex(16)
+  QueueServer.register('get_queue', callable=lambda: q)
+  manager = QueueServer(address=('127.0.0.1', 0), authkey=authkey.encode())
+  server = manager.get_server()
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  host, port = server.address
+  return "{}:{}".format(host, port), authkey
+
+
+def connect(address, authkey=None):
+  """
+  Connect to the queue served by serve() and return it.
+  The key is read from the environment variable RENDER_POOL_AUTHKEY by default.
+  """
+  if authkey is None:
+    authkey = os.environ[AUTHKEY_ENV]
+  host, port = address.rsplit(":", 1)
+  QueueClient.register('get_queue')
+  manager = QueueClient(address=(host, int(port)), authkey=authkey.encode())
+  manager.connect()
+  return manager.get_queue()
+
+
+def cpu_sets(num_workers, threads_per_worker):
+  """
+  Assign threads_per_worker consecutive cpus to each worker, wrapping around
+  when there are more threads than the cpus available to this process.
+  """
+  cpus = sorted(os.sched_getaffinity(0))
+  return [
+    { cpus[(w * threads_per_worker + t) % len(cpus)] for t in range(threads_per_worker) }
+    for w in range(num_workers)
+  ]
+
+
+def main(args, render_args):
+  # the ledger in the output directory of render_images.py tells which transitions are finished
+  output_parser = argparse.ArgumentParser(add_help=False)
+  output_parser.add_argument('--output-dir', default='output')
+  output_dir = output_parser.parse_known_args(render_args)[0].output_dir
+  ledger = Ledger(output_dir)
+  if args.reclaim:
+    ledger.release_all()
+  done = ledger.done()
+
+  indices = [ i for i in range(args.start_idx, args.start_idx + args.num_transitions)
+              if i not in done ]
+  address, authkey = serve(indices, args.num_workers)
+  print("serving {} transitions at {} ({} already finished)".format(
+    len(indices), address, args.num_transitions - len(indices)))
+
+  script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "render_images.py")
+  env = dict(os.environ)
+  env[AUTHKEY_ENV] = authkey
+
+  if args.pin_cpus:
+    affinities = cpu_sets(args.num_workers, args.threads_per_worker)
+
+  workers = []
+  for w in range(args.num_workers):
+    command = [args.blender, "-noaudio", "--background",
+               "--threads", str(args.threads_per_worker),
+               "--python", script, "--",
+               *render_args,
+               "--work-queue", address]
+    if args.pin_cpus:
+      cpus = affinities[w]
+      preexec_fn = (lambda cpus=cpus: os.sched_setaffinity(0, cpus))
+    else:
+      preexec_fn = None
+    workers.append(subprocess.Popen(command, env=env, preexec_fn=preexec_fn))
+
+  failed = 0
+  for w, worker in enumerate(workers):
+    if worker.wait() != 0:
+      print("worker {} exited with status {}".format(w, worker.returncode))
+      failed += 1
+
+  done = ledger.done()
+  unfinished = sum(1 for i in indices if i not in done)
+  if unfinished:
+    print("{} transitions are not finished; run the same command again to render them".format(unfinished))
+  return failed
+
+
+parser = argparse.ArgumentParser(
+  description="Render transitions with several local blender processes pulling from a shared queue. " +
+  "Options after \"--\" are passed to render_images.py.")
+parser.add_argument('--blender', default='blender',
+                    help="Path to the blender executable.")
+parser.add_argument('--num-workers', default=os.cpu_count(), type=int,
+                    help="The number of blender processes to run.")
+parser.add_argument('--threads-per-worker', default=1, type=int,
+                    help="The number of render threads of each blender process.")
+parser.add_argument('--pin-cpus', action="store_true",
+                    help="Bind each worker to its own set of --threads-per-worker cpus.")
+parser.add_argument('--start-idx', default=0, type=int,
+                    help="The index of the first transition to render.")
+parser.add_argument('--num-transitions', default=100, type=int,
+                    help="The number of transitions to render")
+parser.add_argument('--reclaim', action="store_true",
+                    help="Drop the claims of unfinished transitions left by the workers of a previous run " +
+                    "that crashed, instead of waiting for their leases to expire.")
+
+
+if __name__ == '__main__':
+  argv = sys.argv[1:]
+  if '--' in argv:
+    idx = argv.index('--')
+    argv, render_args = argv[:idx], argv[idx+1:]
+  else:
+    render_args = []
+  args = parser.parse_args(argv)
+  sys.exit(1 if main(args, render_args) else 0)
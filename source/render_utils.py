@@ -1,8 +1,8 @@
 from __future__ import print_function
-import sys, random, json, os, tempfile
-from collections import Counter
+import sys, random, os
 import numpy as np
 import copy
+import deltas
 
 INSIDE_BLENDER = True
 try:
@@ -10,6 +10,7 @@ try:
   from mathutils import Vector
 except ImportError as e:
   INSIDE_BLENDER = False
+from camera import Camera
 if INSIDE_BLENDER:
   try:
     import utils
@@ -23,14 +24,11 @@ if INSIDE_BLENDER:
     print("$VERSION is your Blender version (such as 2.78).")
     sys.exit(1)
 
-def render_scene(args,
-    output_image='render.png',
-    output_scene='render_json',
-    output_blendfile=None,
-    objects=[],
-    **kwargs
-  ):
-
+def setup_scene(args):
+  """
+  Load the base scene and the materials, and apply the render settings that
+  stay the same for every frame.
+  """
   # Load the main blendfile
   bpy.ops.wm.open_mainfile(filepath=args.base_scene_blendfile)
 
@@ -42,7 +40,6 @@ def render_scene(args,
   # cannot be used.
   render_args = bpy.context.scene.render
   render_args.engine = "CYCLES"
-  render_args.filepath = output_image
   render_args.resolution_x = args.width
   render_args.resolution_y = args.height
   render_args.resolution_percentage = 100
@@ -87,6 +84,311 @@ def render_scene(args,
   if args.use_gpu == 1:
     bpy.context.scene.cycles.device = 'GPU'
 
+  if args.render_passes:
+    setup_passes(bpy.context.scene)
+
+  if args.async_writer:
+    setup_viewer(bpy.context.scene)
+
+
+def setup_passes(scene):
+  """
+  Enable the object index and depth passes and add a File Output node to the
+  compositor that writes them as OpenEXR files next to the rendered image.
+  The paths of the files are set for each image by set_pass_paths.
+  """
+  if bpy.app.version < (2, 80, 0):
+    layer = scene.render.layers[0]
+  else:
+    layer = scene.view_layers[0]
+  layer.use_pass_object_index = True
+  layer.use_pass_z = True
+
+  scene.use_nodes = True
+  tree = scene.node_tree
+  render_layers = None
+  composite = None
+  for n in tree.nodes:
+    if n.type == 'R_LAYERS':
+      render_layers = n
+    if n.type == 'COMPOSITE':
+      composite = n
+  if render_layers is None:
+    render_layers = tree.nodes.new('CompositorNodeRLayers')
+  if composite is None:
+    composite = tree.nodes.new('CompositorNodeComposite')
+    tree.links.new(render_layers.outputs['Image'], composite.inputs['Image'])
+
+  output = tree.nodes.new('CompositorNodeOutputFile')
+  output.name = 'Passes'
+  output.format.file_format = 'OPEN_EXR'
+  output.format.color_depth = '32'
+  output.file_slots.clear()
+  output.file_slots.new('index')
+  output.file_slots.new('depth')
+  # the depth pass is called "Z" before 2.80
+  depth = render_layers.outputs.get('Depth') or render_layers.outputs.get('Z')
+  tree.links.new(render_layers.outputs['IndexOB'], output.inputs[0])
+  tree.links.new(depth, output.inputs[1])
+
+
+def setup_viewer(scene):
+  """
+  Add a Viewer node to the compositor, so that the pixels of the rendered image
+  can be read from the "Viewer Node" image (see viewer_pixels) instead of
+  being written by blender.
+  """
+  scene.use_nodes = True
+  tree = scene.node_tree
+  render_layers = None
+  for n in tree.nodes:
+    if n.type == 'R_LAYERS':
+      render_layers = n
+  if render_layers is None:
+    render_layers = tree.nodes.new('CompositorNodeRLayers')
+  viewer = tree.nodes.new('CompositorNodeViewer')
+  viewer.use_alpha = True
+  tree.links.new(render_layers.outputs['Image'], viewer.inputs['Image'])
+  check_color_management(scene)
+
+
+def check_color_management(scene):
+  """
+  The Viewer node has the linear pixels, which async_writer.srgb encodes as the
+  Standard view transform on an sRGB display does. Raises ValueError when the
+  color management of the scene does something else, e.g. Filmic or a look,
+  since the images would differ from those saved by blender.
+  """
+  view = scene.view_settings
+  problems = []
+  if view.view_transform not in ('Default', 'Standard'):
+    problems.append("view transform {}".format(view.view_transform))
+  if view.look != 'None':
+    problems.append("look {}".format(view.look))
+  if view.exposure != 0 or view.gamma != 1:
+    problems.append("exposure {} / gamma {}".format(view.exposure, view.gamma))
+  if view.use_curve_mapping:
+    problems.append("curves")
+  if scene.display_settings.display_device != 'sRGB':
+    problems.append("display device {}".format(scene.display_settings.display_device))
+  if problems:
+    raise ValueError("--async-writer encodes the images with the Standard view transform on an sRGB display; " +
+                     "the scene uses " + ", ".join(problems) + ". Set them to the defaults or render without --async-writer.")
+
+
+def viewer_pixels():
+  """
+  Returns the linear pixels of the last rendered image as an array [height, width, channels],
+  where channels is 3 or 4 depending on the color mode of the output.
+  """
+  img = bpy.data.images['Viewer Node']
+  w, h = img.size
+  if bpy.app.version < (2, 83, 0):
+    pixels = np.array(img.pixels[:], dtype=np.float32)
+  else:
+    pixels = np.empty(w * h * 4, dtype=np.float32)
+    img.pixels.foreach_get(pixels)
+  # blender stores the rows from the bottom
+  pixels = pixels.reshape((h, w, 4))[::-1]
+  if bpy.context.scene.render.image_settings.color_mode == 'RGBA':
+    return pixels
+  return pixels[:, :, :3]
+
+
+def pass_paths(output_image):
+  """Returns the paths of the object index and depth passes of an image"""
+  base = os.path.splitext(output_image)[0]
+  return base + "_index.exr", base + "_depth.exr"
+
+
+def set_pass_paths(output_image):
+  """
+  Point the File Output node to output_image, which may contain "#"s replaced by
+  the frame number. Without "#", blender appends the frame number to the names;
+  move_pass_files renames them afterwards.
+  """
+  output = bpy.context.scene.node_tree.nodes['Passes']
+  directory, name = os.path.split(os.path.splitext(output_image)[0])
+  output.base_path = directory
+  output.file_slots[0].path = name + "_index"
+  output.file_slots[1].path = name + "_depth"
+
+
+def move_pass_files(output_image):
+  """Remove the frame number appended by blender to the pass files of a still image"""
+  frame = "{:04d}".format(bpy.context.scene.frame_current)
+  for path in pass_paths(output_image):
+    base, ext = os.path.splitext(path)
+    os.replace(base + frame + ext, path)
+
+
+def load_pass(path):
+  """Load the first channel of an image written by blender as an array [height, width]"""
+  img = bpy.data.images.load(path)
+  w, h = img.size
+  if bpy.app.version < (2, 83, 0):
+    pixels = np.array(img.pixels[:], dtype=np.float32)
+  else:
+    pixels = np.empty(w * h * img.channels, dtype=np.float32)
+    img.pixels.foreach_get(pixels)
+  channels = img.channels
+  bpy.data.images.remove(img)
+  # blender stores the rows from the bottom
+  return pixels.reshape((h, w, channels))[::-1, :, 0]
+
+
+def add_pass_statistics(objects, index_path, depth_path):
+  """
+  Store the statistics of the object index and depth passes into the objects;
+  see pass_statistics.
+  """
+  index = np.rint(load_pass(index_path)).astype(int)
+  depth = load_pass(depth_path)
+  stats = pass_statistics(index, depth, [ obj["bbox"] for obj in objects ])
+  for obj, stat in zip(objects, stats):
+    obj.update(stat)
+
+
+class InstancePool(object):
+  """
+  Each shape is read from the disk once; the objects placed in the scene are
+  linked duplicates sharing the mesh of the loaded shape. Materials are created
+  once per (material, color) pair and reused by all objects with that pair.
+  """
+
+  def __init__(self, shape_dir):
+    self.shape_dir = shape_dir
+    self.shapes = {}
+    self.materials = {}
+    self.count = {}
+
+  def shape(self, name):
+    if name not in self.shapes:
+      prototype = utils.load_object(self.shape_dir, name)
+      # the material is linked to each duplicate, not to the shared mesh.
+      # the mesh only provides an empty slot.
+      assert len(prototype.data.materials) == 0
+      prototype.data.materials.append(None)
+      self.shapes[name] = prototype
+      self.count[name] = 0
+    return self.shapes[name]
+
+  def material(self, name, color):
+    key = (name, tuple(color))
+    if key not in self.materials:
+      mat = utils.new_material(name, Color=color)
+      mat.use_fake_user = True
+      self.materials[key] = mat
+    return self.materials[key]
+
+  def add_object(self, name, scale, loc, theta=0):
+    """
+    Same as utils.add_object, but returns a linked duplicate of the shape.
+    """
+    prototype = self.shape(name)
+
+    o = prototype.copy()
+    o.name = '%s_%d' % (name, self.count[name])
+    self.count[name] += 1
+    utils.link_object(o)
+
+    o.rotation_euler[2] = theta
+    o.scale = tuple(s * scale for s in prototype.scale)
+    # modified from CLEVR: y-axis is 0, and blocks are stacked vertically
+    o.location = tuple(a + b for a, b in zip(prototype.location, loc))
+    utils.make_active(o)
+    return o
+
+  def add_material(self, obj, name, color):
+    """
+    Same as utils.add_material, but reuses the material of the same name and color.
+    """
+    slot = obj.material_slots[0]
+    slot.link = 'OBJECT'
+    slot.material = self.material(name, color)
+
+
+class Session(object):
+  """
+  Keeps the base scene, the materials and the shape meshes loaded across
+  frames. Only the objects added for the previous frame are removed, and the
+  camera and lamps are moved back to their original positions before the
+  jitter of the next frame is applied.
+  """
+
+  def __init__(self, args):
+    setup_scene(args)
+    self.args = args
+    self.base_locations = {
+      name : tuple(bpy.data.objects[name].location)
+      for name in JITTERED_OBJECTS
+    }
+    self.pool = InstancePool(args.shape_dir)
+    self.added = []
+
+  def reset(self):
+    """Restore the base scene and purge the data left over by the previous frame."""
+    for obj in self.added:
+      bpy.data.objects.remove(obj, do_unlink=True)
+    self.added = []
+    for name, location in self.base_locations.items():
+      bpy.data.objects[name].location = location
+    utils.purge_orphans()
+
+  def add_object(self, name, scale, loc, theta=0):
+    o = self.pool.add_object(name, scale, loc, theta)
+    self.added.append(o)
+    return o
+
+  def add_material(self, obj, name, color):
+    self.pool.add_material(obj, name, color)
+
+
+# objects in the base scene whose location is jittered in each frame
+JITTERED_OBJECTS = ['Camera', 'Lamp_Key', 'Lamp_Back', 'Lamp_Fill']
+
+_session = None
+
+def get_session(args):
+  """Returns the session of this process, creating it on the first call."""
+  global _session
+  if _session is None:
+    _session = Session(args)
+  return _session
+
+
+def render_scene(args,
+    output_image='render.png',
+    output_scene='render_json',
+    output_blendfile=None,
+    objects=[],
+    camera_rng=random,
+    lights_rng=random,
+    base_scene=None,
+    writer=None,
+    tracker=None,
+    **kwargs
+  ):
+  """
+  Render the objects and write the image to output_image and the scene data
+  to output_scene. With an async_writer.AsyncWriter, the image and the scene
+  data are written by the writer thread, and the function returns once the
+  image is rendered. With an AnnotationTracker, given the successive frames of
+  a transition, only the annotations and the relations of the objects that
+  moved since the previous frame are computed again.
+  """
+
+  if args.persistent_session:
+    session = get_session(args)
+    session.reset()
+  else:
+    session = None
+    setup_scene(args)
+
+  bpy.context.scene.render.filepath = output_image
+  if args.render_passes:
+    set_pass_paths(output_image)
+
   # This will give ground-truth information about the scene and its objects
   scene_struct = {
       'image_filename': os.path.basename(output_image),
@@ -95,132 +397,339 @@ def render_scene(args,
   }
   scene_struct.update(kwargs)
 
-  if bpy.app.version < (2, 80, 0):
-    bpy.ops.mesh.primitive_plane_add(radius=5)
-  else:
-    bpy.ops.mesh.primitive_plane_add(size=5)
-
-  plane = bpy.context.object
+  if session is None:
+    if bpy.app.version < (2, 80, 0):
+      bpy.ops.mesh.primitive_plane_add(radius=5)
+    else:
+      bpy.ops.mesh.primitive_plane_add(size=5)
 
-  def rand(L):
-    return 2.0 * L * (random.random() - 0.5)
+    plane = bpy.context.object
 
   # Add random jitter to camera position
-  if args.camera_jitter > 0:
-    for i in range(3):
-      bpy.data.objects['Camera'].location[i] += rand(args.camera_jitter)
+  jitter_camera(args, camera_rng)
 
   # Figure out the left, up, and behind directions along the plane and record
   # them in the scene structure
   camera = bpy.data.objects['Camera']
-  plane_normal = plane.data.vertices[0].normal
-  if bpy.app.version < (2, 80, 0):
-    cam_behind = camera.matrix_world.to_quaternion() * Vector((0, 0, -1))
-    cam_left = camera.matrix_world.to_quaternion() * Vector((-1, 0, 0))
-    cam_up = camera.matrix_world.to_quaternion() * Vector((0, 1, 0))
+  if session is None:
+    plane_normal = plane.data.vertices[0].normal
   else:
-    cam_behind = camera.matrix_world.to_quaternion() @ Vector((0, 0, -1))
-    cam_left = camera.matrix_world.to_quaternion() @ Vector((-1, 0, 0))
-    cam_up = camera.matrix_world.to_quaternion() @ Vector((0, 1, 0))
-  plane_behind = (cam_behind - cam_behind.project(plane_normal)).normalized()
-  plane_left = (cam_left - cam_left.project(plane_normal)).normalized()
-  plane_up = cam_up.project(plane_normal).normalized()
+    # the session does not add the plane, whose normal is always +z.
+    # matrix_world of the jittered camera is refreshed by a scene update.
+    utils.update_scene()
+    plane_normal = Vector((0, 0, 1))
+  scene_struct['directions'] = compute_directions(camera, plane_normal)
 
   # Delete the plane; we only used it for normals anyway. The base scene file
   # contains the actual ground plane.
-  utils.delete_object(plane)
-
-  # Save all six axis-aligned directions in the scene struct
-  scene_struct['directions']['left'] = tuple(plane_left)
-  scene_struct['directions']['right'] = tuple(-plane_left)
-  scene_struct['directions']['behind'] = tuple(plane_behind)
-  scene_struct['directions']['front'] = tuple(-plane_behind)
-  scene_struct['directions']['above'] = tuple(plane_up)
-  scene_struct['directions']['below'] = tuple(-plane_up)
+  if session is None:
+    utils.delete_object(plane)
 
   # Add random jitter to lamp positions
-  if args.key_light_jitter > 0:
-    for i in range(3):
-      bpy.data.objects['Lamp_Key'].location[i] += rand(args.key_light_jitter)
-  if args.back_light_jitter > 0:
-    for i in range(3):
-      bpy.data.objects['Lamp_Back'].location[i] += rand(args.back_light_jitter)
-  if args.fill_light_jitter > 0:
-    for i in range(3):
-      bpy.data.objects['Lamp_Fill'].location[i] += rand(args.fill_light_jitter)
+  jitter_lights(args, lights_rng)
 
   # Now make some random objects
-  blender_objects = add_objects(args, scene_struct, camera, objects)
+  blender_objects = add_objects(args, scene_struct, camera, objects, session, tracker)
 
   # insert "table" object into objects
-  table_object = copy.deepcopy(objects[0])
-  table_object["bbox"] = (85.0, 170.0, 210.0, 155.0)
-  table_object["id"] = len(objects)
-  table_object["color"] = [255/255.0, 87/255.0, 34/255.0, 1.0]
-  table_object["location"] = [0, 0, 0]
-  objects.append(table_object)
+  add_table_object(objects)
 
   # Render the scene and dump the scene data structure
   scene_struct['objects'] = objects
-  scene_struct['relationships'] = compute_all_relationships(scene_struct)
+  if tracker is None:
+    scene_struct['relationships'] = compute_all_relationships(scene_struct, spatial=args.spatial_relations)
+  else:
+    scene_struct['relationships'] = tracker.relations.update(scene_struct)
   while True:
     try:
-      bpy.ops.render.render(write_still=True)
+      bpy.ops.render.render(write_still=(writer is None))
       break
     except Exception as e:
       print(e)
+  if writer is not None:
+    writer.write_png(output_image, viewer_pixels())
+
+  if args.render_passes:
+    move_pass_files(output_image)
+    add_pass_statistics(objects[:-1], *pass_paths(output_image))
 
-  with open(output_scene, 'w') as f:
-    json.dump(scene_struct, f, indent=2)
-    f.truncate()
+  if writer is None:
+    deltas.write_scene(output_scene, scene_struct, base_scene)
+  else:
+    writer.write_scene(output_scene, scene_struct, base_scene)
 
   if output_blendfile is not None:
     bpy.ops.wm.save_as_mainfile(filepath=output_blendfile)
 
 
-def add_objects(args, scene_struct, camera, objects):
+def render_trajectory(args,
+    output_image_pattern='render_###.png',
+    output_scenes=[],
+    frames=[],
+    camera_rngs=None,
+    lights_rngs=None,
+    base_scene=None,
+    writer=None,
+    done_frames=(),
+    frame_written=None,
+    **kwargs
+  ):
+  """
+  Render the frames of a trajectory as a single animation.
+
+  frames is a list whose elements are the objects of each frame, as in the
+  objects argument of render_scene; the objects must be the same in all frames
+  and only differ in their locations. The locations, as well as the camera and
+  lamp jitter of each frame, are stored as keyframes, and the whole sequence is
+  rendered with bpy.ops.render.render(animation=True) so that the scene is
+  synchronized with the renderer only once. The image of the j-th frame is
+  written to output_image_pattern whose "#"s are replaced by j, and its scene
+  data is written to output_scenes[j]. The jitter of the j-th frame is drawn from
+  camera_rngs[j] and lights_rngs[j] when they are given. With base_scene, the
+  scene data are written as deltas against it (see deltas.py). With an
+  async_writer.AsyncWriter, the scene data are written by the writer thread.
+
+  The frames in done_frames are not rendered again. The scene data of each
+  frame are written as soon as blender writes its image, and then
+  frame_written(j) is called, e.g. to record the frame and renew the lease of
+  the transition during a long animation.
+  """
+  if args.persistent_session:
+    session = get_session(args)
+    session.reset()
+  else:
+    session = None
+    setup_scene(args)
+
+  scene = bpy.context.scene
+  camera = bpy.data.objects['Camera']
+  base_locations = {
+    name : tuple(bpy.data.objects[name].location)
+    for name in JITTERED_OBJECTS
+  }
+
+  blender_objects = add_objects(args, None, camera, frames[0], session)
+  # the shapes may not be centered at the origin of their .blend file
+  offsets = [ bobj.location - Vector(obj["location"])
+              for bobj, obj in zip(blender_objects, frames[0]) ]
+
+  for j, objects in enumerate(frames):
+    for name, location in base_locations.items():
+      bpy.data.objects[name].location = location
+    jitter_camera(args, random if camera_rngs is None else camera_rngs[j])
+    jitter_lights(args, random if lights_rngs is None else lights_rngs[j])
+    for name in JITTERED_OBJECTS:
+      bpy.data.objects[name].keyframe_insert(data_path="location", frame=j)
+    for bobj, obj, offset in zip(blender_objects, objects, offsets):
+      bobj.location = Vector(obj["location"]) + offset
+      bobj.keyframe_insert(data_path="location", frame=j)
+
+  scene_structs = []
+  tracker = AnnotationTracker(args)
+  for j, objects in enumerate(frames):
+    scene.frame_set(j)
+    scene_struct = {
+        'image_filename': os.path.basename(output_image_pattern.replace("###", "{:03d}".format(j))),
+        'objects': [],
+        'directions': compute_directions(camera, Vector((0, 0, 1))),
+    }
+    scene_struct.update(kwargs)
+    annotate_objects(args, camera, blender_objects, objects, tracker)
+    add_table_object(objects)
+    scene_struct['objects'] = objects
+    scene_struct['relationships'] = tracker.relations.update(scene_struct)
+    scene_structs.append(scene_struct)
+
+  written = set(done_frames)
+  def write_frame(scene, *_):
+    j = scene.frame_current
+    scene_struct = scene_structs[j]
+    if args.render_passes:
+      output_image = output_image_pattern.replace("###", "{:03d}".format(j))
+      add_pass_statistics(scene_struct['objects'][:-1], *pass_paths(output_image))
+    if writer is None:
+      deltas.write_scene(output_scenes[j], scene_struct, base_scene)
+    else:
+      writer.write_scene(output_scenes[j], scene_struct, base_scene)
+    written.add(j)
+    if frame_written is not None:
+      frame_written(j)
+
+  scene.render.filepath = output_image_pattern
+  if args.render_passes:
+    set_pass_paths(output_image_pattern)
+  scene.render.use_persistent_data = True
+  bpy.app.handlers.render_write.append(write_frame)
+  try:
+    # the runs of consecutive frames not written yet, also after a failed render
+    while len(written) < len(frames):
+      start = min(set(range(len(frames))) - written)
+      end = start
+      while end + 1 < len(frames) and end + 1 not in written:
+        end += 1
+      scene.frame_start = start
+      scene.frame_end = end
+      try:
+        bpy.ops.render.render(animation=True)
+      except Exception as e:
+        print(e)
+  finally:
+    bpy.app.handlers.render_write.remove(write_frame)
+  scene.render.use_persistent_data = False
+
+  # the objects are removed by the next reset; the keyframes on the camera
+  # and the lamps must not leak into the following frames.
+  for name in JITTERED_OBJECTS:
+    bpy.data.objects[name].animation_data_clear()
+
+
+def rand(L, rng=random):
+  return 2.0 * L * (rng.random() - 0.5)
+
+
+def jitter_camera(args, rng=random):
+  """Add random jitter to the camera position"""
+  if args.camera_jitter > 0:
+    for i in range(3):
+      bpy.data.objects['Camera'].location[i] += rand(args.camera_jitter, rng)
+
+
+def jitter_lights(args, rng=random):
+  """Add random jitter to the lamp positions"""
+  if args.key_light_jitter > 0:
+    for i in range(3):
+      bpy.data.objects['Lamp_Key'].location[i] += rand(args.key_light_jitter, rng)
+  if args.back_light_jitter > 0:
+    for i in range(3):
+      bpy.data.objects['Lamp_Back'].location[i] += rand(args.back_light_jitter, rng)
+  if args.fill_light_jitter > 0:
+    for i in range(3):
+      bpy.data.objects['Lamp_Fill'].location[i] += rand(args.fill_light_jitter, rng)
+
+
+def compute_directions(camera, plane_normal):
+  """
+  Returns the left, right, behind, front, above and below directions along
+  the ground plane as seen from the camera.
+  """
+  if bpy.app.version < (2, 80, 0):
+    cam_behind = camera.matrix_world.to_quaternion() * Vector((0, 0, -1))
+    cam_left = camera.matrix_world.to_quaternion() * Vector((-1, 0, 0))
+    cam_up = camera.matrix_world.to_quaternion() * Vector((0, 1, 0))
+  else:
+    cam_behind = camera.matrix_world.to_quaternion() @ Vector((0, 0, -1))
+    cam_left = camera.matrix_world.to_quaternion() @ Vector((-1, 0, 0))
+    cam_up = camera.matrix_world.to_quaternion() @ Vector((0, 1, 0))
+  plane_behind = (cam_behind - cam_behind.project(plane_normal)).normalized()
+  plane_left = (cam_left - cam_left.project(plane_normal)).normalized()
+  plane_up = cam_up.project(plane_normal).normalized()
+
+  # Save all six axis-aligned directions in the scene struct
+  directions = {}
+  directions['left'] = tuple(plane_left)
+  directions['right'] = tuple(-plane_left)
+  directions['behind'] = tuple(plane_behind)
+  directions['front'] = tuple(-plane_behind)
+  directions['above'] = tuple(plane_up)
+  directions['below'] = tuple(-plane_up)
+  return directions
+
+
+def add_table_object(objects):
+  """insert "table" object into objects"""
+  table_object = copy.deepcopy(objects[0])
+  table_object["bbox"] = (85.0, 170.0, 210.0, 155.0)
+  table_object["id"] = len(objects)
+  table_object["color"] = [255/255.0, 87/255.0, 34/255.0, 1.0]
+  table_object["location"] = [0, 0, 0]
+  objects.append(table_object)
+
+
+def add_objects(args, scene_struct, camera, objects, session=None, tracker=None):
   """
-  Add objects to the current blender scene
+  Add objects to the current blender scene.
+  When session is given, the shapes are taken from the session.
+  The objects are annotated with the tracker, see annotate_objects.
   """
   blender_objects = []
   for obj in objects:
     
     # Actually add the object to the scene
-    utils.add_object(args.shape_dir,
-                     obj["shape"],
-                     obj["size"],
-                     obj["location"],
-                     theta=obj["rotation"])
-    bobj = bpy.context.object
+    if session is None:
+      utils.add_object(args.shape_dir,
+                       obj["shape"],
+                       obj["size"],
+                       obj["location"],
+                       theta=obj["rotation"])
+      bobj = bpy.context.object
+    else:
+      bobj = session.add_object(obj["shape"],
+                                obj["size"],
+                                obj["location"],
+                                theta=obj["rotation"])
     blender_objects.append(bobj)
-    utils.add_material(obj["material"], Color=obj["color"])
-    obj["pixel_coords"] = utils.get_camera_coords(camera, bobj.location)
-
-    loc = np.array(bobj.location)
-    dim = np.array(bobj.dimensions)
-    half = dim / 2
-    corners = []
-    corners.append(loc + half * [1,1,1])
-    corners.append(loc + half * [1,1,-1])
-    corners.append(loc + half * [1,-1,1])
-    corners.append(loc + half * [1,-1,-1])
-    corners.append(loc + half * [-1,1,1])
-    corners.append(loc + half * [-1,1,-1])
-    corners.append(loc + half * [-1,-1,1])
-    corners.append(loc + half * [-1,-1,-1])
-
-    import mathutils
-    corners_camera_coords = np.array([ utils.get_camera_coords(camera, mathutils.Vector(tuple(corner)))
-                                       for corner in corners ])
-    xmax = np.amax(corners_camera_coords[:,0])
-    ymax = np.amax(corners_camera_coords[:,1])
-    xmin = np.amin(corners_camera_coords[:,0])
-    ymin = np.amin(corners_camera_coords[:,1])
-    obj["bbox"] = (float(xmin), float(ymin), float(xmax), float(ymax))
+    # object index pass; 0 is the background
+    bobj.pass_index = len(blender_objects)
+    if session is None:
+      utils.add_material(obj["material"], Color=obj["color"])
+    else:
+      session.add_material(bobj, obj["material"], obj["color"])
+
+  # dimensions and matrix_world are only refreshed by a scene update
+  utils.update_scene()
+  annotate_objects(args, camera, blender_objects, objects, tracker)
   return blender_objects
 
 
-def compute_all_relationships(scene_struct, eps=0.2):
+def annotate_objects(args, camera, blender_objects, objects, tracker=None):
+  """
+  Store the pixel coordinates and the bounding boxes of the blender objects
+  into objects. All points are projected at once with the camera matrix of
+  the current frame. The bounding box covers the 8 corners of the box given by
+  the location and the dimensions of the object, or with --tight-bboxes, all
+  vertices of its mesh. With an AnnotationTracker, only the objects that moved
+  since the previous frame given to the tracker are annotated again.
+  """
+  model = Camera.from_blender(camera, bpy.context.scene)
+
+  def annotate(moved):
+    bobjs = [ blender_objects[i] for i in moved ]
+    locations = np.array([ tuple(bobj.location) for bobj in bobjs ])
+    px, py, z = model.project(locations)
+
+    if args.tight_bboxes:
+      bboxes = []
+      for bobj in bobjs:
+        vertices = mesh_vertices(bobj)
+        vx, vy, _ = model.project(vertices)
+        bboxes.append((vx.min(), vy.min(), vx.max(), vy.max()))
+    else:
+      dimensions = np.array([ tuple(bobj.dimensions) for bobj in bobjs ])
+      bboxes = model.bboxes(locations, dimensions)
+    return [ ((int(x), int(y), float(d)), tuple(float(v) for v in bbox))
+             for x, y, d, bbox in zip(px, py, z, bboxes) ]
+
+  if tracker is None:
+    for obj, (pixel_coords, bbox) in zip(objects, annotate(range(len(objects)))):
+      obj["pixel_coords"] = pixel_coords
+      obj["bbox"] = bbox
+  else:
+    tracker.annotate_objects(model, objects, annotate)
+
+
+def mesh_vertices(bobj):
+  """Returns the world coordinates of the vertices of a blender object as an array [N, 3]"""
+  vertices = bobj.data.vertices
+  co = np.empty(len(vertices) * 3)
+  vertices.foreach_get("co", co)
+  matrix = np.array(bobj.matrix_world)
+  return co.reshape((-1, 3)) @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+SPATIAL_RELATIONS = ['left', 'right', 'front', 'behind']
+
+
+def compute_all_relationships(scene_struct, eps=0.2, spatial=False):
   """
   Computes relationships between all pairs of objects in the scene.
   
@@ -228,146 +737,186 @@ def compute_all_relationships(scene_struct, eps=0.2):
   integers, where output[rel][i] gives a list of object indices that have the
   relationship rel with object i. For example if j is in output['left'][i] then
   object j is left of object i.
-  """
-  all_relationships = {}
-  non_table_objects = scene_struct['objects'][:-1]
-  table_index = len(non_table_objects)
-
-  # "ON" relationship:
-  direction_vec = scene_struct['directions']['above']
-  name = "on"
-  all_relationships[name] = []
-  for i, obj1 in enumerate(non_table_objects):
-    coords1 = obj1['location']
-    size1 = obj1['size']
-    related = set()
-    for j, obj2 in enumerate(non_table_objects):
-      if obj1 == obj2: continue
-      coords2 = obj2['location']
-      size2 = obj2['size']
-      x_diff = abs(coords2[0] - coords1[0])
-      if x_diff > eps: continue
-      y_diff = coords1[2] - coords2[2]
-      size_buff = size1 + size2
-      y_deviation = abs(y_diff - size_buff)
-      if y_deviation > eps: continue
-      
-      # obj1 is on top of obj2
-      related.add(j)
-    if abs(coords1[2] - size1/2) <= eps:
-      related.add(table_index)
-    all_relationships[name].append(sorted(list(related)))
-
 
-  # "clear" relationship
-  clear_blocks = []
-  for b_id in range(table_index):
-    put = True
-    for blocks in all_relationships[name]:
-      if b_id in blocks: put = False
-
-    if not put: continue
-    clear_blocks.append(b_id)
-
-  name = "clear"
-  all_relationships[name] = []
-  for i in range(table_index):
-    if i not in clear_blocks:
-      all_relationships[name].append(list([]))
-      continue
-    all_relationships[name].append(list([i]))
+  "on" and "clear" are always computed; with spatial, "left", "right", "front"
+  and "behind" are computed from the directions of the scene as well.
+  """
+  return RelationTracker(eps, spatial).update(scene_struct)
 
 
+def relation_on(locations1, sizes1, locations2, sizes2, eps):
+  """on[i, j] when the i-th object of the first arrays is on top of the j-th object of the second."""
+  x_diff = np.abs(locations2[None, :, 0] - locations1[:, None, 0])
+  y_deviation = np.abs((locations1[:, None, 2] - locations2[None, :, 2]) - (sizes1[:, None] + sizes2[None, :]))
+  return (x_diff <= eps) & (y_deviation <= eps)
 
 
-  
-  return all_relationships
+def relation_direction(locations1, locations2, direction, eps):
+  """res[i, j] when the j-th object of the second array is in the direction from the i-th object of the first."""
+  return (locations2[None, :, :] - locations1[:, None, :]) @ direction > eps
 
 
-def check_visibility(blender_objects, min_pixels_per_object):
+class RelationTracker(object):
   """
-  Check whether all objects in the scene have some minimum number of visible
-  pixels; to accomplish this we assign random (but distinct) colors to all
-  objects, and render using no lighting or shading or antialiasing; this
-  ensures that each object is just a solid uniform color. We can then count
-  the number of pixels of each color in the output image to check the visibility
-  of each object.
-
-  Returns True if all objects are visible and False otherwise.
+  Computes the relationships of compute_all_relationships for the successive
+  frames of the same objects. The relations are kept as boolean matrices for
+  all pairs, and only the rows and the columns of the objects that moved since
+  the previous frame are computed again.
   """
-  f, path = tempfile.mkstemp(suffix='.png')
-  object_colors = render_shadeless(blender_objects, path=path)
-  img = bpy.data.images.load(path)
-  p = list(img.pixels)
-  color_count = Counter((p[i], p[i+1], p[i+2], p[i+3])
-                        for i in range(0, len(p), 4))
-  os.remove(path)
-  if len(color_count) != len(blender_objects) + 1:
-    return False
-  for _, count in color_count.most_common():
-    if count < min_pixels_per_object:
-      return False
-  return True
-
-
-def render_shadeless(blender_objects, path='flat.png'):
+  def __init__(self, eps=0.2, spatial=False):
+    self.eps = eps
+    self.spatial = spatial
+    self.locations = None
+
+  def update(self, scene_struct):
+    non_table_objects = scene_struct['objects'][:-1]
+    locations = np.array([ obj['location'] for obj in non_table_objects ], dtype=float).reshape(-1, 3)
+    sizes = np.array([ obj['size'] for obj in non_table_objects ], dtype=float)
+    if self.spatial:
+      directions = np.array([ scene_struct['directions'][name] for name in SPATIAL_RELATIONS ], dtype=float)
+
+    if self.locations is None or self.locations.shape != locations.shape or (self.sizes != sizes).any():
+      moved = np.arange(len(locations))
+      self.on = np.zeros((len(locations), len(locations)), dtype=bool)
+      self.on_table = np.zeros(len(locations), dtype=bool)
+      if self.spatial:
+        self.sides = np.zeros((len(SPATIAL_RELATIONS), len(locations), len(locations)), dtype=bool)
+        self.directions = directions
+    else:
+      moved = np.flatnonzero((locations != self.locations).any(axis=1))
+    self.locations, self.sizes = locations, sizes
+    eps = self.eps
+
+    # obj i is on top of obj j
+    self.on[moved, :] = relation_on(locations[moved], sizes[moved], locations, sizes, eps)
+    self.on[:, moved] = relation_on(locations, sizes, locations[moved], sizes[moved], eps)
+    self.on[moved, moved] = False
+    # size is half the height of a block: the blocks on the table are at z == size
+    self.on_table[moved] = np.abs(locations[moved, 2] - sizes[moved]) <= eps
+
+    if self.spatial:
+      if (directions != self.directions).any():
+        # all pairs change when the camera turns
+        moved = np.arange(len(locations))
+        self.directions = directions
+      for sides, direction in zip(self.sides, directions):
+        sides[moved, :] = relation_direction(locations[moved], locations, direction, eps)
+        sides[:, moved] = relation_direction(locations, locations[moved], direction, eps)
+        sides[moved, moved] = False
+
+    return self.relationships()
+
+  def relationships(self):
+    table_index = len(self.locations)
+    all_relationships = {}
+    all_relationships["on"] = [
+      np.flatnonzero(row).tolist() + ([table_index] if t else [])
+      for row, t in zip(self.on, self.on_table.tolist())
+    ]
+    # "clear" relationship: nothing is on the block
+    clear = ~self.on.any(axis=0)
+    all_relationships["clear"] = [ [i] if c else [] for i, c in enumerate(clear.tolist()) ]
+    if self.spatial:
+      for name, sides in zip(SPATIAL_RELATIONS, self.sides):
+        all_relationships[name] = [ np.flatnonzero(row).tolist() for row in sides ]
+    return all_relationships
+
+
+class AnnotationTracker(object):
   """
-  Render a version of the scene with shading disabled and unique materials
-  assigned to all objects, and return a set of all colors that should be in the
-  rendered image. The image itself is written to path. This is used to ensure
-  that all objects will be visible in the final rendered scene.
+  Annotates the successive frames of a trajectory, where the same objects
+  move a little between frames. The pixel coordinates and the bounding boxes
+  are computed again only for the objects that moved, unless the camera moved,
+  and the relationships are updated by a RelationTracker.
   """
-  render_args = bpy.context.scene.render
-
-  # Cache the render args we are about to clobber
-  old_filepath = render_args.filepath
-  old_engine = render_args.engine
-  old_use_antialiasing = render_args.use_antialiasing
-
-  # Override some render settings to have flat shading
-  render_args.filepath = path
-  render_args.engine = 'BLENDER_RENDER'
-  render_args.use_antialiasing = False
-
-  # Move the lights and ground to layer 2 so they don't render
-  utils.set_layer(bpy.data.objects['Lamp_Key'], 2)
-  utils.set_layer(bpy.data.objects['Lamp_Fill'], 2)
-  utils.set_layer(bpy.data.objects['Lamp_Back'], 2)
-  utils.set_layer(bpy.data.objects['Ground'], 2)
-
-  # Add random shadeless materials to all objects
-  object_colors = set()
-  old_materials = []
-  for i, obj in enumerate(blender_objects):
-    old_materials.append(obj.data.materials[0])
-    bpy.ops.material.new()
-    mat = bpy.data.materials['Material']
-    mat.name = 'Material_%d' % i
-    while True:
-      r, g, b = [random.random() for _ in range(3)]
-      if (r, g, b) not in object_colors: break
-    object_colors.add((r, g, b))
-    mat.diffuse_color = [r, g, b]
-    mat.use_shadeless = True
-    obj.data.materials[0] = mat
-
-  # Render the scene
-  bpy.ops.render.render(write_still=True)
-
-  # Undo the above; first restore the materials to objects
-  for mat, obj in zip(old_materials, blender_objects):
-    obj.data.materials[0] = mat
-
-  # Move the lights and ground back to layer 0
-  utils.set_layer(bpy.data.objects['Lamp_Key'], 0)
-  utils.set_layer(bpy.data.objects['Lamp_Fill'], 0)
-  utils.set_layer(bpy.data.objects['Lamp_Back'], 0)
-  utils.set_layer(bpy.data.objects['Ground'], 0)
-
-  # Set the render settings back to what they were
-  render_args.filepath = old_filepath
-  render_args.engine = old_engine
-  render_args.use_antialiasing = old_use_antialiasing
-
-  return object_colors
+  def __init__(self, args):
+    self.relations = RelationTracker(spatial=args.spatial_relations)
+    self.matrix = None
+    self.locations = None
+
+  def annotate_objects(self, camera, objects, annotate=None):
+    """
+    camera is a camera.Camera. annotate(moved) returns the pixel coordinates and
+    the bounding boxes of the objects of the indices moved; by default they are
+    computed from the dimensions of the shapes in the camera.
+    """
+    locations = np.array([ obj["location"] for obj in objects ], dtype=float)
+    if self.locations is None or self.locations.shape != locations.shape \
+       or not np.array_equal(self.matrix, camera.matrix):
+      moved = np.arange(len(objects))
+      self.pixel_coords = [None] * len(objects)
+      self.bboxes = [None] * len(objects)
+      self.matrix = camera.matrix
+    else:
+      moved = np.flatnonzero((locations != self.locations).any(axis=1))
+    self.locations = locations
+
+    if len(moved):
+      if annotate is None:
+        dimensions = np.array([ camera.dimensions(objects[i]["shape"], objects[i]["size"]) for i in moved ])
+        px, py, z = camera.project(locations[moved])
+        bboxes = camera.bboxes(locations[moved], dimensions)
+        annotations = [ ((int(x), int(y), float(d)), tuple(float(v) for v in bbox))
+                        for x, y, d, bbox in zip(px, py, z, bboxes) ]
+      else:
+        annotations = annotate(moved)
+      for i, (pixel_coords, bbox) in zip(moved, annotations):
+        self.pixel_coords[i] = pixel_coords
+        self.bboxes[i] = bbox
+    for obj, pixel_coords, bbox in zip(objects, self.pixel_coords, self.bboxes):
+      obj["pixel_coords"] = pixel_coords
+      obj["bbox"] = bbox
+
+
+def pass_statistics(index, depth, bboxes):
+  """
+  Computes the visibility of each object from the object index pass (an
+  integer array [height, width] where object k has index k+1 and the
+  background 0) and the depth pass. For each object, returns a dict with:
+
+  visible_pixels: the number of pixels where the object is visible
+  mask_bbox:      the bounding box (xmin, ymin, xmax, ymax) of the visible pixels,
+                  or None when the object is not visible
+  visibility:     visible_pixels divided by the area of the projected bounding box
+                  given in bboxes; it decreases as the object gets occluded
+  depth:          the mean depth of the visible pixels
+  """
+  num_objects = len(bboxes)
+  h, w = index.shape
+  index = index.ravel()
+  counts = np.bincount(index, minlength=num_objects+1)
+  depth_sums = np.bincount(index, weights=depth.ravel(), minlength=num_objects+1)
+
+  ys, xs = np.divmod(np.arange(h * w), w)
+  xmin = np.full(num_objects+1, w)
+  ymin = np.full(num_objects+1, h)
+  xmax = np.full(num_objects+1, -1)
+  ymax = np.full(num_objects+1, -1)
+  np.minimum.at(xmin, index, xs)
+  np.minimum.at(ymin, index, ys)
+  np.maximum.at(xmax, index, xs)
+  np.maximum.at(ymax, index, ys)
+
+  stats = []
+  for k, bbox in enumerate(bboxes, start=1):
+    visible = int(counts[k])
+    x1, y1, x2, y2 = bbox
+    area = max(x2 - x1, 1) * max(y2 - y1, 1)
+    stats.append({
+      "visible_pixels" : visible,
+      "mask_bbox"      : (int(xmin[k]), int(ymin[k]), int(xmax[k]) + 1, int(ymax[k]) + 1) if visible else None,
+      "visibility"     : float(visible / area),
+      "depth"          : float(depth_sums[k] / visible) if visible else None,
+    })
+  return stats
+
+
+def check_visibility(index, num_objects, min_pixels_per_object):
+  """
+  Check whether all objects in the scene have some minimum number of visible
+  pixels in the object index pass.
 
+  Returns True if all objects are visible and False otherwise.
+  """
+  counts = np.bincount(index.ravel(), minlength=num_objects+1)
+  return bool(np.all(counts[1:num_objects+1] >= min_pixels_per_object))
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+"""
+Packing the output files into a few large tar shards.
+
+A shard is a plain tar file (shard-<writer>-<n>.tar) whose members keep
+their path relative to the output directory, e.g.
+image_tr/000012/CLEVR_image_003.png, so that extracting the shards with tar
+gives back the usual tree. Next to each shard, an index
+(shard-<writer>-<n>.idx) has one line "offset<TAB>size<TAB>name" per member,
+appended as soon as the member is written, so that a member is read with a
+single seek even when the shard of a crashed worker was never closed.
+
+Shards are written during rendering with render_images.py --output-format
+shards, or afterwards from an existing tree:
+
+  python source/shards.py pack --output-dir output --shard-size 1024
+
+ShardReader gives random access to the members of all shards of a directory,
+e.g. reader.image(12, 3) and reader.scene(12, 3).
+"""
+
+import argparse, glob, io, json, os, socket, tarfile, time
+
+import deltas
+
+
+def image_name(i, j):
+  return "image_tr/{:06d}/CLEVR_image_{:03d}.png".format(i, j)
+
+
+def scene_name(i, j):
+  return "scene_tr/{:06d}/CLEVR_annotation_{:03d}.json".format(i, j)
+
+
+class ShardWriter(object):
+  """
+  Appends files to the shards of output_dir, starting a new shard when the
+  current one exceeds shard_size bytes. Each writer has its own shards.
+  """
+  def __init__(self, output_dir, shard_size=1 << 30, writer=None):
+    if writer is None:
+      writer = "{}-{}".format(socket.gethostname(), os.getpid())
+    self.output_dir = output_dir
+    self.shard_size = shard_size
+    self.prefix = os.path.join(output_dir, "shard-{}-".format(writer))
+    self.number = len(glob.glob(self.prefix + "*.tar"))
+    self.tar = None
+
+  def _open(self):
+    path = "{}{:05d}".format(self.prefix, self.number)
+    self.number += 1
+    self.tar = tarfile.open(path + ".tar", "w", format=tarfile.GNU_FORMAT)
+    self.index = open(path + ".idx", "w")
+
+  def add(self, name, data):
+    """Append data as the member name."""
+    if self.tar is None:
+      self._open()
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    self.tar.addfile(info, io.BytesIO(data))
+    # the data ends at the current offset, padded to the tar block size
+    blocks = (len(data) + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE
+    offset = self.tar.offset - blocks * tarfile.BLOCKSIZE
+    self.index.write("{}\t{}\t{}\n".format(offset, len(data), name))
+    if self.tar.offset >= self.shard_size:
+      self.close()
+
+  def add_file(self, path, remove=False):
+    """Append the file at path, named by its path relative to the output directory."""
+    with open(path, "rb") as f:
+      data = f.read()
+    self.add(os.path.relpath(path, self.output_dir), data)
+    if remove:
+      os.remove(path)
+
+  def flush(self):
+    """Make the members added so far durable, e.g. before recording them in the ledger."""
+    if self.tar is not None:
+      self.tar.fileobj.flush()
+      os.fsync(self.tar.fileobj.fileno())
+      self.index.flush()
+      os.fsync(self.index.fileno())
+
+  def close(self):
+    if self.tar is not None:
+      self.tar.close()
+      self.index.close()
+      self.tar = None
+
+
+class ShardReader(object):
+  """
+  Random access to the members of the shards of output_dir. When a member is
+  in several shards, e.g. a frame rendered again after a crash, the last one
+  in the order of the shard names is used.
+  """
+  def __init__(self, output_dir):
+    self.members = {}
+    for index in sorted(glob.glob(os.path.join(output_dir, "shard-*.idx"))):
+      shard = index[:-len(".idx")] + ".tar"
+      with open(index, "r") as f:
+        for line in f:
+          if not line.endswith("\n"):
+            # cut by a crash
+            break
+          offset, size, name = line[:-1].split("\t", 2)
+          self.members[name] = (shard, int(offset), int(size))
+    self.files = {}
+
+  def __contains__(self, name):
+    return name in self.members
+
+  def names(self):
+    return sorted(self.members)
+
+  def read(self, name):
+    shard, offset, size = self.members[name]
+    if shard not in self.files:
+      self.files[shard] = open(shard, "rb")
+    f = self.files[shard]
+    f.seek(offset)
+    return f.read(size)
+
+  def image(self, i, j):
+    """the PNG bytes of the frame j of the transition i"""
+    return self.read(image_name(i, j))
+
+  def scene(self, i, j):
+    """the scene structure of the frame j of the transition i, also when it is stored as a delta."""
+    name = scene_name(i, j)
+    data = json.loads(self.read(name))
+    if "base" not in data:
+      return data
+    base = json.loads(self.read(os.path.join(os.path.dirname(name), data["base"])))
+    return deltas.apply(base, data)
+
+  def close(self):
+    for f in self.files.values():
+      f.close()
+    self.files = {}
+
+
+def pack(output_dir, shard_size, remove=False):
+  """Pack the files of image_tr and scene_tr of output_dir into shards, transition by transition."""
+  writer = ShardWriter(output_dir, shard_size, writer="packed")
+  transitions = sorted(set(os.listdir(os.path.join(output_dir, "image_tr"))) |
+                       set(os.listdir(os.path.join(output_dir, "scene_tr"))))
+  for transition in transitions:
+    for top in ["image_tr", "scene_tr"]:
+      directory = os.path.join(output_dir, top, transition)
+      if not os.path.isdir(directory):
+        continue
+      for name in sorted(os.listdir(directory)):
+        writer.add_file(os.path.join(directory, name), remove)
+      if remove:
+        os.rmdir(directory)
+  writer.close()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Pack the output files into tar shards, or read a member of the shards.")
+  subparsers = parser.add_subparsers(dest="command")
+  p = subparsers.add_parser("pack", help="Pack image_tr and scene_tr of an output directory into shards.")
+  p.add_argument('--output-dir', default='output')
+  p.add_argument('--shard-size', default=1024, type=int,
+                 help="The size of a shard in MB.")
+  p.add_argument('--remove', action="store_true",
+                 help="Remove the files once they are packed.")
+  p = subparsers.add_parser("cat", help="Write a member of the shards to stdout.")
+  p.add_argument('--output-dir', default='output')
+  p.add_argument('name', help="The path of the member, e.g. image_tr/000012/CLEVR_image_003.png")
+  args = parser.parse_args()
+  if args.command == "pack":
+    pack(args.output_dir, args.shard_size << 20, args.remove)
+  elif args.command == "cat":
+    import sys
+    sys.stdout.buffer.write(ShardReader(args.output_dir).read(args.name))
+  else:
+    parser.print_help()
@@ -0,0 +1,231 @@
+"""
+Versioned encodings of blocks.State, without eval.
+
+Two encodings are provided:
+
+* encode / decode: a compact JSON record storing the blocks column by column,
+
+    {"version": 1, "table_size": 5, "object_jitter": 0.0, "last_action": "action_move",
+     "objects": {"id": [...], "shape": [...], "color": [...], ...}}
+
+  decode also accepts the records written by blocks.dump before the codec existed.
+
+* pack / unpack: a binary encoding of many states with the same number of
+  blocks, as fixed-layout NumPy records. The strings (shapes, materials,
+  actions) are replaced by indices into a vocabulary stored in the header.
+  All states are encoded and decoded at once.
+
+save / load and save_many / load_many read and write files in these encodings.
+"""
+
+import json, struct
+import numpy as np
+from blocks import State, Block, undump
+
+VERSION = 1
+
+# the attributes of a Block, in the order of the records
+BLOCK_FIELDS = ("id", "shape", "color", "size", "material", "rotation", "stackable", "location")
+
+MAGIC = b"BWST"
+
+BLOCK_DTYPE = np.dtype([
+  ("id",        "<i4"),
+  ("shape",     "<u2"),
+  ("material",  "<u2"),
+  ("color",     "<f8", (4,)),
+  ("size",      "<f8"),
+  ("rotation",  "<f8"),
+  ("stackable", "u1"),
+  ("location",  "<f8", (3,)),
+])
+
+# last_action is NO_ACTION when the state has no action
+STATE_DTYPE = np.dtype([
+  ("table_size",    "<i4"),
+  ("object_jitter", "<f8"),
+  ("last_action",   "<u2"),
+])
+
+NO_ACTION = 0xFFFF
+
+
+def _location(o):
+  if hasattr(o.location, "tolist"):
+    # a view over a numpy array
+    return o.location.tolist()
+  return list(o.location)
+
+
+def _block(values):
+  res = Block.__new__(Block)
+  vars(res).update(values)
+  return res
+
+
+def encode(state):
+  """Returns the compact JSON record of a State."""
+  objects = state.objects
+  res = {
+    "version"       : VERSION,
+    "table_size"    : state.table_size,
+    "object_jitter" : state.object_jitter,
+    "objects"       : {
+      "id"        : [ o.id for o in objects ],
+      "shape"     : [ o.shape for o in objects ],
+      "color"     : [ list(o.color) for o in objects ],
+      "size"      : [ o.size for o in objects ],
+      "material"  : [ o.material for o in objects ],
+      "rotation"  : [ o.rotation for o in objects ],
+      "stackable" : [ o.stackable for o in objects ],
+      "location"  : [ _location(o) for o in objects ],
+    },
+  }
+  if hasattr(state, "last_action"):
+    res["last_action"] = state.last_action
+  if hasattr(state, "plan"):
+    res["plan"] = state.plan
+  return res
+
+
+def decode(data):
+  """Returns the State of a record written by encode, or by blocks.dump."""
+  if "version" not in data:
+    return undump(data)
+  if data["version"] > VERSION:
+    raise ValueError("state record version {} is newer than the supported version {}"
+                     .format(data["version"], VERSION))
+  res = State.__new__(State)
+  res.table_size = data["table_size"]
+  res.object_jitter = data["object_jitter"]
+  columns = data["objects"]
+  columns = dict(columns, color=[ tuple(c) for c in columns["color"] ])
+  res.objects = [ _block(zip(BLOCK_FIELDS, values))
+                  for values in zip(*(columns[k] for k in BLOCK_FIELDS)) ]
+  if "last_action" in data:
+    res.last_action = data["last_action"]
+  if "plan" in data:
+    res.plan = data["plan"]
+  return res
+
+
+def save(path, state):
+  with open(path, "w") as f:
+    json.dump(encode(state), f, separators=(",", ":"))
+
+
+def load(path):
+  with open(path, "r") as f:
+    return decode(json.load(f))
+
+
+def pack(states):
+  """
+  Returns the binary encoding of a list of states, which must have the same
+  number of blocks and the same number of plan steps.
+
+  layout: MAGIC, the length of the header (uint32), the JSON header,
+  then the state records, the block records [states, blocks] and the plans
+  [states, steps, blocks, 3] (float64).
+  """
+  num_objects = len(states[0].objects) if states else 0
+  num_steps = len(getattr(states[0], "plan", [])) if states else 0
+  if any(len(s.objects) != num_objects or len(getattr(s, "plan", [])) != num_steps for s in states):
+    raise ValueError("pack requires states with the same number of blocks and plan steps")
+
+  shapes    = sorted({ o.shape for s in states for o in s.objects })
+  materials = sorted({ o.material for s in states for o in s.objects })
+  actions   = sorted({ s.last_action for s in states if hasattr(s, "last_action") })
+  shape_ids    = { v:i for i, v in enumerate(shapes) }
+  material_ids = { v:i for i, v in enumerate(materials) }
+  action_ids   = { v:i for i, v in enumerate(actions) }
+
+  state_records = np.zeros(len(states), dtype=STATE_DTYPE)
+  state_records["table_size"] = [ s.table_size for s in states ]
+  state_records["object_jitter"] = [ s.object_jitter for s in states ]
+  state_records["last_action"] = [ action_ids[s.last_action] if hasattr(s, "last_action") else NO_ACTION
+                                   for s in states ]
+
+  objects = [ o for s in states for o in s.objects ]
+  block_records = np.zeros(len(objects), dtype=BLOCK_DTYPE)
+  block_records["id"]        = [ o.id for o in objects ]
+  block_records["shape"]     = [ shape_ids[o.shape] for o in objects ]
+  block_records["material"]  = [ material_ids[o.material] for o in objects ]
+  block_records["color"]     = np.reshape([ o.color for o in objects ], (-1, 4))
+  block_records["size"]      = [ o.size for o in objects ]
+  block_records["rotation"]  = [ o.rotation for o in objects ]
+  block_records["stackable"] = [ o.stackable for o in objects ]
+  block_records["location"]  = np.reshape([ _location(o) for o in objects ], (-1, 3))
+
+  plans = np.array([ getattr(s, "plan", []) for s in states ], dtype="<f8")
+
+  header = json.dumps({
+    "version"     : VERSION,
+    "num_states"  : len(states),
+    "num_objects" : num_objects,
+    "num_steps"   : num_steps,
+    "shapes"      : shapes,
+    "materials"   : materials,
+    "actions"     : actions,
+  }, separators=(",", ":")).encode()
+  return b"".join([MAGIC, struct.pack("<I", len(header)), header,
+                   state_records.tobytes(), block_records.tobytes(), plans.tobytes()])
+
+
+def unpack(buf):
+  """Returns the list of states encoded by pack."""
+  if buf[:4] != MAGIC:
+    raise ValueError("not a packed state file")
+  header_size, = struct.unpack_from("<I", buf, 4)
+  offset = 8 + header_size
+  header = json.loads(bytes(buf[8:offset]))
+  if header["version"] > VERSION:
+    raise ValueError("packed state version {} is newer than the supported version {}"
+                     .format(header["version"], VERSION))
+  n, m, k = header["num_states"], header["num_objects"], header["num_steps"]
+
+  state_records = np.frombuffer(buf, dtype=STATE_DTYPE, count=n, offset=offset)
+  offset += state_records.nbytes
+  block_records = np.frombuffer(buf, dtype=BLOCK_DTYPE, count=n*m, offset=offset)
+  offset += block_records.nbytes
+  plans = np.frombuffer(buf, dtype="<f8", count=n*k*m*3, offset=offset).reshape(n, k, m, 3)
+
+  # convert each column at once, then build the blocks from plain python values
+  shapes    = np.array(header["shapes"] or [""], dtype=object)
+  materials = np.array(header["materials"] or [""], dtype=object)
+  columns = {
+    "id"        : block_records["id"].tolist(),
+    "shape"     : shapes[block_records["shape"]].tolist(),
+    "color"     : list(map(tuple, block_records["color"].tolist())),
+    "size"      : block_records["size"].tolist(),
+    "material"  : materials[block_records["material"]].tolist(),
+    "rotation"  : block_records["rotation"].tolist(),
+    "stackable" : block_records["stackable"].astype(bool).tolist(),
+    "location"  : block_records["location"].tolist(),
+  }
+  blocks = [ _block(zip(BLOCK_FIELDS, values))
+             for values in zip(*(columns[f] for f in BLOCK_FIELDS)) ]
+
+  states = []
+  for i, record in enumerate(state_records.tolist()):
+    table_size, object_jitter, last_action = record
+    s = State.__new__(State)
+    s.table_size = table_size
+    s.object_jitter = object_jitter
+    s.objects = blocks[i*m:(i+1)*m]
+    if last_action != NO_ACTION:
+      s.last_action = header["actions"][last_action]
+    if k:
+      s.plan = plans[i].tolist()
+    states.append(s)
+  return states
+
+
+def save_many(path, states):
+  with open(path, "wb") as f:
+    f.write(pack(states))
+
+
+def load_many(path):
+  with open(path, "rb") as f:
+    return unpack(f.read())
@@ -0,0 +1,40 @@
+"""
+Random streams derived from the seed of a run.
+
+Each transition draws from its own streams, so that its content depends only
+on the run seed and its index, and not on the worker that renders it or on
+what that worker did before:
+
+  logic:   the sampled states and actions, one stream per transition
+  wiggle:  the x jitter of the blocks, one stream per frame
+  lights:  the jitter of the lamps, one stream per frame
+  camera:  the jitter of the camera, one stream per frame
+
+A single frame can therefore be generated again alone, e.g. to render it again.
+With the seed None, all streams are the global random module, as before
+(render_images.py and generate_transitions.py both default to the seed 0).
+"""
+
+import random
+
+STREAMS = ("logic", "wiggle", "lights", "camera")
+
+
+def stream(seed, idx, name, frame=None):
+  """returns the random.Random of the stream name of the transition idx, or of one of its frames."""
+  if name not in STREAMS:
+    raise ValueError("unknown stream {}".format(name))
+  if seed is None:
+    return random
+  if frame is None:
+    return random.Random("{}:{}:{}".format(seed, idx, name))
+  return random.Random("{}:{}:{}:{}".format(seed, idx, name, frame))
+
+
+def logic(seed, idx):
+  return stream(seed, idx, "logic")
+
+
+def frame(seed, idx, j):
+  """returns the wiggle, lights and camera streams of the j-th frame of the transition idx."""
+  return { name : stream(seed, idx, name, j) for name in ("wiggle", "lights", "camera") }
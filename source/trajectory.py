@@ -0,0 +1,74 @@
+"""
+Computing the object positions of all frames of a transition at once.
+
+A move is animated in three phases: the moving objects are lifted to the
+operation level, carried horizontally above their destination, and placed.
+The frames are spread evenly over the phases of all moves, from the first
+state to the last one.
+The positions of every frame are returned as a single array
+[frames, objects, 3], so that thousands of frame layouts can be computed
+per second without building intermediate states.
+"""
+
+import numpy as np
+
+EASINGS = {
+  "linear"     : (lambda t: t),
+  "smoothstep" : (lambda t: t * t * (3 - 2 * t)),
+  "sine"       : (lambda t: (1 - np.cos(np.pi * t)) / 2),
+}
+
+
+def operate_level(keyframes, sizes):
+  """the height at which the objects are carried: above the tallest object by 4 times the largest size."""
+  return max(np.max(np.asarray(k)[:, 2]) for k in keyframes) + 4 * np.max(sizes)
+
+
+def keys(pre, suc, level, active_threshold=.5):
+  """
+  Returns the positions [4, objects, 3] at the ends of the phases of a move
+  from pre to suc (both [objects, 3]): pre, lifted, carried and suc. The
+  objects that move by at least active_threshold are lifted to the height
+  level, carried and placed; the others stay where they are.
+  """
+  pre = np.asarray(pre, dtype=float)
+  suc = np.asarray(suc, dtype=float)
+  active = np.linalg.norm(suc - pre, axis=-1) >= active_threshold
+
+  # 1. lifted up until the operation level
+  lifted = pre.copy()
+  lifted[active, 2] = level
+  # 2. moved horizontally on the operation level
+  carried = lifted.copy()
+  carried[active, 0:2] = suc[active, 0:2]
+  return np.stack([pre, lifted, carried, suc])
+
+
+def plan(keyframes, num_frames, level, easing="linear", active_threshold=.5):
+  """
+  Returns the positions [num_frames, objects, 3] of a chain of moves through
+  keyframes (a list of position arrays [objects, 3], one per state of the plan).
+  The phases of all moves are laid end to end and sampled at num_frames evenly
+  spaced points, so that the first frame is keyframes[0] and, with 2 frames or
+  more, the last frame is keyframes[-1].
+  easing is a name in EASINGS or a function mapping [0,1] to [0,1], applied within each phase.
+  """
+  if isinstance(easing, str):
+    easing = EASINGS[easing]
+  path = np.concatenate([
+    keys(pre, suc, level, active_threshold)[:-1]
+    for pre, suc in zip(keyframes[:-1], keyframes[1:])
+  ] + [ np.asarray(keyframes[-1], dtype=float)[None] ])
+
+  num_phases = len(path) - 1
+  s = np.linspace(0.0, num_phases, num_frames)
+  phase = np.minimum(np.floor(s).astype(int), num_phases - 1)
+  t = easing(s - phase)[:, None, None]
+
+  start, end = path[phase], path[phase+1]
+  return start + t * (end - start)
+
+
+def move(pre, suc, num_frames, level, easing="linear", active_threshold=.5):
+  """Returns the positions [num_frames, objects, 3] of the objects moving from pre to suc, see plan."""
+  return plan([pre, suc], num_frames, level, easing, active_threshold)
@@ -117,6 +117,54 @@ def add_object(object_dir, name, scale, loc, theta=0):
   bpy.ops.transform.translate(value=tuple(loc))
 
 
+def load_object(object_dir, name):
+  """
+  Load an object from "$name.blend" in object_dir without adding it to the
+  scene, and return it. The object is kept even when it has no users so that
+  it can be copied later.
+  """
+  filename = os.path.join(object_dir, '%s.blend' % name)
+  with bpy.data.libraries.load(filename) as (data_from, data_to):
+    data_to.objects = [name]
+  obj = data_to.objects[0]
+  obj.use_fake_user = True
+  return obj
+
+
+def link_object(obj):
+  """ Add an object to the current scene """
+  if bpy.app.version < (2, 80, 0):
+    bpy.context.scene.objects.link(obj)
+  else:
+    bpy.context.scene.collection.objects.link(obj)
+
+
+def make_active(obj):
+  """ Select an object and make it the active object """
+  if bpy.app.version < (2, 80, 0):
+    obj.select = True
+    bpy.context.scene.objects.active = obj
+  else:
+    obj.select_set( state = True, view_layer = bpy.context.view_layer )
+    bpy.context.view_layer.objects.active = obj
+
+
+def update_scene():
+  """ Recompute the derived data (e.g. matrix_world) of the current scene """
+  if bpy.app.version < (2, 80, 0):
+    bpy.context.scene.update()
+  else:
+    bpy.context.view_layer.update()
+
+
+def purge_orphans():
+  """ Remove the meshes, materials and animations that are no longer used by any object """
+  for collection in (bpy.data.meshes, bpy.data.materials, bpy.data.actions):
+    for block in list(collection):
+      if block.users == 0:
+        collection.remove(block)
+
+
 def load_materials(material_dir):
   """
   Load materials from a directory. We assume that the directory contains .blend
@@ -135,6 +183,20 @@ def add_material(name, **properties):
   Create a new material and assign it to the active object. "name" should be the
   name of a material that has been previously loaded using load_materials.
   """
+  mat = new_material(name, **properties)
+
+  # Attach the new material to the active object
+  # Make sure it doesn't already have materials
+  obj = bpy.context.active_object
+  assert len(obj.data.materials) == 0
+  obj.data.materials.append(mat)
+
+
+def new_material(name, **properties):
+  """
+  Create a new material that is not attached to any object. "name" should be the
+  name of a material that has been previously loaded using load_materials.
+  """
   # Figure out how many materials are already in the scene
   mat_count = len(bpy.data.materials)
 
@@ -148,12 +210,6 @@ def add_material(name, **properties):
   mat = bpy.data.materials['Material']
   mat.name = 'Material_%d' % mat_count
 
-  # Attach the new material to the active object
-  # Make sure it doesn't already have materials
-  obj = bpy.context.active_object
-  assert len(obj.data.materials) == 0
-  obj.data.materials.append(mat)
-
   # Find the output node of the new material
   output_node = None
   for n in mat.node_tree.nodes:
@@ -180,4 +236,4 @@ def add_material(name, **properties):
       group_node.outputs['Shader'],
       output_node.inputs['Surface'],
   )
-
+  return mat
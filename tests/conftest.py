@@ -0,0 +1,71 @@
+import json, os, sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "source"))
+
+SHAPES = ["SmoothCylinder", "SmoothCube_v2"]
+COLORS = [[1.0, 0.0, 0.0, 1.0], [0.0, 0.0, 1.0, 1.0], [0.0, 1.0, 0.0, 1.0]]
+
+
+def random_scene(rng, num_objects, size=0.7):
+  """a scene structure of num_objects blocks in random towers, and the table as the last object"""
+  order = rng.permutation(num_objects)
+  towers = np.split(order, np.sort(rng.choice(np.arange(1, num_objects), rng.integers(num_objects), replace=False)))
+  below = [None] * num_objects
+  height = [0] * num_objects
+  x = [0.0] * num_objects
+  for t, tower in enumerate(towers):
+    for h, i in enumerate(tower):
+      below[i] = int(tower[h-1]) if h else num_objects
+      height[i] = h
+      x[i] = 1.5 * t
+  covered = { b for b in below }
+  objects = [
+    {
+      "shape"        : SHAPES[int(rng.integers(len(SHAPES)))],
+      "color"        : COLORS[int(rng.integers(len(COLORS)))],
+      "size"         : size,
+      "material"     : "MyMetal",
+      "rotation"     : float(rng.uniform(0, 360)),
+      "stackable"    : True,
+      "location"     : [x[i], 0.0, size * (2 * height[i] + 1)],
+      "id"           : i,
+      "pixel_coords" : [int(rng.integers(300)), int(rng.integers(200)), float(rng.uniform(5, 10))],
+      "bbox"         : [float(v) for v in sorted(rng.integers(0, 300, 2))] * 2,
+    }
+    for i in range(num_objects)
+  ]
+  objects.append(dict(objects[0], location=[0, 0, 0], id=num_objects, stackable=True))
+  return {
+    "image_filename" : "CLEVR_image_000.png",
+    "objects"        : objects,
+    "directions"     : {"left": [-1, 0, 0]},
+    "relationships"  : {
+      "on"    : [ [below[i]] for i in range(num_objects) ],
+      "clear" : [ [] if i in covered else [i] for i in range(num_objects) ],
+    },
+  }
+
+
+def write_scenes(output_dir, num_transitions=8, num_frames=3, num_objects=4, seed=0):
+  """writes random scenes into output_dir/scene_tr, returns {(transition, frame): scene}"""
+  rng = np.random.default_rng(seed)
+  res = {}
+  for i in range(num_transitions):
+    directory = os.path.join(output_dir, "scene_tr", "{:06d}".format(i))
+    os.makedirs(directory, exist_ok=True)
+    for j in range(num_frames):
+      scene = random_scene(rng, num_objects)
+      scene["image_filename"] = "CLEVR_image_{:03d}.png".format(j)
+      with open(os.path.join(directory, "CLEVR_annotation_{:03d}.json".format(j)), "w") as f:
+        json.dump(scene, f)
+      res[(i, j)] = scene
+  return res
+
+
+@pytest.fixture
+def scenes(tmp_path):
+  """an output directory of random scenes, and the scenes"""
+  output_dir = str(tmp_path / "output")
+  return output_dir, write_scenes(output_dir)
@@ -0,0 +1,27 @@
+import time
+import annotation_store
+from conftest import write_scenes
+
+
+def test_store_equals_json(scenes):
+  output_dir, expected = scenes
+  store = annotation_store.open_store(output_dir)
+  assert len(store) == len(expected)
+  for (i, j), scene in expected.items():
+    actual = store.scene(store.index(i, j))
+    del scene["directions"]
+    assert actual == scene
+
+
+def test_store_is_consolidated_again(scenes):
+  output_dir, _ = scenes
+  store = annotation_store.open_store(output_dir)
+  assert annotation_store.open_store(output_dir).meta == store.meta
+  # more transitions, and the frames written again with other scenes
+  time.sleep(0.01)
+  expected = write_scenes(output_dir, num_transitions=10, seed=1)
+  store = annotation_store.open_store(output_dir)
+  assert len(store) == len(expected)
+  for (i, j), scene in expected.items():
+    del scene["directions"]
+    assert store.scene(store.index(i, j)) == scene
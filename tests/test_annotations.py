@@ -0,0 +1,42 @@
+import copy
+import numpy as np
+from camera import Camera
+import annotations
+import render_utils
+
+
+def camera():
+  # looking down -y from (0, -20, 5)
+  matrix = [[1, 0, 0, 0], [0, 0, 1, -20], [0, -1, 0, 5], [0, 0, 0, 1]]
+  frame = [[1, 0.75, -2], [1, -0.75, -2], [-1, -0.75, -2]]
+  return Camera(matrix, frame, False, (300, 200), {"SmoothCylinder": [2, 2, 2]})
+
+
+def trajectory():
+  objects = [ {"shape": "SmoothCylinder", "size": 0.7, "location": [1.5 * i, 0.0, 0.7]} for i in range(3) ]
+  res = []
+  for z in [0.7, 1.5, 3.0, 3.0, 2.1]:
+    objects = copy.deepcopy(objects)
+    objects[1]["location"] = [1.5, 0.0, z]
+    res.append(objects)
+  return res
+
+
+def test_tracker_matches_annotate_objects():
+  tracker = render_utils.AnnotationTracker(type("args", (), {"spatial_relations": False}))
+  for objects in trajectory():
+    expected = copy.deepcopy(objects)
+    annotations.annotate_objects(camera(), expected)
+    tracker.annotate_objects(camera(), objects)
+    assert objects == expected
+
+
+def test_tracker_annotates_only_moved_objects():
+  tracker = render_utils.AnnotationTracker(type("args", (), {"spatial_relations": False}))
+  calls = []
+  def annotate(moved):
+    calls.append(list(moved))
+    return [ ((0, 0, 0.0), (0.0, 0.0, 1.0, 1.0)) for i in moved ]
+  for objects in trajectory():
+    tracker.annotate_objects(camera(), objects, annotate)
+  assert calls == [[0, 1, 2], [1], [1], [1]]
@@ -0,0 +1,54 @@
+import os
+import pytest
+from blocks import State, Unstackable, load_colors
+import generate_transitions
+import streams
+
+PROPERTIES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "properties.json")
+
+
+def parse(*argv):
+  args = generate_transitions.parser.parse_args(["--properties-json", PROPERTIES, *argv])
+  load_colors(args)
+  return args
+
+
+def sample_with_state(args, rng):
+  # sample_transition before it sampled with ArrayState
+  pre = State(args, rng)
+  suc = pre.clone()
+  plan = []
+  for j in range(args.num_steps):
+    if j > 0:
+      plan.append(suc.positions().tolist())
+    suc.random_action(rng)
+  if plan:
+    suc.plan = plan
+  return pre, suc
+
+
+def sample(sampler, args, idx):
+  rng = streams.logic(0, idx)
+  while True:
+    try:
+      return sampler(args, rng)
+    except Unstackable:
+      pass
+
+
+@pytest.mark.parametrize("argv", [
+  ("--num-objects", "3"),
+  ("--num-objects", "8", "--num-steps", "4"),
+  ("--num-objects", "6", "--table-size", "3", "--num-steps", "3"),
+])
+def test_sample_transition_same_as_state(argv):
+  args = parse(*argv)
+  for idx in range(50):
+    expected = sample(sample_with_state, args, idx)
+    actual = sample(generate_transitions.sample_transition, args, idx)
+    for e, a in zip(expected, actual):
+      assert a.dump() == e.dump()
+      assert a.for_rendering() == e.for_rendering()
+      assert (a.positions() == e.positions()).all()
+    assert actual[1].last_action == expected[1].last_action
+    assert getattr(actual[1], "plan", None) == getattr(expected[1], "plan", None)
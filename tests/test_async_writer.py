@@ -0,0 +1,30 @@
+import io
+from types import SimpleNamespace
+import imageio
+import numpy as np
+import pytest
+import async_writer
+import render_utils
+
+
+def scene(**view):
+  settings = dict(view_transform="Standard", look="None", exposure=0.0, gamma=1.0, use_curve_mapping=False)
+  settings.update(view)
+  return SimpleNamespace(view_settings=SimpleNamespace(**settings),
+                         display_settings=SimpleNamespace(display_device="sRGB"))
+
+
+def test_color_management():
+  render_utils.check_color_management(scene())
+  render_utils.check_color_management(scene(view_transform="Default"))
+  for view in [dict(view_transform="Filmic"), dict(look="Filmic - High Contrast"), dict(exposure=1.0)]:
+    with pytest.raises(ValueError):
+      render_utils.check_color_management(scene(**view))
+
+
+def test_png_roundtrip(tmp_path):
+  rng = np.random.default_rng(0)
+  for channels in [3, 4]:
+    pixels = rng.random((20, 30, channels))
+    data = async_writer.encode_png(async_writer.srgb(pixels))
+    assert np.array_equal(imageio.imread(io.BytesIO(data)), async_writer.srgb(pixels))
@@ -0,0 +1,51 @@
+import numpy as np
+import skimage.transform
+from skimage import img_as_ubyte
+from crop_resize import crop_resize
+
+
+def expected(images, frames, bboxes, shape):
+  # as extract_all_regions_binary.py before crop_resize
+  return np.stack([
+    img_as_ubyte(np.clip(skimage.transform.resize(images[f, y1:y2, x1:x2], (*shape, images.shape[-1])), 0.0, 1.0))
+    for f, (x1, y1, x2, y2) in zip(frames, bboxes)
+  ])
+
+
+def regions(rng, images, num):
+  _, height, width, _ = images.shape
+  x = np.sort(rng.choice(width + 1, (num, 2)), axis=1)
+  y = np.sort(rng.choice(height + 1, (num, 2)), axis=1)
+  # non-empty
+  x[:, 1] = np.maximum(x[:, 1], x[:, 0] + 1)
+  y[:, 1] = np.maximum(y[:, 1], y[:, 0] + 1)
+  x[:, 0] = np.minimum(x[:, 0], width - 1)
+  y[:, 0] = np.minimum(y[:, 0], height - 1)
+  x[:, 1] = np.minimum(x[:, 1], width)
+  y[:, 1] = np.minimum(y[:, 1], height)
+  frames = rng.integers(len(images), size=num)
+  return frames, np.stack([x[:, 0], y[:, 0], x[:, 1], y[:, 1]], axis=1)
+
+
+def test_float_images():
+  rng = np.random.default_rng(0)
+  images = rng.random((4, 60, 80, 3))
+  frames, bboxes = regions(rng, images, 200)
+  for shape in [(8, 8), (16, 12)]:
+    assert np.array_equal(crop_resize(images, frames, bboxes, shape), expected(images, frames, bboxes, shape))
+
+
+def test_8bit_images():
+  # the same up to the rounding of values close to a half of 1/255
+  rng = np.random.default_rng(0)
+  images = rng.integers(256, size=(4, 60, 80, 4)) / 255
+  frames, bboxes = regions(rng, images, 200)
+  actual = crop_resize(images, frames, bboxes, (8, 8), max_pixels=1 << 12).astype(int)
+  diff = np.abs(actual - expected(images, frames, bboxes, (8, 8)))
+  assert diff.max() <= 1
+  assert diff.mean() < 1e-2
+
+
+def test_no_region():
+  images = np.zeros((1, 10, 10, 3))
+  assert crop_resize(images, [], [], (8, 8)).shape == (0, 8, 8, 3)
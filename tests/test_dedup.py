@@ -0,0 +1,28 @@
+import dedup
+from test_state_codec import transitions
+
+
+def test_keys_ignore_ids_and_order():
+  (pre, suc), = transitions(1, "--num-objects", "5", "--object-jitter", "0.2")
+  shuffled = pre.clone()
+  shuffled.objects = shuffled.objects[::-1]
+  for i, o in enumerate(shuffled.objects):
+    o.id = i
+    o.rotation += 10
+  assert dedup.state_key(shuffled) == dedup.state_key(pre)
+  assert dedup.transition_key(pre, suc) != dedup.transition_key(suc, pre)
+
+
+def test_index(tmp_path):
+  index = dedup.DedupIndex(str(tmp_path))
+  assert index.add("k0", 0)
+  assert index.add("k0", 0)
+  assert index.add("k1", 1)
+  assert not index.add("k0", 2)
+  assert not index.add("k0", 3)
+  assert len(index) == 2 and "k0" in index and index.duplicates() == 2
+  index.forget(0)
+  assert "k0" not in index
+  assert index.add("k0", 2)
+  index.close()
+  assert len(dedup.DedupIndex(str(tmp_path))) == 2
@@ -0,0 +1,59 @@
+import socket, subprocess, sys
+from ledger import Ledger
+
+
+def test_claim(tmp_path):
+  a = Ledger(str(tmp_path), worker="a")
+  b = Ledger(str(tmp_path), worker="b")
+  assert a.claim(0)
+  assert a.claim(0)
+  assert not b.claim(0)
+  assert b.claim(1)
+  a.release(0)
+  assert b.claim(0)
+  a.close(); b.close()
+
+
+def test_expired_claim(tmp_path):
+  a = Ledger(str(tmp_path), worker="a", lease=0.0)
+  b = Ledger(str(tmp_path), worker="b")
+  assert a.claim(0)
+  # a crashed: its lease expired
+  assert b.claim(0)
+  assert not a.claim(0)
+  b.release_all()
+  assert a.claim(0)
+  a.close(); b.close()
+
+
+def test_resume(tmp_path):
+  a = Ledger(str(tmp_path), worker="a", lease=0.0)
+  assert a.claim(3)
+  a.frame_done(3, 0)
+  a.frame_done(3, 1)
+  a.frame_done(3, 1)
+  a.close()
+
+  b = Ledger(str(tmp_path), worker="b")
+  assert b.claim(3)
+  assert b.done_frames(3) == {0, 1}
+  assert b.done_frames(4) == set()
+  b.frame_done(3, 2)
+  b.finish(3)
+  assert b.done() == {3}
+  assert not b.claim(3)
+  b.close()
+  assert Ledger(str(tmp_path), worker="c").done() == {3}
+
+
+def test_release_dead(tmp_path):
+  # a worker of this host whose process is no longer running
+  process = subprocess.Popen([sys.executable, "-c", "pass"])
+  process.wait()
+  dead = Ledger(str(tmp_path), worker="{}:{}".format(socket.gethostname(), process.pid))
+  alive = Ledger(str(tmp_path))
+  assert dead.claim(0)
+  assert not alive.claim(0)
+  alive.release_dead()
+  assert alive.claim(0)
+  dead.close(); alive.close()
@@ -0,0 +1,65 @@
+import numpy as np
+import annotation_store
+import query
+
+
+def test_negated_variable_is_negation_as_failure(scenes):
+  output_dir, _ = scenes
+  index = query.QueryIndex(annotation_store.open_store(output_dir))
+  for j in range(4):
+    _, nothing_on = index.query("!on(X,{})".format(j))
+    _, clear = index.query("clear({})".format(j))
+    assert np.array_equal(nothing_on, clear)
+
+
+def holds(scene, name, args):
+  # the fact name(args) in the scene structure
+  objects = scene["objects"]
+  table = len(scene["relationships"]["on"])
+  if name in ("shape", "material"):
+    return objects[int(args[0])][name] == args[1]
+  related = scene["relationships"][name][int(args[0])]
+  if name == "clear":
+    return bool(related)
+  return (table if args[1] == "table" else int(args[1])) in related
+
+
+def solutions(scene, atoms, binding):
+  # the bindings extending binding, with distinct objects, under which all atoms hold
+  if not atoms:
+    yield binding
+    return
+  name, args = atoms[0]
+  free = [ a for a in (args[:1] if name in ("shape", "material") else args) if a[:1].isupper() and a not in binding ]
+  if free:
+    for o in range(len(scene["relationships"]["on"])):
+      if str(o) not in binding.values():
+        yield from solutions(scene, atoms, dict(binding, **{ free[0] : str(o) }))
+  elif holds(scene, name, tuple(binding.get(a, a) for a in args)):
+    yield from solutions(scene, atoms[1:], binding)
+
+
+def brute_force(scene, atoms):
+  positive = [ (name, args) for neg, name, args in atoms if not neg ]
+  negative = [ (name, args) for neg, name, args in atoms if neg ]
+  return any(
+    not any(next(solutions(scene, [atom], binding), None) is not None for atom in negative)
+    for binding in solutions(scene, positive, {})
+  )
+
+
+def test_query_matches_brute_force(scenes):
+  output_dir, expected = scenes
+  store = annotation_store.open_store(output_dir)
+  index = query.QueryIndex(store)
+  for text in ["on(X,Y) shape(X,SmoothCylinder) shape(Y,SmoothCube_v2)",
+               "on(X,table) clear(X) shape(X,SmoothCube_v2)",
+               "clear(2) !on(2,table)",
+               "on(X,Y) on(Y,Z) !clear(X)",
+               "on(X,Y) !on(Y,table)",
+               "clear(X) !on(X,Y)"]:
+    atoms = [ (neg, name, args) for neg, _, name, args in query.parse(text) ]
+    kind, rows = index.query(text)
+    assert kind == "frame"
+    assert rows.tolist() == sorted( store.index(i, j) for (i, j), scene in expected.items()
+                                    if brute_force(scene, atoms) ), text
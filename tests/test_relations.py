@@ -0,0 +1,18 @@
+import render_utils
+
+
+def block(x, z, size=0.7):
+  return {"location": [x, 0.0, z], "size": size}
+
+
+def test_on_table_and_stacks():
+  # 0 on the table, 1 on 0, 2 on the table, then the table object
+  scene = {"objects": [block(0.0, 0.7), block(0.0, 2.1), block(3.0, 0.7), block(0.0, 0.0)]}
+  relationships = render_utils.compute_all_relationships(scene)
+  assert relationships["on"] == [[3], [0], [3]]
+  assert relationships["clear"] == [[], [1], [2]]
+
+
+def test_lifted_block_is_not_on_the_table():
+  scene = {"objects": [block(0.0, 0.7), block(3.0, 5.0), block(0.0, 0.0)]}
+  assert render_utils.compute_all_relationships(scene)["on"] == [[2], []]
@@ -0,0 +1,44 @@
+import os, tarfile
+import numpy as np
+import shards
+
+
+def test_offsets(tmp_path):
+  output_dir = str(tmp_path)
+  rng = np.random.default_rng(0)
+  files = { shards.image_name(i, j) : rng.bytes(int(rng.integers(1, 3000))) for i in range(3) for j in range(3) }
+  writer = shards.ShardWriter(output_dir, shard_size=8192, writer="test")
+  for name, data in files.items():
+    writer.add(name, data)
+  writer.close()
+
+  reader = shards.ShardReader(output_dir)
+  assert reader.names() == sorted(files)
+  assert len({ shard for shard, _, _ in reader.members.values() }) > 1
+  for name, data in files.items():
+    assert name in reader
+    assert reader.read(name) == data
+    # the offsets point at the data of the members of the plain tar files
+    shard, offset, size = reader.members[name]
+    with tarfile.open(shard) as tar:
+      info = tar.getmember(name)
+      assert (info.offset_data, info.size) == (offset, size)
+  assert reader.image(1, 2) == files[shards.image_name(1, 2)]
+  reader.close()
+
+
+def test_cut_index_line_is_ignored(tmp_path):
+  output_dir = str(tmp_path)
+  writer = shards.ShardWriter(output_dir, writer="test")
+  writer.add(shards.image_name(0, 0), b"first")
+  writer.add(shards.image_name(0, 1), b"second")
+  writer.close()
+  index, = [ os.path.join(output_dir, f) for f in os.listdir(output_dir) if f.endswith(".idx") ]
+  with open(index, "r") as f:
+    text = f.read()
+  with open(index, "w") as f:
+    f.write(text[:-3])
+  reader = shards.ShardReader(output_dir)
+  assert reader.names() == [shards.image_name(0, 0)]
+  assert reader.read(shards.image_name(0, 0)) == b"first"
+  reader.close()
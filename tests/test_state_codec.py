@@ -0,0 +1,69 @@
+import os
+import pytest
+from blocks import State, Unstackable, load_colors
+import generate_transitions
+import state_codec
+import streams
+
+PROPERTIES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "properties.json")
+
+
+def transitions(num, *argv):
+  args = generate_transitions.parser.parse_args(["--properties-json", PROPERTIES, *argv])
+  load_colors(args)
+  res = []
+  for idx in range(num):
+    rng = streams.logic(0, idx)
+    while True:
+      try:
+        res.append(generate_transitions.sample_transition(args, rng))
+        break
+      except Unstackable:
+        pass
+  return res
+
+
+def same(a, b):
+  assert a.dump() == b.dump()
+  assert getattr(a, "last_action", None) == getattr(b, "last_action", None)
+  assert getattr(a, "plan", None) == getattr(b, "plan", None)
+
+
+def test_encode_decode():
+  for pre, suc in transitions(10, "--num-steps", "3"):
+    for state in [pre, suc]:
+      same(state_codec.decode(state_codec.encode(state)), state)
+      # the records written by blocks.dump before the codec
+      same(state_codec.decode(state.dump()), State.undump(state.dump()))
+
+
+def test_pack_unpack():
+  pairs = transitions(10, "--num-steps", "3")
+  for states in [[ pre for pre, _ in pairs ], [ suc for _, suc in pairs ], []]:
+    unpacked = state_codec.unpack(state_codec.pack(states))
+    assert len(unpacked) == len(states)
+    for a, b in zip(unpacked, states):
+      same(a, b)
+
+
+def test_pack_requires_same_sizes():
+  (pre, _), = transitions(1, "--num-objects", "3")
+  (other, _), = transitions(1, "--num-objects", "4")
+  with pytest.raises(ValueError):
+    state_codec.pack([pre, other])
+
+
+def test_newer_version_is_rejected():
+  (pre, _), = transitions(1)
+  data = state_codec.encode(pre)
+  data["version"] = state_codec.VERSION + 1
+  with pytest.raises(ValueError):
+    state_codec.decode(data)
+
+  buf = state_codec.pack([pre])
+  newer = buf.replace(b'"version":1', b'"version":2', 1)
+  assert newer != buf
+  with pytest.raises(ValueError):
+    state_codec.unpack(newer)
+  with pytest.raises(ValueError):
+    state_codec.unpack(b"JUNK" + buf[4:])
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+import trajectory
+
+
+def positions(rng, num_objects=4):
+  return np.stack([rng.uniform(-3, 3, num_objects), np.zeros(num_objects), rng.uniform(0.7, 3, num_objects)], axis=1)
+
+
+@pytest.mark.parametrize("easing", sorted(trajectory.EASINGS))
+def test_endpoints(easing):
+  rng = np.random.default_rng(0)
+  for _ in range(20):
+    keyframes = [ positions(rng) for _ in range(int(rng.integers(2, 5))) ]
+    level = trajectory.operate_level(keyframes, [0.7])
+    # 3 is the default of --num-samples-per-state
+    for num_frames in [3, 2, 10]:
+      frames = trajectory.plan(keyframes, num_frames, level, easing)
+      assert frames.shape == (num_frames, 4, 3)
+      assert np.allclose(frames[0], keyframes[0])
+      assert np.allclose(frames[-1], keyframes[-1])
+    frames = trajectory.move(keyframes[0], keyframes[1], 3, level, easing)
+    assert np.allclose(frames[0], keyframes[0])
+    assert np.allclose(frames[-1], keyframes[1])
+
+
+def test_still_objects_do_not_move():
+  rng = np.random.default_rng(0)
+  pre = positions(rng)
+  suc = pre.copy()
+  suc[1] += [2.0, 0.0, 1.4]
+  frames = trajectory.move(pre, suc, 7, trajectory.operate_level([pre, suc], [0.7]))
+  assert np.array_equal(frames[:, [0, 2, 3]], np.broadcast_to(pre[[0, 2, 3]], (7, 3, 3)))
+  assert np.isclose(frames[:, 1, 2].max(), trajectory.operate_level([pre, suc], [0.7]))
@@ -11,7 +11,10 @@ import sys
 import pprint
 
 import os
-from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "source"))
+import annotation_store
+import deltas
 
 JSONFILE="test.json"
 IMAGEFILE="test.png"
@@ -154,44 +157,42 @@ def visualize_scene_graph_pyviz(scene_graph):
     return net.show(name)
 
 
-def process_images_and_jsons(image_dir, json_dir, output_dir="visualization_output"):
+def process_images_and_jsons(dataset_dir, transition=0, output_dir="visualization_output"):
     """
-    Process all PNG and JSON file pairs from the given directories, generating annotated images and scene graphs.
+    Process all frames of a transition, generating annotated images and scene graphs.
 
     Parameters:
-    image_dir (str): Directory containing PNG files.
-    json_dir (str): Directory containing JSON files.
+    dataset_dir (str): The output directory of render_images.py. The scenes are read from its annotation store.
+    transition (int): The index of the transition.
     output_dir (str): Directory to save the annotated images and scene graphs.
     """
     os.makedirs(output_dir, exist_ok=True)
-    image_files = sorted(Path(image_dir).glob("*.png"))
-    json_files = sorted(Path(json_dir).glob("*.json"))
+    store = annotation_store.open_store(dataset_dir)
+    rows = store.frames(transition)
 
-    if not image_files or not json_files:
-        print("No PNG or JSON files found in the specified directories.")
+    if not len(rows):
+        print(f"No frame of transition {transition} found in {dataset_dir}.")
         return
 
-    for img_file, json_file in zip(image_files, json_files):
-
+    for k in rows:
+        frame = int(store.frame[k])
         try:
-            with open(json_file, "r") as file:
-                data = json.load(file)
+            data = store.scene(k)
 
-            annotated_image_path = os.path.join(output_dir, f"annotated_{img_file.stem[-3:]}.png")
-            scene_graph_path = os.path.join(output_dir, f"scene_graph_{img_file.stem[-3:]}.png")
-            create_annotations_png(data, img_file, output_file=annotated_image_path)
+            annotated_image_path = os.path.join(output_dir, f"annotated_{frame:03d}.png")
+            scene_graph_path = os.path.join(output_dir, f"scene_graph_{frame:03d}.png")
+            create_annotations_png(data, store.image(k), output_file=annotated_image_path)
             scene_graph = create_scene_graph(data)
             visualize_scene_graph_pygraphviz(scene_graph, output_file=scene_graph_path)
-            print(f"Processed {img_file.name} and {json_file.name} -> Saved to {output_dir}")
+            print(f"Processed frame {frame} of transition {transition} -> Saved to {output_dir}")
         except Exception as e:
-            print(f"Error processing {img_file.name} and {json_file.name}: {e}")
+            print(f"Error processing frame {frame} of transition {transition}: {e}")
 
 
 def process_folder():
-    image_directory = "cylinders-6/image_tr/000000/"
-    json_directory = "cylinders-6/scene_tr/000000/"
+    dataset_directory = "cylinders-6"
     output_directory = "visualization_output"
-    process_images_and_jsons(image_directory, json_directory, output_directory)
+    process_images_and_jsons(dataset_directory, 0, output_directory)
 
 def visualize_test():
     if len(sys.argv) > 1:
@@ -201,8 +202,8 @@ def visualize_test():
         IMAGEFILE = sys.argv[2]
 
     try:
-        with open(JSONFILE, "r") as file:
-            data = json.load(file)
+        # also reads the scenes written as deltas by --annotation-deltas
+        data = deltas.load_scene(JSONFILE)
     except FileNotFoundError:
         print(f"Error: File '{JSONFILE}' not found.")
         sys.exit(1)